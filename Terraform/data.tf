@@ -8,14 +8,15 @@ data "archive_file" "extraction_lambda" {
 
     Args:
         type (str): The type of archive file to create (e.g., "zip").
-        source_file (str): The path to the main source file or directory to include in the archive.
+        source_dir (str): The directory to include in the archive, the whole of src so sibling modules are importable.
         output_path (str): The path where the archive file will be generated.
 
     Returns:
         None
     */
   type        = "zip"
-  source_file = "${path.module}/../src/extractor.py"
+  source_dir  = "${path.module}/../src"
+  excludes    = ["__pycache__"]
   output_path = "${path.module}/../extraction_lambda.zip"
 
 }
@@ -25,14 +26,15 @@ data "archive_file" "transformation_lambda" {
 
     Args:
         type (str): The type of archive file to create (e.g., "zip").
-        source_file (str): The path to the main source file or directory to include in the archive.
+        source_dir (str): The directory to include in the archive, the whole of src so sibling modules are importable.
         output_path (str): The path where the archive file will be generated.
 
     Returns:
         None
     */
   type        = "zip"
-  source_file = "${path.module}/../src/transformation.py"
+  source_dir  = "${path.module}/../src"
+  excludes    = ["__pycache__"]
   output_path = "${path.module}/../transformation_lambda.zip"
 }
 data "archive_file" "loader_lambda" {
@@ -41,7 +43,7 @@ data "archive_file" "loader_lambda" {
 
     Args:
         type (str): The type of archive file to create (e.g., "zip").
-        source_file (str): The path to the main source file or directory to include in the archive.
+        source_dir (str): The directory to include in the archive, the whole of src so sibling modules are importable.
         output_path (str): The path where the archive file will be generated.
 
     Returns:
@@ -49,7 +51,8 @@ data "archive_file" "loader_lambda" {
     */
   type = "zip"
 
-  source_file = "${path.module}/../src/loader.py"
+  source_dir  = "${path.module}/../src"
+  excludes    = ["__pycache__"]
   output_path = "${path.module}/../loader_lambda.zip"
 }
 
@@ -310,6 +310,8 @@ resource "aws_s3_bucket_notification" "bucket_notification_loader" {
   lambda_function {
     lambda_function_arn = aws_lambda_function.loader_lambda.arn
     events              = ["s3:ObjectCreated:*"]
+    # only table files, not the profiles and manifests written next to them
+    filter_suffix       = ".pqt"
   }
 }
 
@@ -1,3 +1,12 @@
+locals {
+  /*
+    Environment of the lambdas when var.profile_imports is set: the
+    Python runtime then writes the cost of every module it imports on
+    a cold start to CloudWatch Logs (see scripts/cold_start.py).
+  */
+  import_profile_env = var.profile_imports ? { PYTHONPROFILEIMPORTTIME = "1" } : {}
+}
+
 resource "aws_lambda_function" "extraction_lambda" {
   /*
     Defines an AWS Lambda function for data extraction.
@@ -30,7 +39,7 @@ resource "aws_lambda_function" "extraction_lambda" {
   timeout     = 240
 
   environment {
-    variables = {
+    variables = merge({
       S3_EXTRACT_BUCKET = aws_s3_bucket.rannoch-s3-ingestion-bucket.bucket
       PGUSER            = "${var.username}"
       PGPASSWORD        = "${var.password}"
@@ -39,7 +48,7 @@ resource "aws_lambda_function" "extraction_lambda" {
       PGDATABASE        = "${var.database}"
       PG_LAST_UPDATED   = "2000-01-01 00:00:00"
       S3_CONTROL_BUCKET = data.aws_s3_bucket.utility_bucket.bucket
-    }
+    }, local.import_profile_env)
   }
 }
 resource "aws_lambda_function" "transformation_lambda" {
@@ -74,11 +83,11 @@ resource "aws_lambda_function" "transformation_lambda" {
 
 
   environment {
-    variables = {
+    variables = merge({
       S3_EXTRACT_BUCKET        = aws_s3_bucket.rannoch-s3-ingestion-bucket.bucket
       S3_TRANSFORMATION_BUCKET = aws_s3_bucket.rannoch-s3-processed-data-bucket.bucket
       S3_CONTROL_BUCKET        = data.aws_s3_bucket.utility_bucket.bucket
-    }
+    }, local.import_profile_env)
   }
 }
 resource "aws_lambda_function" "loader_lambda" {
@@ -113,14 +122,19 @@ resource "aws_lambda_function" "loader_lambda" {
   timeout     = 60
 
   environment {
-    variables = {
+    variables = merge({
       PGUSER2     = "${var.OLAP_username}"
       PGPASSWORD2 = "${var.OLAP_password}"
       PGHOST2     = "${var.OLAP_host}"
       PGPORT2     = "${var.OLAP_port}"
       PGDATABASE2 = "${var.OLAP_database}"
       PGDATABASE2 = "${var.OLAP_database}"
-    }
+      S3_CONTROL_BUCKET = data.aws_s3_bucket.utility_bucket.bucket
+      LOAD_STREAM_ROWS  = "100000"
+      LOAD_AGGREGATES   = "false"
+      LOAD_DATE_PARTITIONS = "true"
+      LOAD_AUDIT        = "true"
+    }, local.import_profile_env)
   }
 }
 
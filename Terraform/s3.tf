@@ -59,7 +59,7 @@ resource "aws_s3_object" "transformation_lambda_code" {
   bucket      = var.utility_bucket
   key         = "lambda-code/transformation_lambda.zip"
   source      = "${path.module}/../transformation_lambda.zip"
-  source_hash = filemd5("${path.module}/../src/transformation.py")
+  source_hash = data.archive_file.transformation_lambda.output_md5
 
 }
 resource "aws_s3_object" "loader_lambda_code" {
@@ -76,7 +76,7 @@ resource "aws_s3_object" "loader_lambda_code" {
   bucket      = var.utility_bucket
   key         = "lambda-code/loader_lambda.zip"
   source      = "${path.module}/../loader_lambda.zip"
-  source_hash = filemd5("${path.module}/../src/loader.py")
+  source_hash = data.archive_file.loader_lambda.output_md5
 
 }
 
@@ -29,6 +29,12 @@ variable "loader_lambda_name" {
   default = "loader-"
 }
 
+variable "profile_imports" {
+  description = "profile the module imports of every lambda cold start"
+  type        = bool
+  default     = false
+}
+
 variable "username" {
   description = "username"
   type        = string
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput of the whole pipeline on a synthetic totesys
+database (see synthetic_totesys.py), one stage at a time:
+
+- seed: COPYs the generated source tables into Postgres.
+- extract: runs extractor.extract for every table into a moto S3.
+- transform: runs every tables_transformation_templates function
+  on the extracted files.
+- load: upserts every transformed frame with loader.df_insertion.
+
+For every stage and table it reports rows/s, the peak RSS of the
+process and the bytes the stage moved: the CSV sent by seed, the
+Parquet written by extract and transform, and the in-memory size of
+the frames sent by load.
+
+The source and warehouse tables live in one scratch database,
+dropped and created again by every run. Connection settings come
+from the PG*2 environment variables the loader reads, the database
+is replaced by --database.
+
+    PYTHONPATH=src:scripts python scripts/bench_pipeline.py \
+        --scale 100000 --seed 7 --json /tmp/pipeline.json
+"""
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import boto3
+import pg8000.native as pg
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from moto import mock_aws
+from extractor import extract
+from loader import (
+    COPY_NULL,
+    create_query,
+    df_insertion,
+    df_to_csv,
+    get_batch_size,
+    get_connection,
+    table_relations,
+)
+from transformation import (
+    get_df_from_parquet,
+    tables_transformation_templates,
+)
+from synthetic_totesys import SOURCE_COLUMNS, iter_table, table_sizes
+
+SOURCE_DDL = (
+    Path(__file__).parent.parent
+    / "test"
+    / "test_extract_db"
+    / "subset_test_db_simple.sql"
+)
+BUCKET = "bench-ingestion"
+# Arrow type test -> warehouse column type, the first match wins
+WAREHOUSE_TYPES = [
+    (pa.types.is_boolean, "BOOLEAN"),
+    (pa.types.is_integer, "BIGINT"),
+    (pa.types.is_floating, "DOUBLE PRECISION"),
+    (pa.types.is_decimal, "NUMERIC"),
+    (pa.types.is_date, "DATE"),
+    (pa.types.is_time, "TIME"),
+    (pa.types.is_timestamp, "TIMESTAMP"),
+]
+
+
+def rss_bytes():
+    """Returns the resident set size of this process."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    # the peak so far, in kB on Linux, where /proc is missing anyway
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def sampled_peak_rss(interval=0.01):
+    """
+    Samples the RSS of the process every interval seconds while the
+    block runs.
+
+    Example:
+    ```
+    with sampled_peak_rss() as peak:
+        run_stage()
+    print(peak["rss"])
+    ```
+    """
+    peak = {"rss": rss_bytes()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak["rss"] = max(peak["rss"], rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield peak
+    finally:
+        done.set()
+        sampler.join()
+        peak["rss"] = max(peak["rss"], rss_bytes())
+
+
+def measured(stage, table, rows, run):
+    """
+    Runs one stage of one table and measures it.
+
+    Parameters:
+    - stage (str): The name of the stage.
+    - table (str): The source table.
+    - rows (int): The rows the stage processes.
+    - run (callable): Runs the stage, returning the bytes it moved.
+
+    Returns:
+    - dict: The result, with "skipped" set to the error instead of
+    the measurements if run raised.
+    """
+    result = {"stage": stage, "table": table, "rows": rows}
+    with sampled_peak_rss() as peak:
+        start = time.perf_counter()
+        try:
+            moved = run()
+        except Exception as e:
+            result["skipped"] = f"{type(e).__name__}: {e}"
+            return result
+        seconds = time.perf_counter() - start
+    result.update(
+        seconds=seconds,
+        rows_per_second=rows / seconds if seconds else None,
+        bytes=moved,
+        peak_rss=peak["rss"],
+    )
+    return result
+
+
+def source_ddl():
+    """Returns {source table: CREATE TABLE statement} of the schema."""
+    text = SOURCE_DDL.read_text()
+    return {
+        name: statement
+        for statement, name in re.findall(
+            r'(CREATE TABLE "(\w+)" \(.*?\n\);)', text, re.S
+        )
+    }
+
+
+def create_database(database):
+    """Drops and creates the scratch database, then uses it."""
+    os.environ["PGDATABASE2"] = "postgres"
+    con = get_connection()
+    con.run(f"DROP DATABASE IF EXISTS {pg.identifier(database)}")
+    con.run(f"CREATE DATABASE {pg.identifier(database)}")
+    con.close()
+    os.environ["PGDATABASE2"] = database
+
+
+def seed_table(con, table, scale, seed):
+    """COPYs a generated source table block by block."""
+    sent = 0
+    columns = ", ".join(SOURCE_COLUMNS[table])
+    for block in iter_table(table, scale, seed):
+        stream = df_to_csv(block)
+        sent += len(stream.getvalue())
+        con.run(
+            f"COPY {pg.identifier(table)} ({columns}) "
+            f"FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+            stream=stream,
+        )
+    return sent
+
+
+def extract_table(con, s3, table, event_time):
+    """Extracts a table and returns the size of its file."""
+    extract(s3, con, BUCKET, table, event_time, None)
+    key = f"{event_time:%Y-%m-%dT%H:%M:%S}/{table}.pqt"
+    return s3.head_object(Bucket=BUCKET, Key=key)["ContentLength"]
+
+
+def parquet_size(df):
+    buffer = BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.tell()
+
+
+def create_warehouse_table(con, table_name, primary_key, df):
+    """Creates a warehouse table typed after a transformed frame."""
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    columns = []
+    for field in schema:
+        column_type = next(
+            (name for test, name in WAREHOUSE_TYPES if test(field.type)),
+            "VARCHAR",
+        )
+        columns.append(f"{field.name} {column_type}")
+    con.run(f"DROP TABLE IF EXISTS {table_name}")
+    con.run(
+        f"CREATE TABLE {table_name} "
+        f"({', '.join(columns)}, PRIMARY KEY ({primary_key}))"
+    )
+
+
+def load_table(table_name, primary_key, df):
+    """Upserts a frame as the loader does, auto batch size."""
+    batch_size = get_batch_size(len(df.columns), "auto")
+    query = create_query(table_name, primary_key, df, batch_size)
+    if df_insertion(query, df, table_name, primary_key, batch_size) is None:
+        raise RuntimeError("df_insertion failed, see the log")
+    return int(df.memory_usage(deep=True).sum())
+
+
+def run_pipeline(scale, seed):
+    """
+    Runs every stage over every table.
+
+    Returns:
+    - list: The measured results, see measured.
+    """
+    sizes = table_sizes(scale)
+    ddl = source_ddl()
+    con = get_connection()
+    results = []
+    for table in SOURCE_COLUMNS:
+        con.run(ddl[table])
+        results.append(
+            measured(
+                "seed",
+                table,
+                sizes[table],
+                lambda: seed_table(con, table, scale, seed),
+            )
+        )
+    event_time = datetime.now().replace(microsecond=0)
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={
+                "LocationConstraint": os.environ["AWS_DEFAULT_REGION"]
+            },
+        )
+        for table in SOURCE_COLUMNS:
+            results.append(
+                measured(
+                    "extract",
+                    table,
+                    sizes[table],
+                    lambda: extract_table(con, s3, table, event_time),
+                )
+            )
+        extracted = {
+            result["table"]
+            for result in results
+            if result["stage"] == "extract" and "skipped" not in result
+        }
+        transformed = {}
+        for table, template in tables_transformation_templates.items():
+            if table not in extracted:
+                continue
+            key = f"{event_time:%Y-%m-%dT%H:%M:%S}/{table}.pqt"
+            df = get_df_from_parquet(key, BUCKET)
+
+            def transform():
+                transformed[table] = template(df)
+                return None
+
+            result = measured("transform", table, sizes[table], transform)
+            if table in transformed:
+                result["bytes"] = parquet_size(transformed[table])
+            results.append(result)
+            del df
+    for table, df in transformed.items():
+        table_name, primary_key = table_relations[table]
+        create_warehouse_table(con, table_name, primary_key, df)
+        results.append(
+            measured(
+                "load",
+                table,
+                len(df),
+                lambda: load_table(table_name, primary_key, df),
+            )
+        )
+    con.close()
+    return results
+
+
+def print_report(results):
+    print(
+        f"{'stage':<10}{'table':<16}{'rows':>12}{'seconds':>10}"
+        f"{'rows/s':>12}{'MB':>10}{'peak RSS MB':>13}"
+    )
+    for result in results:
+        prefix = f"{result['stage']:<10}{result['table']:<16}"
+        if "skipped" in result:
+            print(f"{prefix}skipped: {result['skipped'][:60]}")
+            continue
+        print(
+            f"{prefix}{result['rows']:>12,}{result['seconds']:>10.2f}"
+            f"{result['rows_per_second']:>12,.0f}"
+            f"{(result['bytes'] or 0) / 2**20:>10.1f}"
+            f"{result['peak_rss'] / 2**20:>13.0f}"
+        )
+    for stage in ("seed", "extract", "transform", "load"):
+        done = [
+            result
+            for result in results
+            if result["stage"] == stage and "skipped" not in result
+        ]
+        rows = sum(result["rows"] for result in done)
+        seconds = sum(result["seconds"] for result in done)
+        if seconds:
+            print(f"{stage:<10}{'(total)':<16}{rows:>12,}{seconds:>10.2f}"
+                  f"{rows / seconds:>12,.0f}")
+
+
+def main(scale, seed, database, json_path=None):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+    # the extractor waits between dimension and fact tables unless in CI
+    os.environ["CI"] = "true"
+    create_database(database)
+    results = run_pipeline(scale, seed)
+    print_report(results)
+    if json_path:
+        Path(json_path).write_text(
+            json.dumps(
+                {"scale": scale, "seed": seed, "results": results}, indent=2
+            )
+        )
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Benchmark the whole pipeline")
+    parser.add_argument("--scale", type=int, default=10_000,
+                        help="sales orders, 1e3 to 1e8")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", default="totesys_bench")
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+    main(args.scale, args.seed, args.database, args.json)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks every transformation template, split_time,
+loader.create_query and extractor.rows_to_dict on synthetic inputs
+of several sizes, and compares them with a committed baseline.
+
+Every benchmark reports the fastest of --repeat runs and the peak of
+the memory allocated by one run, as traced by tracemalloc (numpy and
+pandas buffers included, Arrow's allocator is not traced). Each run
+is preceded by a fixed reference workload and times are compared as
+multiples of the fastest reference of their own runs, which keeps
+a baseline comparable on a busy or a different machine. Inputs
+are built with synthetic_totesys in the shape the extractor writes
+them: counterparty joined to its address, staff to its department
+and NUMERIC columns as Decimal.
+
+    PYTHONPATH=src:scripts python scripts/bench_templates.py --check
+
+--check exits with status 1 if a benchmark got slower than its
+baseline by more than --tolerance, or allocates more by more than
+--alloc-tolerance. --update writes the current results as the new
+baseline.
+"""
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+from extractor import rows_to_dict
+from loader import create_query, get_batch_size, table_relations
+from transformation import split_time, tables_transformation_templates
+from synthetic_totesys import BLOCK_ROWS, generate_block, table_sizes
+
+BASELINE = Path(__file__).with_name("bench_templates_baseline.json")
+DEFAULT_SCALES = [1_000, 100_000]
+DEFAULT_REPEAT = 5
+# a benchmark regresses once it takes this much longer than its
+# baseline, or allocates this much more at its peak
+DEFAULT_TOLERANCE = 0.5
+DEFAULT_ALLOC_TOLERANCE = 0.2
+# differences below this many reference workloads are timer noise
+NOISE_RELATIVE = 0.05
+# the reference workload, pandas work of the kind templates do
+REFERENCE_ROWS = 20_000
+
+# NUMERIC source columns, read by the extractor as Decimal
+DECIMAL_COLUMNS = {
+    "sales_order": ["unit_price"],
+    "purchase_order": ["item_unit_price"],
+    "payment": ["payment_amount"],
+}
+# the currency template looks the names up online, benchmarks read
+# these instead
+CURRENCY_NAMES = {
+    "GBP": "British Pound",
+    "USD": "US Dollar",
+    "EUR": "Euro",
+}
+
+
+def source_frame(table, rows, seed=0):
+    """
+    Generates rows rows of a source table. Tables of a fixed size,
+    e.g. currency, are repeated up to rows.
+    """
+    # every table sized from the scale has at least rows rows
+    scale = rows * 1000
+    size = min(rows, table_sizes(scale)[table])
+    df = pd.concat(
+        [
+            generate_block(table, scale, block, seed)
+            for block in range(-(-size // BLOCK_ROWS))
+        ],
+        ignore_index=True,
+    ).head(rows)
+    if len(df) < rows:
+        df = df.iloc[np.arange(rows) % len(df)].reset_index(drop=True)
+    return df
+
+
+def extracted_frame(table, rows, seed=0):
+    """Returns source_frame as the extractor would have written it."""
+    df = source_frame(table, rows, seed)
+    for column in DECIMAL_COLUMNS.get(table, []):
+        df[column] = [Decimal(f"{value:.2f}") for value in df[column]]
+    if table == "counterparty":
+        # every address a counterparty of source_frame may refer to
+        addresses = table_sizes(rows * 1000)["address"]
+        address = source_frame("address", addresses, seed)
+        df = df.merge(
+            address.drop(columns=["created_at", "last_updated"]),
+            how="left",
+            left_on="legal_address_id",
+            right_on="address_id",
+        ).drop(columns=["address_id"])
+    elif table == "staff":
+        department = generate_block("department", rows, 0, seed)
+        df = df.merge(
+            department[["department_id", "department_name", "location"]],
+            how="left",
+            on="department_id",
+        )
+    return df
+
+
+def fake_currency_names(url):
+    return BytesIO(json.dumps(CURRENCY_NAMES).encode())
+
+
+def benchmarks(rows):
+    """
+    Returns {benchmark name: (setup, run)} for inputs of rows rows,
+    run(setup()) being the measured call. Templates change their
+    input in place, setup gives every run a fresh copy.
+    """
+    cases = {}
+    for table, template in tables_transformation_templates.items():
+        df = extracted_frame(table, rows)
+        cases[template.__name__] = (df.copy, template)
+    sales = extracted_frame("sales_order", rows)
+    cases["split_time"] = (
+        sales.copy,
+        lambda df: split_time(
+            df, "created_at", "created_date", "created_time"
+        ),
+    )
+    table_name, primary_key = table_relations["sales_order"]
+    transformed = tables_transformation_templates["sales_order"](
+        sales.copy()
+    )
+    batch_size = min(rows, get_batch_size(len(transformed.columns), rows))
+    cases["create_query"] = (
+        lambda: transformed,
+        lambda df: create_query(table_name, primary_key, df, batch_size),
+    )
+    items = sales.values.tolist()
+    columns = [{"name": name} for name in sales.columns]
+    cases["rows_to_dict"] = (
+        lambda: items,
+        lambda items: rows_to_dict(items, columns),
+    )
+    return cases
+
+
+def reference_workload(times):
+    times.dt.date
+    times.dt.time
+    times.astype(str)
+
+
+def timed(run, argument):
+    """Times one call with the garbage collector off, as timeit does."""
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        run(argument)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def measure(setup, run, repeat):
+    """
+    Runs a benchmark and the reference workload, alternately.
+
+    Returns:
+    - tuple: The fastest of repeat runs in seconds, the fastest
+    reference in seconds and the peak bytes allocated by one run.
+    """
+    times = pd.Series(
+        pd.date_range("2022-11-03", periods=REFERENCE_ROWS, freq="min")
+    )
+    seconds = []
+    reference = []
+    for _ in range(repeat):
+        reference.append(timed(reference_workload, times))
+        seconds.append(timed(run, setup()))
+    argument = setup()
+    tracemalloc.start()
+    try:
+        run(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(seconds), min(reference), peak
+
+
+def run_benchmarks(scales, repeat):
+    """
+    Returns:
+    - dict: {"name@rows": {"seconds": float, "relative": float,
+    "peak_bytes": int}}, relative being seconds in reference
+      workloads.
+    """
+    results = {}
+    with patch("transformation.urlopen", fake_currency_names):
+        for rows in scales:
+            for name, (setup, run) in benchmarks(rows).items():
+                seconds, reference, peak = measure(setup, run, repeat)
+                results[f"{name}@{rows}"] = {
+                    "seconds": seconds,
+                    "relative": seconds / reference,
+                    "peak_bytes": peak,
+                }
+    return results
+
+
+def regressions(results, baseline, tolerance, alloc_tolerance):
+    """
+    Compares results with a baseline.
+
+    Parameters:
+    - results (dict): The results of run_benchmarks.
+    - baseline (dict): Earlier results, benchmarks missing from
+    either side are not compared.
+    - tolerance (float): The fraction a benchmark may get slower by,
+    relative to the reference workload.
+    - alloc_tolerance (float): The fraction its peak allocation may
+    grow by.
+
+    Returns:
+    - list: A description of every regression.
+
+    Example:
+    ```
+    regressions(
+        {"create_query@1000": {"relative": 3.0, "peak_bytes": 10}},
+        {"create_query@1000": {"relative": 1.0, "peak_bytes": 10}},
+        0.5,
+        0.2,
+    )
+    # ["create_query@1000 took 3.00 references, baseline 1.00 (3.00x)"]
+    ```
+    """
+    found = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        relative = baseline[key]["relative"]
+        peak = baseline[key]["peak_bytes"]
+        if result["relative"] > relative * (1 + tolerance) + NOISE_RELATIVE:
+            found.append(
+                f"{key} took {result['relative']:.2f} references, "
+                f"baseline {relative:.2f} "
+                f"({result['relative'] / relative:.2f}x)"
+            )
+        if result["peak_bytes"] > peak * (1 + alloc_tolerance):
+            found.append(
+                f"{key} allocated {result['peak_bytes']:,} bytes, "
+                f"baseline {peak:,} "
+                f"({result['peak_bytes'] / max(peak, 1):.2f}x)"
+            )
+    return found
+
+
+def print_report(results, baseline):
+    print(f"{'benchmark':<40}{'seconds':>10}{'vs base':>9}"
+          f"{'peak MB':>10}{'vs base':>9}")
+    for key, result in results.items():
+        base = baseline.get(key)
+        time_ratio = alloc_ratio = ""
+        if base:
+            time_ratio = f"{result['relative'] / base['relative']:.2f}x"
+            alloc_ratio = (
+                f"{result['peak_bytes'] / max(base['peak_bytes'], 1):.2f}x"
+            )
+        print(f"{key:<40}{result['seconds']:>10.4f}{time_ratio:>9}"
+              f"{result['peak_bytes'] / 2**20:>10.2f}{alloc_ratio:>9}")
+
+
+def main(args):
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())["results"]
+    results = run_benchmarks(args.scales, args.repeat)
+    print_report(results, baseline)
+    if args.update:
+        args.baseline.write_text(
+            json.dumps(
+                {"scales": args.scales, "repeat": args.repeat,
+                 "results": results},
+                indent=2,
+            ) + "\n"
+        )
+        print(f"Baseline written to {args.baseline}")
+    if args.check:
+        found = regressions(
+            results, baseline, args.tolerance, args.alloc_tolerance
+        )
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Benchmark the templates")
+    parser.add_argument("--scales", nargs="*", type=int,
+                        default=DEFAULT_SCALES)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--tolerance", type=float,
+                        default=DEFAULT_TOLERANCE)
+    parser.add_argument("--alloc-tolerance", type=float,
+                        default=DEFAULT_ALLOC_TOLERANCE)
+    parser.add_argument("--check", action="store_true",
+                        help="exit with 1 on a regression")
+    parser.add_argument("--update", action="store_true",
+                        help="write the results as the baseline")
+    main(parser.parse_args())
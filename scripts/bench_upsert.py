@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Measures the rows per second of the loader's upsert path for every
+table_relations target, row by row and in multi-row batches.
+
+Each target is shadowed by a temporary table created LIKE it, so the
+rows only ever live in the benchmark's session and the warehouse is
+left untouched. Connection settings come from the PG*2 environment
+variables the loader reads.
+
+    PYTHONPATH=src python scripts/bench_upsert.py --rows 5000 \
+        --batch-sizes 1 100 auto
+"""
+import re
+import time
+from datetime import date, datetime, timedelta
+import numpy as np
+import pandas as pd
+from loader import (
+    create_query,
+    get_batch_size,
+    get_connection,
+    table_relations,
+    upsert_batches,
+)
+from pg_binary_copy import get_column_types
+
+FIRST_DAY = date(1990, 1, 1)
+
+
+def synthetic_column(pg_type, rows):
+    """
+    Generates distinct values of a postgres column type.
+
+    Parameters:
+    - pg_type (str): The column type from get_column_types.
+    - rows (int): The number of values.
+
+    Returns:
+    - list: Python values pg8000 can send for that type.
+    """
+    base = re.sub(r"\(.*\)", "", pg_type).strip()
+    ids = np.arange(1, rows + 1)
+    if base == "smallint":
+        return (ids % 32767).tolist()
+    if base in ("integer", "bigint"):
+        return ids.tolist()
+    if base in ("numeric", "real", "double precision"):
+        return np.round(ids * 1.25 % 10000, 2).tolist()
+    if base == "boolean":
+        return (ids % 2 == 0).tolist()
+    if base == "date":
+        return [FIRST_DAY + timedelta(days=int(i)) for i in ids]
+    if base == "time without time zone":
+        return [(datetime.min + timedelta(seconds=int(i) % 86400)).time()
+                for i in ids]
+    if base == "timestamp without time zone":
+        return [datetime(2022, 1, 1) + timedelta(seconds=int(i))
+                for i in ids]
+    length = re.search(r"\((\d+)\)", pg_type)
+    width = int(length.group(1)) if length else 20
+    return [f"v{i}"[-width:] for i in ids]
+
+
+def synthetic_frame(column_types, rows):
+    """Generates a DataFrame with a value of every column per row."""
+    return pd.DataFrame(
+        {
+            name: synthetic_column(pg_type, rows)
+            for name, pg_type in column_types.items()
+        }
+    )
+
+
+def load(con, table_name, primary_key, df, batch_size):
+    """Upserts df as the loader does and returns the seconds taken."""
+    started = time.perf_counter()
+    if batch_size == 1:
+        ps = con.prepare(create_query(table_name, primary_key, df))
+        for row in df.to_dict("records"):
+            ps.run(**row)
+    else:
+        query = create_query(table_name, primary_key, df, batch_size)
+        upsert_batches(con, query, df, table_name, primary_key, batch_size)
+    return time.perf_counter() - started
+
+
+def bench_target(con, table_name, primary_key, rows, batch_sizes):
+    """
+    Times inserting rows into a shadow of one target, then
+    re-delivering the same, unchanged rows.
+
+    Returns:
+    - list: (batch size, insert rows/s, reload rows/s) per batch size.
+    """
+    df = synthetic_frame(get_column_types(con, table_name), rows)
+    results = []
+    for requested in batch_sizes:
+        batch_size = min(get_batch_size(len(df.columns), requested), rows)
+        con.run(
+            f"CREATE TEMPORARY TABLE {table_name} (LIKE {table_name} "
+            "INCLUDING DEFAULTS INCLUDING INDEXES)"
+        )
+        try:
+            inserted = load(con, table_name, primary_key, df, batch_size)
+            reloaded = load(con, table_name, primary_key, df, batch_size)
+        finally:
+            con.run(f"DROP TABLE pg_temp.{table_name}")
+        results.append((batch_size, rows / inserted, rows / reloaded))
+    return results
+
+
+def main(rows, batch_sizes):
+    con = get_connection()
+    print(f"{'target':<22}{'batch':>7}{'insert rows/s':>16}"
+          f"{'reload rows/s':>16}")
+    for table_name, primary_key in table_relations.values():
+        try:
+            results = bench_target(
+                con, table_name, primary_key, rows, batch_sizes
+            )
+        except Exception as e:
+            print(f"{table_name:<22}skipped: {e}")
+            continue
+        for batch_size, insert_rate, reload_rate in results:
+            print(f"{table_name:<22}{batch_size:>7}{insert_rate:>16,.0f}"
+                  f"{reload_rate:>16,.0f}")
+    con.close()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Benchmark the loader upserts")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--batch-sizes", nargs="*",
+                        default=["1", "100", "auto"])
+    args = parser.parse_args()
+    main(args.rows, args.batch_sizes)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Profiles the cold start of every lambda handler and checks it against
+the committed budget in cold_start_budget.json.
+
+Each handler module is imported in a fresh interpreter run with
+-X importtime, as the Lambda runtime imports it on a cold start, and
+the report lists the modules costing the most. Each run is preceded
+by a fresh import of a reference module and import times are compared
+as multiples of the fastest reference of their own runs, as
+bench_templates does, which keeps the budget comparable on a busy or
+a different machine. The budget holds, per handler, the references
+its import may take and the modules it must leave to first use. No
+boto3 client may be created at import.
+
+    PYTHONPATH=src python scripts/cold_start.py --check
+
+--check exits with status 1 if a handler overran its budget by more
+than --tolerance or imported a deferred module, --update writes the
+current relative import times as the new budget. Deployed lambdas
+profile themselves with the Terraform variable profile_imports=true,
+their -X importtime report then goes to CloudWatch Logs and --logs
+reads it back from an exported log file.
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+BUDGET = Path(__file__).with_name("cold_start_budget.json")
+# the handler modules of the lambdas, see Terraform/lambda.tf
+HANDLERS = ["extractor", "transformation", "loader"]
+DEFAULT_REPEAT = 5
+DEFAULT_TOP = 10
+DEFAULT_TOLERANCE = 0.5
+# overruns below this many references are disk cache and scheduler noise
+NOISE_RELATIVE = 0.1
+# the reference import, a pinned dependency of the kind handlers import
+REFERENCE = "pandas"
+
+# "import time:       self [us] | cumulative | imported package"
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+# run in the fresh interpreter, after which it prints its findings
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+clients = getattr(sys.modules.get("clients"), "clients", {{}})
+print(json.dumps({{"seconds": seconds, "modules": sorted(sys.modules),
+                  "clients": sorted(clients)}}))
+"""
+
+
+def parse_importtime(lines):
+    """
+    Parses the report of -X importtime, or CloudWatch log lines
+    holding it.
+
+    Returns:
+    - list: (module, self seconds, cumulative seconds, depth) of
+    every import, depth 0 being imported at top level.
+
+    Example:
+    ```
+    parse_importtime(["import time:       361 |     263404 |   pandas"])
+    # [("pandas", 0.000361, 0.263404, 1)]
+    ```
+    """
+    imports = []
+    for line in lines:
+        match = IMPORT_TIME.search(line)
+        if match:
+            own, cumulative, indent, module = match.groups()
+            imports.append(
+                (
+                    module,
+                    int(own) / 1e6,
+                    int(cumulative) / 1e6,
+                    (len(indent) - 1) // 2,
+                )
+            )
+    return imports
+
+
+def profile_import(module):
+    """
+    Imports a module in a fresh interpreter, from src as Lambda does.
+
+    Returns:
+    - dict: {"seconds": import time, "modules": modules loaded,
+    "clients": boto3 clients created, "imports": parse_importtime
+      of the run}.
+    """
+    env = dict(os.environ, PYTHONPATH=str(SRC))
+    run = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         CHILD.format(module=module)],
+        cwd=SRC,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(run.stdout.splitlines()[-1])
+    result["modules"] = set(result["modules"])
+    result["imports"] = parse_importtime(run.stderr.splitlines())
+    return result
+
+
+def profile_handlers(handlers, repeat):
+    """
+    Profiles every handler and the reference import, alternately.
+
+    Returns:
+    - dict: {handler: the fastest of repeat profile_import runs,
+    plus "relative", its seconds in the fastest reference import of
+      the same runs}.
+    """
+    results = {}
+    for handler in handlers:
+        runs = []
+        reference = []
+        for _ in range(repeat):
+            reference.append(profile_import(REFERENCE)["seconds"])
+            runs.append(profile_import(handler))
+        result = min(runs, key=lambda run: run["seconds"])
+        result["relative"] = result["seconds"] / min(reference)
+        results[handler] = result
+    return results
+
+
+def top_imports(imports, top, depth=None):
+    """
+    Returns the top imports by their own time, or the imports of one
+    depth by cumulative time, e.g. depth 1 for what a handler itself
+    imports.
+    """
+    if depth is None:
+        return sorted(imports, key=lambda i: i[1], reverse=True)[:top]
+    return sorted(
+        (i for i in imports if i[3] == depth),
+        key=lambda i: i[2],
+        reverse=True,
+    )[:top]
+
+
+def over_budget(results, budget, tolerance):
+    """
+    Compares profiled handlers with their budget.
+
+    Parameters:
+    - results (dict): The results of profile_handlers.
+    - budget (dict): {handler: {"import_relative": float,
+    "deferred": [module]}}, handlers missing from it are not
+      checked.
+    - tolerance (float): The fraction a handler may overrun its
+    import_relative by.
+
+    Returns:
+    - list: A description of every overrun.
+    """
+    found = []
+    for handler, result in results.items():
+        if handler not in budget:
+            continue
+        allowed = budget[handler]["import_relative"]
+        if result["relative"] > allowed * (1 + tolerance) + NOISE_RELATIVE:
+            found.append(
+                f"{handler} imported in {result['relative']:.2f} "
+                f"references, budget {allowed:.2f}"
+            )
+        for module in budget[handler]["deferred"]:
+            if module in result["modules"]:
+                found.append(f"{handler} imports {module} at load")
+        for client in result["clients"]:
+            found.append(f"{handler} creates its {client} client at load")
+    return found
+
+
+def print_imports(imports, top):
+    print(f"{'module':<48}{'self ms':>10}{'total ms':>10}")
+    for module, own, cumulative, _ in imports[:top]:
+        print(f"{module:<48}{own * 1000:>10.1f}{cumulative * 1000:>10.1f}")
+
+
+def print_report(results, budget, top):
+    for handler, result in results.items():
+        allowed = budget.get(handler, {}).get("import_relative")
+        vs = f", budget {allowed:.2f}" if allowed else ""
+        print(
+            f"\n{handler}: {result['seconds']:.3f}s to import, "
+            f"{result['relative']:.2f} references{vs}"
+        )
+        print_imports(top_imports(result["imports"], top, depth=1), top)
+        print("slowest modules of their own:")
+        print_imports(top_imports(result["imports"], top), top)
+
+
+def main(args):
+    if args.logs:
+        imports = parse_importtime(args.logs.read_text().splitlines())
+        print_imports(top_imports(imports, args.top), args.top)
+        return
+    budget = {}
+    if args.budget.exists():
+        budget = json.loads(args.budget.read_text())
+    results = profile_handlers(args.handlers, args.repeat)
+    print_report(results, budget, args.top)
+    if args.update:
+        for handler, result in results.items():
+            budget[handler] = {
+                "import_relative": round(result["relative"], 3),
+                "deferred": budget.get(handler, {}).get("deferred", []),
+            }
+        args.budget.write_text(json.dumps(budget, indent=2) + "\n")
+        print(f"\nBudget written to {args.budget}")
+    if args.check:
+        found = over_budget(results, budget, args.tolerance)
+        for overrun in found:
+            print(f"OVER BUDGET {overrun}")
+        if found:
+            sys.exit(1)
+        print("\nWithin budget")
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Profile the lambda cold starts")
+    parser.add_argument("--handlers", nargs="*", default=HANDLERS)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP)
+    parser.add_argument("--budget", type=Path, default=BUDGET)
+    parser.add_argument("--tolerance", type=float,
+                        default=DEFAULT_TOLERANCE)
+    parser.add_argument("--logs", type=Path,
+                        help="report the -X importtime lines of a log")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with 1 when over budget")
+    parser.add_argument("--update", action="store_true",
+                        help="write the import times as the budget")
+    main(parser.parse_args())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Reports how stale every warehouse table is and the latency
+percentiles of every pipeline stage, from the load audit table the
+loader writes with LOAD_AUDIT=true. Connection settings come from the
+PG*2 environment variables the loader reads.
+
+    PYTHONPATH=src python scripts/freshness_report.py --hours 24
+"""
+from datetime import timedelta
+from lineage import (
+    PERCENTILES,
+    STAGE_LATENCIES,
+    freshness,
+    now,
+    stage_latencies,
+)
+from loader import get_connection
+
+
+def seconds(value):
+    return "-" if value is None else f"{value:,.1f}"
+
+
+def main(hours):
+    con = get_connection()
+    tables = freshness(con)
+    since = None if hours is None else now() - timedelta(hours=hours)
+    latencies = stage_latencies(con, since)
+    con.close()
+
+    print(f"{'table':<22}{'as of':>34}{'staleness s':>14}")
+    for table, fresh in tables.items():
+        print(f"{table:<22}{str(fresh['as_of']):>34}"
+              f"{seconds(fresh['staleness']):>14}")
+    print()
+    print(f"{'table':<22}{'stage':<12}"
+          + "".join(f"{f'p{round(p * 100)} s':>12}" for p in PERCENTILES))
+    for table, stages in latencies.items():
+        for name in STAGE_LATENCIES:
+            values = stages[name] or [None] * len(PERCENTILES)
+            print(f"{table:<22}{name:<12}"
+                  + "".join(f"{seconds(value):>12}" for value in values))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Report warehouse freshness")
+    parser.add_argument("--hours", type=float,
+                        help="only files loaded in the last HOURS")
+    main(parser.parse_args().hours)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Generates a synthetic totesys database: all 11 source tables, with
+every foreign key pointing at a row that exists.
+
+The scale is the number of sales orders, from 1e3 to 1e8. Purchase
+orders, transactions, payments and the dimensions are sized from
+it. Each table is produced in blocks of BLOCK_ROWS rows from a
+generator seeded with (seed, table, block), so a seed always gives
+the same rows whatever part of a table is asked for and at any
+scale the tables can be streamed block by block.
+
+    python scripts/synthetic_totesys.py --scale 100000 \
+        --seed 7 --out /tmp/totesys
+"""
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+BLOCK_ROWS = 100_000
+# created_at of the generated rows spreads over these two years
+FIRST_CREATED = datetime(2022, 11, 3, 14, 20)
+LAST_CREATED = datetime(2024, 11, 3, 14, 20)
+
+CURRENCIES = ["GBP", "USD", "EUR"]
+CURRENCY_WEIGHTS = [0.6, 0.25, 0.15]
+DEPARTMENTS = [
+    ("Sales", "Manchester"),
+    ("Purchasing", "Manchester"),
+    ("Production", "Leeds"),
+    ("Dispatch", "Leeds"),
+    ("Finance", "Manchester"),
+    ("Facilities", "Manchester"),
+    ("Communications", "Leeds"),
+    ("HR", "Leeds"),
+]
+PAYMENT_TYPES = [
+    "SALES_RECEIPT",
+    "SALES_REFUND",
+    "PURCHASE_PAYMENT",
+    "PURCHASE_REFUND",
+]
+FIRST_NAMES = np.array(
+    ["Jeremie", "Deron", "Jeanette", "Ana", "Magdalena", "Korey", "Ozzy",
+     "Pat", "Jodie", "Imani", "Stan", "Rhiannon", "Tom", "Lucy", "Irving"]
+)
+LAST_NAMES = np.array(
+    ["Franey", "Beier", "Erdman", "Glover", "Zieme", "Kreiger", "Lind",
+     "Hagenes", "Rippin", "Walsh", "Lehner", "Kuhic", "Ruecker", "Moen"]
+)
+CITIES = np.array(
+    ["New Patienceburgh", "Aliso Viejo", "Lake Charles", "Olsonside",
+     "Fort Shadburgh", "Kendraburgh", "East Bobbie", "Utica", "Sayreville",
+     "Pricetown", "Hackensack", "Candelarioland", "North Deshaun"]
+)
+COUNTRIES = np.array(
+    ["United Kingdom", "Germany", "United States", "Austria", "Brazil",
+     "Turkey", "Japan", "Mexico", "Ireland", "Poland"]
+)
+DESIGN_NAMES = np.array(
+    ["Wooden", "Bronze", "Granite", "Soft", "Concrete", "Steel", "Frozen",
+     "Fresh", "Cotton", "Plastic", "Rubber", "Metal", "Wooden", "Fresh"]
+)
+COMPANY_WORDS = np.array(
+    ["Fahey", "Leannon", "Armstrong", "Kohler", "Frami", "Mraz", "Yost",
+     "Bashirian", "Moore", "Jacobs", "Hermann", "Price", "Padberg"]
+)
+COMPANY_SUFFIXES = np.array(["LLC", "Inc", "Group", "and Sons", "Ltd"])
+# source table -> its position, used in the seeds of its blocks
+TABLES = [
+    "address",
+    "counterparty",
+    "currency",
+    "department",
+    "design",
+    "payment",
+    "payment_type",
+    "purchase_order",
+    "sales_order",
+    "staff",
+    "transaction",
+]
+
+
+def table_sizes(scale):
+    """
+    Returns {source table: rows} of a database of `scale` sales
+    orders.
+
+    Example:
+    ```
+    table_sizes(1000)["transaction"]  # 1500
+    ```
+    """
+    purchase_orders = max(1, scale // 2)
+    counterparties = max(5, scale // 1000)
+    return {
+        "address": counterparties * 2,
+        "counterparty": counterparties,
+        "currency": len(CURRENCIES),
+        "department": len(DEPARTMENTS),
+        "design": max(10, scale // 100),
+        # one transaction per order and one payment per transaction
+        "payment": scale + purchase_orders,
+        "payment_type": len(PAYMENT_TYPES),
+        "purchase_order": purchase_orders,
+        "sales_order": scale,
+        "staff": max(8, scale // 1000),
+        "transaction": scale + purchase_orders,
+    }
+
+
+def choice(rng, values, rows):
+    """Picks rows values uniformly, as an object array."""
+    return values[rng.integers(0, len(values), rows)].astype(object)
+
+
+def numbered(prefix, ids, suffix=""):
+    """Returns prefix + id + suffix for every id, as a string array."""
+    return (prefix + pd.Series(ids).astype(str) + suffix).to_numpy()
+
+
+def created_at(ids, rows):
+    """
+    Spreads the created_at of a table's rows evenly over the two
+    years, in id order, so later ids are newer.
+    """
+    span = (LAST_CREATED - FIRST_CREATED) / max(rows, 1)
+    offsets = pd.to_timedelta((ids - 1) * span.total_seconds(), unit="s")
+    return (pd.Timestamp(FIRST_CREATED) + offsets).floor("ms")
+
+
+def last_updated(rng, created):
+    """Adds up to 30 days of edits after created_at, in milliseconds."""
+    edits = rng.integers(0, 30 * 86_400_000, len(created))
+    updated = created + pd.to_timedelta(edits, unit="ms")
+    updated = pd.Series(updated).clip(upper=pd.Timestamp(LAST_CREATED))
+    return updated.dt.floor("ms").to_numpy()
+
+
+def day_after(rng, created, most_days):
+    """Returns dates up to most_days after created_at, as yyyy-mm-dd."""
+    days = pd.to_timedelta(rng.integers(1, most_days, len(created)), "D")
+    return (created + days).strftime("%Y-%m-%d").to_numpy()
+
+
+def foreign_keys(rng, sizes, table, rows):
+    """Returns ids of `table` picked uniformly, every one exists."""
+    return rng.integers(1, sizes[table] + 1, rows)
+
+
+def generate_block(table, scale, block, seed=0):
+    """
+    Generates one block of a source table.
+
+    Parameters:
+    - table (str): A source table, one of TABLES.
+    - scale (int): The number of sales orders of the database.
+    - block (int): The block number, rows block * BLOCK_ROWS + 1 to
+    (block + 1) * BLOCK_ROWS.
+    - seed (int): The seed of the database.
+
+    Returns:
+    - DataFrame: The rows of the block, columns in the order of the
+    source schema. Empty past the end of the table.
+    """
+    sizes = table_sizes(scale)
+    rows = sizes[table]
+    first = block * BLOCK_ROWS + 1
+    ids = np.arange(first, min(first + BLOCK_ROWS, rows + 1))
+    rng = np.random.default_rng([seed, TABLES.index(table), block])
+    n = len(ids)
+    created = created_at(ids, rows)
+    columns = GENERATORS[table](rng, sizes, ids, n, created)
+    columns["created_at"] = created
+    columns["last_updated"] = last_updated(rng, created)
+    return pd.DataFrame(columns)[SOURCE_COLUMNS[table]]
+
+
+def address(rng, sizes, ids, n, created):
+    return {
+        "address_id": ids,
+        "address_line_1": numbered("", rng.integers(1, 9999, n), " Gr Street"),
+        "address_line_2": np.where(
+            rng.random(n) < 0.3, None, numbered("Flat ", ids % 97)
+        ),
+        "district": np.where(
+            rng.random(n) < 0.4, None, choice(rng, CITIES, n)
+        ),
+        "city": choice(rng, CITIES, n),
+        "postal_code": numbered("", rng.integers(10000, 99999, n)),
+        "country": choice(rng, COUNTRIES, n),
+        "phone": numbered("", rng.integers(1000000000, 9999999999, n)),
+    }
+
+
+def counterparty(rng, sizes, ids, n, created):
+    names = choice(rng, COMPANY_WORDS, n) + " " + choice(
+        rng, COMPANY_SUFFIXES, n
+    )
+    contact = choice(rng, FIRST_NAMES, n) + " " + choice(rng, LAST_NAMES, n)
+    return {
+        "counterparty_id": ids,
+        "counterparty_legal_name": names,
+        "legal_address_id": foreign_keys(rng, sizes, "address", n),
+        "commercial_contact": np.where(rng.random(n) < 0.1, None, contact),
+        "delivery_contact": np.where(
+            rng.random(n) < 0.1, None, np.roll(contact, 1)
+        ),
+    }
+
+
+def currency(rng, sizes, ids, n, created):
+    return {
+        "currency_id": ids,
+        "currency_code": np.array(CURRENCIES)[ids - 1],
+    }
+
+
+def department(rng, sizes, ids, n, created):
+    return {
+        "department_id": ids,
+        "department_name": [DEPARTMENTS[i - 1][0] for i in ids],
+        "location": [DEPARTMENTS[i - 1][1] for i in ids],
+        "manager": choice(rng, FIRST_NAMES, n) + " " + choice(
+            rng, LAST_NAMES, n
+        ),
+    }
+
+
+def design(rng, sizes, ids, n, created):
+    names = choice(rng, DESIGN_NAMES, n)
+    return {
+        "design_id": ids,
+        "design_name": names,
+        "file_location": numbered("/usr/share/", ids % 50),
+        "file_name": (
+            pd.Series(names).str.lower() + "-" + pd.Series(ids).map(
+                "{:08x}".format
+            ) + ".json"
+        ).to_numpy(),
+    }
+
+
+def payment_type(rng, sizes, ids, n, created):
+    return {
+        "payment_type_id": ids,
+        "payment_type_name": np.array(PAYMENT_TYPES)[ids - 1],
+    }
+
+
+def currencies(rng, n):
+    return rng.choice(
+        np.arange(1, len(CURRENCIES) + 1), n, p=CURRENCY_WEIGHTS
+    )
+
+
+def sales_order(rng, sizes, ids, n, created):
+    return {
+        "sales_order_id": ids,
+        "design_id": foreign_keys(rng, sizes, "design", n),
+        "staff_id": foreign_keys(rng, sizes, "staff", n),
+        "counterparty_id": foreign_keys(rng, sizes, "counterparty", n),
+        "units_sold": rng.integers(1000, 100_001, n),
+        "unit_price": np.round(rng.uniform(2, 4, n), 2),
+        "currency_id": currencies(rng, n),
+        "agreed_delivery_date": day_after(rng, created, 30),
+        "agreed_payment_date": day_after(rng, created, 60),
+        "agreed_delivery_location_id": foreign_keys(
+            rng, sizes, "address", n
+        ),
+    }
+
+
+def purchase_order(rng, sizes, ids, n, created):
+    return {
+        "purchase_order_id": ids,
+        "staff_id": foreign_keys(rng, sizes, "staff", n),
+        "counterparty_id": foreign_keys(rng, sizes, "counterparty", n),
+        "item_code": numbered("", rng.integers(0, 36**7, n) % 10**7),
+        "item_quantity": rng.integers(1, 1001, n),
+        "item_unit_price": np.round(rng.uniform(3, 1000, n), 2),
+        "currency_id": currencies(rng, n),
+        "agreed_delivery_date": day_after(rng, created, 30),
+        "agreed_payment_date": day_after(rng, created, 60),
+        "agreed_delivery_location_id": foreign_keys(
+            rng, sizes, "address", n
+        ),
+    }
+
+
+def transaction(rng, sizes, ids, n, created):
+    # the first transactions are the sales, then the purchases
+    sale = ids <= sizes["sales_order"]
+    return {
+        "transaction_id": ids,
+        "transaction_type": np.where(sale, "SALE", "PURCHASE"),
+        "sales_order_id": pd.Series(ids, dtype="Int64").where(sale),
+        "purchase_order_id": pd.Series(
+            ids - sizes["sales_order"], dtype="Int64"
+        ).where(~sale),
+    }
+
+
+def payment(rng, sizes, ids, n, created):
+    sale = ids <= sizes["sales_order"]
+    refund = rng.random(n) < 0.05
+    return {
+        "payment_id": ids,
+        # one payment per transaction
+        "transaction_id": ids,
+        "counterparty_id": foreign_keys(rng, sizes, "counterparty", n),
+        "payment_amount": np.round(rng.uniform(1, 1_000_000, n), 2),
+        "currency_id": currencies(rng, n),
+        "payment_type_id": np.where(sale, 1, 3) + refund,
+        "paid": rng.random(n) < 0.8,
+        "payment_date": day_after(rng, created, 60),
+        "company_ac_number": rng.integers(10_000_000, 100_000_000, n),
+        "counterparty_ac_number": rng.integers(10_000_000, 100_000_000, n),
+    }
+
+
+def staff(rng, sizes, ids, n, created):
+    first = choice(rng, FIRST_NAMES, n)
+    last = choice(rng, LAST_NAMES, n)
+    return {
+        "staff_id": ids,
+        "first_name": first,
+        "last_name": last,
+        "department_id": foreign_keys(rng, sizes, "department", n),
+        "email_address": (
+            pd.Series(first).str.lower() + "." + pd.Series(last).str.lower()
+            + pd.Series(ids).astype(str) + "@terrifictotes.com"
+        ).to_numpy(),
+    }
+
+
+GENERATORS = {
+    "address": address,
+    "counterparty": counterparty,
+    "currency": currency,
+    "department": department,
+    "design": design,
+    "payment": payment,
+    "payment_type": payment_type,
+    "purchase_order": purchase_order,
+    "sales_order": sales_order,
+    "staff": staff,
+    "transaction": transaction,
+}
+
+# source table -> columns, in the order of the totesys schema
+SOURCE_COLUMNS = {
+    "address": [
+        "address_id", "address_line_1", "address_line_2", "district",
+        "city", "postal_code", "country", "phone", "created_at",
+        "last_updated",
+    ],
+    "counterparty": [
+        "counterparty_id", "counterparty_legal_name", "legal_address_id",
+        "commercial_contact", "delivery_contact", "created_at",
+        "last_updated",
+    ],
+    "currency": [
+        "currency_id", "currency_code", "created_at", "last_updated",
+    ],
+    "department": [
+        "department_id", "department_name", "location", "manager",
+        "created_at", "last_updated",
+    ],
+    "design": [
+        "design_id", "created_at", "last_updated", "design_name",
+        "file_location", "file_name",
+    ],
+    "payment": [
+        "payment_id", "created_at", "last_updated", "transaction_id",
+        "counterparty_id", "payment_amount", "currency_id",
+        "payment_type_id", "paid", "payment_date", "company_ac_number",
+        "counterparty_ac_number",
+    ],
+    "payment_type": [
+        "payment_type_id", "payment_type_name", "created_at",
+        "last_updated",
+    ],
+    "purchase_order": [
+        "purchase_order_id", "created_at", "last_updated", "staff_id",
+        "counterparty_id", "item_code", "item_quantity", "item_unit_price",
+        "currency_id", "agreed_delivery_date", "agreed_payment_date",
+        "agreed_delivery_location_id",
+    ],
+    "sales_order": [
+        "sales_order_id", "created_at", "last_updated", "design_id",
+        "staff_id", "counterparty_id", "units_sold", "unit_price",
+        "currency_id", "agreed_delivery_date", "agreed_payment_date",
+        "agreed_delivery_location_id",
+    ],
+    "staff": [
+        "staff_id", "first_name", "last_name", "department_id",
+        "email_address", "created_at", "last_updated",
+    ],
+    "transaction": [
+        "transaction_id", "transaction_type", "sales_order_id",
+        "purchase_order_id", "created_at", "last_updated",
+    ],
+}
+
+
+def iter_table(table, scale, seed=0):
+    """Yields the blocks of a source table, in id order."""
+    blocks = -(-table_sizes(scale)[table] // BLOCK_ROWS)
+    for block in range(blocks):
+        yield generate_block(table, scale, block, seed)
+
+
+def generate(scale, seed=0, tables=TABLES):
+    """
+    Generates whole source tables, for scales that fit in memory.
+
+    Returns:
+    - dict: {source table: DataFrame}.
+    """
+    return {
+        table: pd.concat(
+            list(iter_table(table, scale, seed)), ignore_index=True
+        )
+        for table in tables
+    }
+
+
+def write_csv(scale, seed, out):
+    """Writes every table to out/<table>.csv, one block at a time."""
+    from pathlib import Path
+
+    Path(out).mkdir(parents=True, exist_ok=True)
+    for table in TABLES:
+        path = Path(out) / f"{table}.csv"
+        for number, block in enumerate(iter_table(table, scale, seed)):
+            block.to_csv(
+                path, mode="a" if number else "w", header=not number,
+                index=False,
+            )
+        print(f"{table:<16}{table_sizes(scale)[table]:>12,} rows  {path}")
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Generate a synthetic totesys")
+    parser.add_argument("--scale", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="synthetic_totesys")
+    args = parser.parse_args()
+    write_csv(args.scale, args.seed, args.out)
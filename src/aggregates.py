@@ -0,0 +1,291 @@
+import logging
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# summary table -> the fact table it summarises, the columns it is
+# grouped by and its measures, {column: expression summed per group}
+AGGREGATES = {
+    "agg_daily_sales": {
+        "source": "fact_sales_order",
+        "group_by": [
+            "created_date",
+            "currency_record_id",
+            "design_record_id",
+        ],
+        "measures": {
+            "units_sold": "units_sold",
+            "sales_value": "units_sold * unit_price",
+        },
+    },
+    "agg_daily_sales_by_counterparty": {
+        "source": "fact_sales_order",
+        "group_by": [
+            "created_date",
+            "currency_record_id",
+            "counterparty_record_id",
+        ],
+        "measures": {
+            "units_sold": "units_sold",
+            "sales_value": "units_sold * unit_price",
+        },
+    },
+    "agg_daily_payments": {
+        "source": "fact_payment",
+        "group_by": [
+            "created_date",
+            "currency_record_id",
+            "counterparty_record_id",
+        ],
+        "measures": {"payment_amount": "payment_amount"},
+    },
+}
+# fact rows summarised by every group, a group reaching 0 is deleted
+ROW_COUNT = "row_count"
+# names of the transition tables the maintenance triggers read
+NEW_ROWS = "new_rows"
+OLD_ROWS = "old_rows"
+TRIGGER_EVENTS = {
+    "INSERT": f"NEW TABLE AS {NEW_ROWS}",
+    "UPDATE": f"OLD TABLE AS {OLD_ROWS} NEW TABLE AS {NEW_ROWS}",
+    "DELETE": f"OLD TABLE AS {OLD_ROWS}",
+}
+
+# summary tables found installed by this process
+installed = set()
+
+
+def aggregates_of(table_name):
+    """Returns the names of the summary tables of a fact table."""
+    return [
+        name
+        for name, definition in AGGREGATES.items()
+        if definition["source"] == table_name
+    ]
+
+
+def create_summary_query(name):
+    """
+    Creates the SQL building a summary table from its whole fact
+    table, used once when the summary is installed.
+
+    Example:
+    ```
+    create_summary_query("agg_daily_payments")
+    ```
+    """
+    definition = AGGREGATES[name]
+    group_by = ", ".join(definition["group_by"])
+    measures = "".join(
+        f"sum({expression}) AS {column}, "
+        for column, expression in definition["measures"].items()
+    )
+    not_null = " AND ".join(
+        f"{column} IS NOT NULL" for column in definition["group_by"]
+    )
+    return f"""
+    CREATE TABLE {name} AS
+    SELECT {group_by}, {measures}count(*) AS {ROW_COUNT}
+    FROM {definition["source"]}
+    WHERE {not_null}
+    GROUP BY {group_by};
+    """
+
+
+def delta_query(name, sources):
+    """
+    Creates the SQL applying the rows of transition tables to a
+    summary table.
+
+    Parameters:
+    - name (str): The summary table.
+    - sources (dict): {transition table: 1 for rows added,
+    -1 for rows removed}.
+
+    Returns:
+    - str: Two statements, the first adding the difference of every
+    touched group, the second deleting the groups left without
+      rows.
+
+    Notes:
+    - Groups are changed by addition rather than recomputed, so
+    concurrent loads touching the same group serialise on its row
+      instead of overwriting each other's totals.
+    - Groups are written in key order, concurrent loads lock shared
+    groups in the same order.
+    """
+    definition = AGGREGATES[name]
+    keys = definition["group_by"]
+    group_by = ", ".join(keys)
+    measures = definition["measures"]
+    delta = " UNION ALL ".join(
+        f"SELECT {group_by}, "
+        + "".join(
+            f"{sign} * ({expression}) AS {column}, "
+            for column, expression in measures.items()
+        )
+        + f"{sign} AS {ROW_COUNT} FROM {source}"
+        for source, sign in sources.items()
+    )
+    not_null = " AND ".join(f"{key} IS NOT NULL" for key in keys)
+    totals = [*measures, ROW_COUNT]
+    changed = " OR ".join(f"sum({column}) <> 0" for column in totals)
+    updates = ", ".join(
+        f"{column} = {name}.{column} + EXCLUDED.{column}"
+        for column in totals
+    )
+    touched = " UNION ".join(
+        f"SELECT {group_by} FROM {source}" for source in sources
+    )
+    return f"""
+        INSERT INTO {name} ({group_by}, {", ".join(totals)})
+        SELECT {group_by}, {", ".join(f"sum({c})" for c in totals)}
+        FROM ({delta}) AS delta
+        WHERE {not_null}
+        GROUP BY {group_by}
+        HAVING {changed}
+        ORDER BY {group_by}
+        ON CONFLICT ({group_by}) DO UPDATE SET {updates};
+        DELETE FROM {name}
+        WHERE {ROW_COUNT} = 0 AND ({group_by}) IN ({touched});"""
+
+
+def create_trigger_function_query(name):
+    """
+    Creates the SQL of the trigger function keeping a summary table
+    up to date with its fact table.
+
+    Notes:
+    - The function runs once per statement and reads the rows the
+    statement inserted, updated or deleted from its transition
+      tables, so a load only ever touches the groups of its rows.
+    """
+    return f"""
+    CREATE OR REPLACE FUNCTION {name}_maintain() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN{delta_query(name, {NEW_ROWS: 1})}
+        ELSIF TG_OP = 'UPDATE' THEN{
+            delta_query(name, {NEW_ROWS: 1, OLD_ROWS: -1})
+        }
+        ELSIF TG_OP = 'DELETE' THEN{delta_query(name, {OLD_ROWS: -1})}
+        ELSE
+            TRUNCATE {name};
+        END IF;
+        RETURN NULL;
+    END
+    $$;
+    """
+
+
+def trigger_names(name):
+    """Returns {event: trigger name} of a summary table's triggers."""
+    return {
+        event: f"{name}_{event.lower()}"
+        for event in [*TRIGGER_EVENTS, "TRUNCATE"]
+    }
+
+
+def create_trigger_queries(name):
+    """
+    Creates the SQL attaching the maintenance triggers of a summary
+    table to its fact table, one per event as a trigger reading
+    transition tables handles a single event.
+    """
+    source = AGGREGATES[name]["source"]
+    queries = []
+    for event, trigger in trigger_names(name).items():
+        transition = TRIGGER_EVENTS.get(event)
+        referencing = f"REFERENCING {transition} " if transition else ""
+        queries += [
+            f"DROP TRIGGER IF EXISTS {trigger} ON {source}",
+            f"""
+            CREATE TRIGGER {trigger}
+            AFTER {event} ON {source}
+            {referencing}FOR EACH STATEMENT
+            EXECUTE FUNCTION {name}_maintain();
+            """,
+        ]
+    return queries
+
+
+def is_installed(con, name):
+    """Checks a summary table and all of its triggers exist."""
+    triggers = list(trigger_names(name).values())
+    [[table, found]] = con.run(
+        """
+        SELECT to_regclass(:name) IS NOT NULL, count(*)
+        FROM pg_trigger
+        WHERE tgrelid = to_regclass(:source)
+        AND tgname = ANY(:triggers);
+        """,
+        name=name,
+        source=AGGREGATES[name]["source"],
+        triggers=triggers,
+    )
+    return table and found == len(triggers)
+
+
+def install_aggregate(con, name):
+    """
+    Creates a summary table from its fact table and the triggers
+    maintaining it from then on.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - name (str): A summary table of AGGREGATES.
+
+    Notes:
+    - The fact table is locked against writes until the summary and
+    its triggers exist, no change falls between the two.
+    - An existing summary table is rebuilt, so installing again
+    repairs one whose triggers were dropped.
+    - Rows with a NULL grouping column are left out of the summary.
+    """
+    definition = AGGREGATES[name]
+    con.run("START TRANSACTION")
+    try:
+        con.run(
+            f"LOCK TABLE {definition['source']} "
+            "IN SHARE ROW EXCLUSIVE MODE"
+        )
+        con.run(f"DROP TABLE IF EXISTS {name}")
+        con.run(create_summary_query(name))
+        con.run(
+            f"ALTER TABLE {name} "
+            f"ADD PRIMARY KEY ({', '.join(definition['group_by'])})"
+        )
+        con.run(create_trigger_function_query(name))
+        for query in create_trigger_queries(name):
+            con.run(query)
+        con.run("COMMIT")
+    except Exception:
+        con.run("ROLLBACK")
+        raise
+    logger.info(f"📐 Installed summary table {name}")
+
+
+def ensure_aggregates(con, table_name):
+    """
+    Installs the summary tables of a fact table not installed yet.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): A warehouse table, tables without summaries
+    are left alone.
+
+    Returns:
+    - list: The summary tables maintained for the table.
+
+    Notes:
+    - Summaries found installed are remembered for the life of the
+    process, a warm Lambda checks them once.
+    """
+    names = aggregates_of(table_name)
+    for name in names:
+        if name in installed:
+            continue
+        if not is_installed(con, name):
+            install_aggregate(con, name)
+        installed.add(name)
+    return names
@@ -0,0 +1,293 @@
+import logging
+from collections import Counter
+from os import environ
+import pyarrow as pa
+from pg8000.native import identifier
+from load_coordinator import (
+    DEFAULT_WORKERS,
+    dependency_graph,
+    list_run_files,
+    schedule,
+)
+from loader import (
+    create_merge_query,
+    get_connection,
+    log_counts,
+    maintain_aggregates,
+    table_relations,
+)
+from date_partitions import ensure_partitions, partition_column
+from maintenance import forget_changes
+from parquet_stream import iter_batches, prefetch
+from pg_binary_copy import (
+    cast_to_column_types,
+    get_column_types,
+    iter_copy_chunks,
+)
+from clients import get_client
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+BULK_STAGING_PREFIX = "bulk_staging_"
+# staging column numbering rows in arrival order, the last one wins
+LOAD_ORDER = "bulk_load_order"
+DEFAULT_BULK_ROWS = 100_000
+
+
+def lambda_handler(event, context):
+    """
+    Bulk loads every table file of one or more transformation runs,
+    for initial loads and replays.
+
+    Parameters:
+    - event (dict): "runs", the extraction timestamps of the runs
+    in the order to apply them, and optionally "bucket" (defaults
+    to $S3_TRANSFORMATION_BUCKET) and "workers" (defaults to
+    $LOAD_WORKERS or DEFAULT_WORKERS).
+    - context (LambdaContext): The Lambda execution context.
+
+    Returns:
+    - dict: {warehouse table: "loaded" | "failed" | "blocked"}.
+
+    Notes:
+    - Each table is loaded by bulk_load_table, dimensions before the
+    facts referencing them.
+    - A table being loaded is locked against readers until its load
+    commits, see bulk_load_table.
+    """
+    bucket = event.get(
+        "bucket", environ.get("S3_TRANSFORMATION_BUCKET", "processed")
+    )
+    workers = int(
+        event.get("workers", environ.get("LOAD_WORKERS", DEFAULT_WORKERS))
+    )
+    s3 = get_client("s3")
+    files = {}
+    for run in event["runs"]:
+        for table_name, keys in list_run_files(s3, bucket, run).items():
+            files.setdefault(table_name, []).extend(keys)
+    primary_keys = dict(table_relations.values())
+    outcomes = schedule(
+        files,
+        dependency_graph(),
+        lambda table_name: bulk_load_table(
+            s3, bucket, table_name, primary_keys[table_name], files[table_name]
+        )
+        is not None,
+        workers,
+    )
+    logger.info(f"📊 Bulk load: {outcomes}")
+    return outcomes
+
+
+def get_secondary_indexes(con, table_name):
+    """
+    Reads the indexes of a table a bulk load can drop.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): The table to describe.
+
+    Returns:
+    - list: (index name, CREATE INDEX statement) pairs.
+
+    Notes:
+    - The primary key, which the upsert's ON CONFLICT needs, and
+    indexes backing a constraint are left out.
+    - Unique indexes are left out too, dropped they would let the
+    merge write duplicates the rebuild then refuses.
+    """
+    return [
+        tuple(row)
+        for row in con.run(
+            """
+            SELECT CAST(CAST(i.indexrelid AS regclass) AS TEXT),
+            pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            WHERE i.indrelid = CAST(:table_name AS regclass)
+            AND NOT i.indisprimary
+            AND NOT i.indisunique
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_constraint c
+                WHERE c.conindid = i.indexrelid
+            )
+            ORDER BY i.indexrelid;
+            """,
+            table_name=table_name,
+        )
+    ]
+
+
+def get_foreign_key_constraints(con, table_name):
+    """
+    Reads the foreign keys declared on a table.
+
+    Returns:
+    - list: (constraint name, definition) pairs, the definition
+    as accepted by ALTER TABLE ... ADD CONSTRAINT.
+    """
+    return [
+        tuple(row)
+        for row in con.run(
+            """
+            SELECT conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = CAST(:table_name AS regclass)
+            AND contype = 'f'
+            ORDER BY conname;
+            """,
+            table_name=table_name,
+        )
+    ]
+
+
+def copy_file(con, bucket, key, staging_table, column_types, rows, client):
+    """
+    Streams one Parquet file into the staging table with binary
+    COPY, a batch of `rows` rows per COPY.
+
+    Returns:
+    - tuple: (rows copied, column names of the file).
+    """
+    copied = 0
+    columns = []
+    for batch in prefetch(iter_batches(client, bucket, key, rows)):
+        table = cast_to_column_types(
+            pa.Table.from_batches([batch]), column_types
+        )
+        con.run(
+            f"COPY {staging_table} ({', '.join(table.column_names)}) "
+            "FROM STDIN WITH (FORMAT binary)",
+            stream=iter_copy_chunks(table),
+        )
+        copied += table.num_rows
+        columns = table.column_names
+    return copied, columns
+
+
+def bulk_load_table(client, bucket, table_name, primary_key, keys, rows=None):
+    """
+    Bulk loads files into one warehouse table.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - keys (list): The files to load, later files win.
+    - rows (int): Rows per COPY, defaults to $BULK_LOAD_ROWS or
+    DEFAULT_BULK_ROWS.
+
+    Returns:
+    - Counter | None: The inserted, updated and unchanged rows, or
+    None if the load failed (the error is logged).
+
+    Notes:
+    - The files are COPYed into an UNLOGGED staging table, then
+    merged into the target in one statement, keeping the last
+      version of every key. Only the columns the files hold are
+      written.
+    - The download and COPY run before the target is touched, the
+    target is only locked by the short transaction that follows.
+    - That transaction drops the target's secondary indexes and
+    foreign keys, merges and recreates them, building an index
+      once is much cheaper than maintaining it row by row, and the
+      foreign keys are validated in one pass. Unique indexes are
+      kept and maintained by the merge (see get_secondary_indexes).
+    - A failure, including a foreign key no longer holding, rolls
+    the indexes, constraints and rows back as they were.
+    - Dropping the indexes takes an ACCESS EXCLUSIVE lock on the
+    target until the transaction commits, readers of the table
+      wait for the merge and the index builds, not for the files.
+    - The target is ANALYZEd once the load committed.
+    - A target partitioned on a date gets the partitions of the
+    staged rows before the merge.
+    - Summary tables of the target are maintained by their triggers
+    during the merge (see loader.maintain_aggregates).
+    """
+    rows = rows or int(environ.get("BULK_LOAD_ROWS", DEFAULT_BULK_ROWS))
+    staging_table = f"{BULK_STAGING_PREFIX}{table_name}"
+    try:
+        maintain_aggregates(table_name)
+        con = get_connection()
+    except Exception as e:
+        logger.error(f"❗ Bulk load of {table_name} not started: {e}")
+        return None
+    try:
+        con.run(f"DROP TABLE IF EXISTS {staging_table}")
+        con.run(
+            f"CREATE UNLOGGED TABLE {staging_table} "
+            f"(LIKE {table_name} INCLUDING DEFAULTS, "
+            f"{LOAD_ORDER} BIGINT GENERATED ALWAYS AS IDENTITY)"
+        )
+        try:
+            column_types = get_column_types(con, table_name)
+            copied = 0
+            columns = []
+            for key in keys:
+                file_rows, file_columns = copy_file(
+                    con, bucket, key, staging_table, column_types, rows, client
+                )
+                copied += file_rows
+                columns += [col for col in file_columns if col not in columns]
+
+            con.run("START TRANSACTION")
+            try:
+                column = partition_column(con, table_name)
+                if column is not None:
+                    days = con.run(
+                        f"SELECT DISTINCT {column} FROM {staging_table}"
+                    )
+                    ensure_partitions(
+                        con, table_name, pa.array([day for [day] in days])
+                    )
+                indexes = get_secondary_indexes(con, table_name)
+                foreign_keys = get_foreign_key_constraints(con, table_name)
+                for name, _ in foreign_keys:
+                    con.run(
+                        f"ALTER TABLE {table_name} "
+                        f"DROP CONSTRAINT {identifier(name)}"
+                    )
+                for name, _ in indexes:
+                    con.run(f"DROP INDEX {name}")
+                logger.info(
+                    f"🧹 {table_name}: dropped {len(indexes)} indexes and "
+                    f"{len(foreign_keys)} foreign keys for the bulk load"
+                )
+                latest = (
+                    f"(SELECT DISTINCT ON ({primary_key}) * "
+                    f"FROM {staging_table} "
+                    f"ORDER BY {primary_key}, {LOAD_ORDER} DESC) AS latest"
+                )
+                [[inserted, updated, unchanged]] = con.run(
+                    create_merge_query(
+                        table_name, primary_key, columns, latest
+                    )
+                )
+                for _, definition in indexes:
+                    con.run(definition)
+                for name, definition in foreign_keys:
+                    con.run(
+                        f"ALTER TABLE {table_name} "
+                        f"ADD CONSTRAINT {identifier(name)} {definition}"
+                    )
+                con.run("COMMIT")
+            except Exception:
+                con.run("ROLLBACK")
+                raise
+        finally:
+            con.run(f"DROP TABLE IF EXISTS {staging_table}")
+        con.run(f"ANALYZE {table_name}")
+        counts = Counter(
+            inserted=inserted, updated=updated, unchanged=unchanged
+        )
+        logger.info(f"🚚 {table_name}: {copied} rows bulk loaded")
+        log_counts(table_name, counts)
+        forget_changes(table_name)
+        return counts
+    except Exception as e:
+        logger.error(f"❗ Bulk load of {table_name} failed: {e}")
+        return None
+    finally:
+        con.close()
@@ -0,0 +1,36 @@
+import threading
+
+# {service: boto3 client}, shared by the modules of a lambda
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service):
+    """
+    Returns the boto3 client of a service, created on first use and
+    kept for the warm invocations that follow.
+
+    Parameters:
+    - service (str): The AWS service, e.g. "s3".
+
+    Example:
+    ```
+    get_client("s3").get_object(Bucket=bucket, Key=key)
+    ```
+
+    Notes:
+    - Creating a client takes tens of milliseconds. Created at
+    import, it was paid by everything importing the loader or
+      the transformation, whether it reached AWS or not.
+    - boto3's default session is not thread safe, clients are
+    created under a lock for the loader's worker threads.
+    """
+    client = clients.get(service)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service)
+            if client is None:
+                import boto3
+
+                client = clients[service] = boto3.client(service)
+    return client
@@ -0,0 +1,350 @@
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from os import environ
+import pandas as pd
+from compaction import SORT_COLUMNS, parse_key
+from load_coordinator import (
+    DEFAULT_WORKERS,
+    MANIFEST,
+    dependency_graph,
+    schedule,
+)
+from loader import (
+    get_df_from_parquet,
+    get_table_name,
+    load_frame,
+    maintain_aggregates,
+    maintain_table,
+    table_relations,
+)
+from clients import get_client
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+WATERMARK_PREFIX = "load_watermarks"
+# files may arrive this many hours behind the newest run loaded,
+# overridden by $LOAD_LATE_HOURS
+DEFAULT_LATE_HOURS = 24
+# the extraction timestamp prefixing every run's keys
+RUN_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# helper column ranking rows by the file they came from
+FILE_ORDER = "_file_order"
+
+
+def lambda_handler(event, context):
+    """
+    Loads every transformed file delivered since the last coalesced
+    load, one upsert per table, dimensions before facts.
+
+    Parameters:
+    - event (dict): Optional overrides, "bucket" (defaults to
+    $S3_TRANSFORMATION_BUCKET), "tables" (source table names,
+    defaults to every table of table_relations) and "workers"
+    (defaults to $LOAD_WORKERS or DEFAULT_WORKERS).
+    - context (LambdaContext): The Lambda execution context.
+
+    Returns:
+    - dict: {warehouse table: "loaded" | "failed" | "blocked"} for
+    the tables that had pending files.
+
+    Notes:
+    - Meant to run on a schedule while the per-file loader runs
+    with LOAD_COALESCE=true, so a row updated in several runs of
+    the window is written to the warehouse once.
+    - The watermarks live in $S3_CONTROL_BUCKET, two coalesced
+    loads must not run at once.
+    - Files arriving up to $LOAD_LATE_HOURS behind the newest run
+    loaded are still picked up, see list_pending_files.
+    """
+    bucket = event.get(
+        "bucket", environ.get("S3_TRANSFORMATION_BUCKET", "processed")
+    )
+    control_bucket = environ["S3_CONTROL_BUCKET"]
+    tables = event.get("tables", list(table_relations))
+    workers = int(
+        event.get("workers", environ.get("LOAD_WORKERS", DEFAULT_WORKERS))
+    )
+    s3 = get_client("s3")
+    watermarks = {
+        table: get_watermark(s3, control_bucket, table) for table in tables
+    }
+    pending = list_pending_files(s3, bucket, watermarks)
+    # several sources may feed one target, e.g. the date_* files
+    targets = {}
+    for table in pending:
+        targets.setdefault(table_relations[table][0], []).append(table)
+    outcomes = schedule(
+        targets,
+        dependency_graph(),
+        lambda target: all(
+            [
+                load_pending(
+                    s3, bucket, control_bucket, table, pending[table]
+                )
+                for table in targets[target]
+            ]
+        ),
+        workers,
+    )
+    logger.info(f"📊 Coalesced load: {outcomes}")
+    return outcomes
+
+
+def coalesced_key(table, keys):
+    """
+    Returns the key the rejected rows and partition progress of a
+    coalesced load are recorded under, one per set of files so it
+    never shares the progress of a single file's load.
+
+    Example:
+    ```
+    coalesced_key("design", ["2024-02-15T10:00:00/design.pqt"])
+    # "coalesced/design/{sha256 of the sorted keys}.pqt"
+    ```
+    """
+    digest = hashlib.sha256("\n".join(sorted(keys)).encode()).hexdigest()
+    return f"coalesced/{table}/{digest}.pqt"
+
+
+def watermark_key(table):
+    """Returns the control bucket key of a table's load watermark."""
+    return f"{WATERMARK_PREFIX}/{table}.json"
+
+
+def get_watermark(client, bucket, table):
+    """
+    Reads what has been loaded of a table.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The control bucket.
+    - table (str): The source table name.
+
+    Returns:
+    - dict: {"run": the newest extraction time loaded, e.g.
+    "2024-02-15T19:01:53" or "" if the table has never been
+      coalesced, "loaded": the keys loaded since its late_horizon}.
+    """
+    try:
+        body = client.get_object(Bucket=bucket, Key=watermark_key(table))[
+            "Body"
+        ].read()
+    except client.exceptions.NoSuchKey:
+        return {"run": "", "loaded": []}
+    watermark = json.loads(body)
+    return {"run": watermark["run"], "loaded": watermark.get("loaded", [])}
+
+
+def save_watermark(client, bucket, table, watermark):
+    """Records what has been loaded of a table, see get_watermark."""
+    client.put_object(
+        Bucket=bucket,
+        Key=watermark_key(table),
+        Body=json.dumps(watermark),
+    )
+
+
+def late_horizon(run):
+    """
+    Returns the oldest extraction time a file may still arrive for
+    once a run is loaded, $LOAD_LATE_HOURS before it.
+
+    Example:
+    ```
+    late_horizon("2024-02-15T19:01:53")  # "2024-02-14T19:01:53"
+    late_horizon("")  # ""
+    ```
+    """
+    if not run:
+        return ""
+    hours = float(environ.get("LOAD_LATE_HOURS", DEFAULT_LATE_HOURS))
+    horizon = datetime.strptime(run, RUN_FORMAT) - timedelta(hours=hours)
+    return horizon.strftime(RUN_FORMAT)
+
+
+def advance_watermark(watermark, keys):
+    """
+    Adds loaded keys to a watermark from get_watermark.
+
+    Returns:
+    - dict: The new watermark, keys behind the late_horizon of its
+    newest run are dropped as no file can arrive for them anymore.
+    """
+    run = max([watermark["run"]] + [run_of(key) for key in keys])
+    horizon = late_horizon(run)
+    loaded = {
+        key for key in watermark["loaded"] + keys if run_of(key) > horizon
+    }
+    return {"run": run, "loaded": sorted(loaded)}
+
+
+def run_of(key):
+    """
+    Returns the extraction timestamp of a transformed table file,
+    or None if the key is not one.
+
+    Example:
+    ```
+    run_of("2024-02-15T19:01:53/design.pqt")  # "2024-02-15T19:01:53"
+    run_of("table=design/last_updated_date=2024-02-15/"
+           "2024-02-15T19:01:53.pqt")  # "2024-02-15T19:01:53"
+    ```
+    """
+    if key.startswith("table="):
+        name = key.split("/")[-1]
+        return name[:-4] if name.endswith(".pqt") else None
+    parsed = parse_key(key)
+    return key.split("/")[0] if parsed else None
+
+
+def list_run_keys(client, bucket, start_after):
+    """
+    Lists the keys of the runs extracted after a time, following
+    pagination.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - start_after (str): An extraction time, "" to list every run.
+
+    Returns:
+    - list: The keys under the "{run}/" prefixes after it.
+
+    Notes:
+    - Keys are listed in order and run prefixes sort by time, the
+    listing starts after the time and stops at the first key past
+      the run prefixes ("compacted/", "table=..."), so it covers
+      only the runs still to load.
+    """
+    keys = []
+    paginator = client.get_paginator("list_objects_v2")
+    start = {"StartAfter": start_after} if start_after else {}
+    for page in paginator.paginate(Bucket=bucket, **start):
+        for item in page.get("Contents", []):
+            if item["Key"][:1] > "9":
+                return keys
+            keys.append(item["Key"])
+    return keys
+
+
+def list_pending_files(client, bucket, watermarks):
+    """
+    Finds the transformed files of each table not loaded yet.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - watermarks (dict): {source table: watermark from
+    get_watermark}.
+
+    Returns:
+    - dict: {source table: keys ordered by extraction time}, only
+    for tables with pending files, covering both the
+    "{run}/{table}.pqt" and the Hive-partitioned layouts.
+
+    Notes:
+    - Only the runs after the earliest late_horizon are listed, Hive
+    partition files are read from the manifests of those runs (see
+      transformation.upload_manifest).
+    - A file is pending if its run is after its table's late_horizon
+    and it is not among the keys the watermark holds as loaded, so
+      a run transformed after a newer one was loaded is not skipped.
+    """
+    horizons = {
+        table: late_horizon(watermark["run"])
+        for table, watermark in watermarks.items()
+    }
+    keys = list_run_keys(client, bucket, min(horizons.values(), default=""))
+    for manifest in [key for key in keys if key.endswith(MANIFEST)]:
+        body = client.get_object(Bucket=bucket, Key=manifest)["Body"]
+        keys += json.loads(body.read())
+    pending = {}
+    for key in keys:
+        run = run_of(key)
+        if run is None:
+            continue
+        table = get_table_name(key)
+        if (
+            table in watermarks
+            and run > horizons[table]
+            and key not in watermarks[table]["loaded"]
+        ):
+            pending.setdefault(table, []).append((run, key))
+    return {
+        table: [key for _, key in sorted(runs)]
+        for table, runs in pending.items()
+    }
+
+
+def coalesce_frames(frames, primary_key):
+    """
+    Merges transformed frames of one table, keeping the latest
+    version of every row.
+
+    Parameters:
+    - frames (list): DataFrames ordered by extraction time.
+    - primary_key (str): The column identifying a row.
+
+    Returns:
+    - DataFrame: One row per primary key.
+
+    Notes:
+    - Rows are ranked by whichever SORT_COLUMNS are present, ties
+    (and tables without them) going to the later file, then the
+    last row per key is kept. The sort is stable and vectorised.
+    """
+    df = pd.concat(
+        [
+            frame.assign(**{FILE_ORDER: number})
+            for number, frame in enumerate(frames)
+        ],
+        ignore_index=True,
+    )
+    order = [col for col in SORT_COLUMNS if col in df.columns]
+    df = df.sort_values(order + [FILE_ORDER], kind="stable")
+    df = df.drop_duplicates(subset=[primary_key], keep="last")
+    return df.drop(columns=FILE_ORDER).reset_index(drop=True)
+
+
+def load_pending(client, bucket, control_bucket, table, keys):
+    """
+    Loads the pending files of one table as a single upsert and
+    advances its watermark.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - control_bucket (str): The bucket holding the watermarks.
+    - table (str): The source table name.
+    - keys (list): Its pending keys, from list_pending_files.
+
+    Returns:
+    - bool: True if the rows loaded, the watermark is left alone
+    otherwise so the next load retries every file.
+
+    Notes:
+    - Rejected rows and partition progress are recorded under
+    coalesced_key, a retry of the same files resumes where it
+      stopped.
+    """
+    table_name, primary_key = table_relations[table]
+    maintain_aggregates(table_name)
+    frames = [get_df_from_parquet(key, bucket) for key in keys]
+    df = coalesce_frames(frames, primary_key)
+    logger.info(
+        f"🧮 {table_name}: {sum(len(frame) for frame in frames)} rows "
+        f"from {len(keys)} files coalesced into {len(df)}"
+    )
+    file_key = coalesced_key(table, keys)
+    if load_frame(df, table_name, primary_key, file_key) is None:
+        return False
+    maintain_table(table_name)
+    watermark = get_watermark(client, control_bucket, table)
+    save_watermark(
+        client, control_bucket, table, advance_watermark(watermark, keys)
+    )
+    return True
@@ -0,0 +1,349 @@
+import json
+import logging
+from datetime import datetime, timezone
+from io import BytesIO
+from os import environ
+import pyarrow as pa
+import pyarrow.parquet as pq
+from clients import get_client
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+COMPACTED_PREFIX = "compacted"
+KEY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# strftime patterns used to bucket per-run keys into time windows
+WINDOW_FORMATS = {
+    "hour": "%Y-%m-%dT%H",
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+}
+
+# Parquet key-value metadata key of the manifest of a compacted file,
+# written in the same PUT as its rows
+MANIFEST_KEY = b"totesys.compaction"
+
+# columns the compacted files are sorted by, in priority order,
+# whichever of them are present in the table
+SORT_COLUMNS = ["last_updated", "last_updated_date", "last_updated_time"]
+
+
+def lambda_handler(event, context):
+    """
+    Compacts the small per-run Parquet files in a bucket
+    into one sorted file per table per time window.
+
+    Parameters:
+    - event (dict): Optional overrides, "bucket" (defaults to
+    $S3_EXTRACT_BUCKET), "window" (one of WINDOW_FORMATS,
+    defaults to "day") and "delete_sources" (defaults to False).
+    - context (LambdaContext): The Lambda execution context.
+
+    Returns:
+    - list: The manifests written during this run.
+
+    Notes:
+    - Only closed windows are compacted, the window containing
+    the invocation time is left alone as extraction may still
+    be writing into it.
+    """
+    bucket = event.get(
+        "bucket", environ.get("S3_EXTRACT_BUCKET", "ingestion")
+    )
+    window = event.get("window", "day")
+    delete_sources = event.get("delete_sources", False)
+    s3 = get_client("s3")
+    until = window_start(datetime.now(timezone.utc), window)
+    return compact_bucket(s3, bucket, window, until, delete_sources)
+
+
+def parse_key(key):
+    """
+    Splits a per-run object key into its extraction time and table.
+
+    Parameters:
+    - key (str): An object key like "2024-02-15T19:01:53/address.pqt".
+
+    Returns:
+    - tuple | None: (datetime, table name), or None if the key
+    is not a per-run table file (e.g. compacted output or sidecars).
+    """
+    parts = key.split("/")
+    if len(parts) != 2 or not parts[1].endswith(".pqt"):
+        return None
+    try:
+        time = datetime.strptime(parts[0], KEY_TIME_FORMAT)
+    except ValueError:
+        return None
+    return time, parts[1][:-4]
+
+
+def window_start(time, window):
+    """
+    Truncates a datetime to the start of its compaction window.
+
+    Parameters:
+    - time (datetime): The time to truncate.
+    - window (str): One of the keys of WINDOW_FORMATS.
+
+    Returns:
+    - str: The window label, e.g. "2024-02-15" for a daily window.
+    """
+    return time.strftime(WINDOW_FORMATS[window])
+
+
+def list_keys(client, bucket, prefix=""):
+    """
+    Lists every object key in a bucket, following pagination.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The bucket to list.
+    - prefix (str): Only list keys starting with this prefix.
+
+    Returns:
+    - list: The object keys.
+    """
+    keys = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(item["Key"] for item in page.get("Contents", []))
+    return keys
+
+
+def group_keys(keys, window, until=None):
+    """
+    Groups per-run keys by table and time window.
+
+    Parameters:
+    - keys (list): Object keys, anything that is not a per-run
+    table file is ignored.
+    - window (str): One of the keys of WINDOW_FORMATS.
+    - until (str | None): Window label at which to stop, windows
+    sorting at or after it are left out.
+
+    Returns:
+    - dict: {(table, window label): [keys in time order]}
+    """
+    groups = {}
+    for key in sorted(keys):
+        parsed = parse_key(key)
+        if parsed is None:
+            continue
+        time, table = parsed
+        label = window_start(time, window)
+        if until is not None and label >= until:
+            continue
+        groups.setdefault((table, label), []).append(key)
+    return groups
+
+
+def compacted_key(table, label):
+    """Returns the key of the compacted file for a table and window."""
+    return f"{COMPACTED_PREFIX}/{label}/{table}.pqt"
+
+
+def manifest_key(table, label):
+    """
+    Returns the key of the JSON manifest for a table and window,
+    written by earlier versions, see get_manifest.
+    """
+    return f"{COMPACTED_PREFIX}/{label}/{table}.manifest.json"
+
+
+def read_table(client, bucket, key):
+    """Reads a Parquet object from S3 into an Arrow table."""
+    body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    return pq.read_table(BytesIO(body))
+
+
+def get_manifest(client, bucket, table, label):
+    """
+    Reads the manifest of a compacted file, returning None if the
+    window has not been compacted yet.
+
+    Notes:
+    - The manifest lives in the compacted file's own metadata, so a
+    file and the source keys it holds are written at once. Files
+    compacted before that fall back to their JSON manifest.
+    """
+    from parquet_stream import open_parquet
+
+    try:
+        metadata = open_parquet(
+            client, bucket, compacted_key(table, label)
+        ).metadata.metadata
+    except client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        return None
+    if metadata and MANIFEST_KEY in metadata:
+        return json.loads(metadata[MANIFEST_KEY])
+    try:
+        body = client.get_object(
+            Bucket=bucket, Key=manifest_key(table, label)
+        )["Body"].read()
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(body)
+
+
+def target_schema(tables):
+    """
+    Returns the schema compacted tables are cast to, every column
+    typed as in the newest table holding it.
+
+    Parameters:
+    - tables (list): Arrow tables, oldest first.
+
+    Notes:
+    - Files written before a column changed type, e.g. the float
+    order ids of dim_transaction before they became Int64, are
+      cast to the current type. Columns with no values at all
+      (null typed) do not override a real type.
+    """
+    fields = {}
+    for table in tables:
+        for field in table.schema:
+            if field.name not in fields or field.type != pa.null():
+                fields[field.name] = field
+    return pa.schema(list(fields.values()))
+
+
+def conform(table, schema):
+    """
+    Casts an Arrow table to a schema, columns it lacks are added
+    as nulls.
+    """
+    return pa.Table.from_arrays(
+        [
+            table.column(field.name).cast(field.type)
+            if field.name in table.column_names
+            else pa.nulls(table.num_rows, field.type)
+            for field in schema
+        ],
+        schema=schema,
+    )
+
+
+def sort_table(table, name):
+    """
+    Sorts an Arrow table by its update time and then by its id.
+
+    Parameters:
+    - table (pa.Table): The merged table.
+    - name (str): The table name, used to find the "{name}_id" column.
+
+    Returns:
+    - pa.Table: The sorted table.
+    """
+    columns = [col for col in SORT_COLUMNS if col in table.column_names]
+    if f"{name}_id" in table.column_names:
+        columns.append(f"{name}_id")
+    if not columns:
+        return table
+    return table.sort_by([(col, "ascending") for col in columns])
+
+
+def compact_window(client, bucket, table, label, keys, delete_sources=False):
+    """
+    Merges the per-run files of one table and window into a single
+    sorted Parquet file and records the merged keys in a manifest.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The bucket holding the files.
+    - table (str): The table name.
+    - label (str): The window label.
+    - keys (list): The per-run keys belonging to the window.
+    - delete_sources (bool): Delete the per-run files once the
+    manifest has been written.
+
+    Returns:
+    - dict | None: The manifest written, or None if every key had
+    already been compacted.
+
+    Notes:
+    - Re-running over a window is safe, keys already listed in the
+    manifest are skipped and new keys are merged into the existing
+    compacted file.
+    - The manifest is written into the compacted file's metadata
+    (see get_manifest), a run failing part way leaves either the
+      old file and manifest or the new ones, never rows compacted
+      without their sources being listed.
+    - Sources are deleted only once the compacted file listing them
+    is written, sources a failed run left are deleted on the next.
+    """
+    output_key = compacted_key(table, label)
+    manifest = get_manifest(client, bucket, table, label)
+    done = set(manifest["source_keys"]) if manifest else set()
+    new_keys = [key for key in keys if key not in done]
+    if not new_keys:
+        if delete_sources:
+            delete_keys(client, bucket, keys)
+        return None
+
+    tables = [read_table(client, bucket, key) for key in new_keys]
+    if manifest:
+        tables.insert(0, read_table(client, bucket, output_key))
+    schema = target_schema(tables).remove_metadata()
+    merged = pa.concat_tables([conform(t, schema) for t in tables])
+    merged = sort_table(merged, table)
+
+    manifest = {
+        "table": table,
+        "window": label,
+        "output_key": output_key,
+        "rows": merged.num_rows,
+        "source_keys": sorted(done | set(new_keys)),
+        "compacted_at": datetime.now(timezone.utc).isoformat(),
+    }
+    merged = merged.replace_schema_metadata(
+        {MANIFEST_KEY: json.dumps(manifest).encode()}
+    )
+    buffer = BytesIO()
+    pq.write_table(merged, buffer)
+    client.put_object(
+        Bucket=bucket, Key=output_key, Body=buffer.getvalue()
+    )
+    logger.info(
+        f"compacted {len(new_keys)} files into {output_key} "
+        f"({merged.num_rows} rows)"
+    )
+
+    if delete_sources:
+        delete_keys(client, bucket, keys)
+    return manifest
+
+
+def delete_keys(client, bucket, keys):
+    """Deletes compacted source keys, missing ones are ignored."""
+    for key in keys:
+        client.delete_object(Bucket=bucket, Key=key)
+
+
+def compact_bucket(client, bucket, window="day", until=None,
+                   delete_sources=False):
+    """
+    Compacts every table and window of per-run files in a bucket.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The bucket to compact.
+    - window (str): One of the keys of WINDOW_FORMATS.
+    - until (str | None): Window label at which to stop, see group_keys.
+    - delete_sources (bool): Delete per-run files after compaction.
+
+    Returns:
+    - list: The manifests written.
+    """
+    groups = group_keys(list_keys(client, bucket), window, until)
+    manifests = []
+    for (table, label), keys in sorted(groups.items()):
+        manifest = compact_window(
+            client, bucket, table, label, keys, delete_sources
+        )
+        if manifest is not None:
+            manifests.append(manifest)
+    return manifests
@@ -0,0 +1,106 @@
+import json
+# pyarrow is imported where used, see parquet_stream
+
+# cap on how many duplicated key values are listed in a profile
+MAX_LISTED_DUPLICATES = 100
+
+
+def is_orderable(data_type):
+    """Returns True for Arrow types min/max can be computed over."""
+    import pyarrow as pa
+
+    return (
+        pa.types.is_integer(data_type)
+        or pa.types.is_floating(data_type)
+        or pa.types.is_decimal(data_type)
+        or pa.types.is_temporal(data_type)
+        or pa.types.is_string(data_type)
+        or pa.types.is_large_string(data_type)
+    )
+
+
+def profile_column(column):
+    """
+    Computes the statistics of one column.
+
+    Parameters:
+    - column (pa.ChunkedArray): The column to profile.
+
+    Returns:
+    - dict: The Arrow type, null count and, for orderable types,
+    the min and max values.
+    """
+    import pyarrow.compute as pc
+
+    stats = {"type": str(column.type), "null_count": column.null_count}
+    if is_orderable(column.type) and column.null_count < len(column):
+        min_max = pc.min_max(column)
+        stats["min"] = min_max["min"].as_py()
+        stats["max"] = min_max["max"].as_py()
+    return stats
+
+
+def profile_table(table, primary_key):
+    """
+    Computes a data-quality profile of a transformed batch.
+
+    Parameters:
+    - table (pa.Table): The batch, as it will be written out.
+    - primary_key (str): The record id column of the batch.
+
+    Returns:
+    - dict: Row count, per-column statistics, distinct key count
+    and the duplicated key values.
+
+    Example:
+    ```
+    profile = profile_table(arrow_table, "design_record_id")
+    ```
+
+    Notes:
+    - Everything is computed with Arrow compute kernels over the
+    column buffers of the table that gets uploaded, null counts
+    come from the array metadata without touching the values.
+    """
+    import pyarrow.compute as pc
+
+    counts = pc.value_counts(table.column(primary_key))
+    duplicated = pc.greater(counts.field("counts"), 1)
+    duplicates = counts.field("values").filter(duplicated).to_pylist()
+    return {
+        "rows": table.num_rows,
+        "primary_key": primary_key,
+        "distinct_keys": len(counts),
+        "duplicate_key_count": len(duplicates),
+        "duplicate_keys": duplicates[:MAX_LISTED_DUPLICATES],
+        "columns": {
+            name: profile_column(table.column(name))
+            for name in table.column_names
+        },
+    }
+
+
+def profile_key(key):
+    """Returns the key of the profile sidecar of an output file."""
+    return f"{key[:-4]}.profile.json"
+
+
+def upload_profile(client, bucket, key, profile):
+    """
+    Writes a profile as a JSON sidecar next to its output file.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The bucket holding the output file.
+    - key (str): The key of the output file.
+    - profile (dict): The profile from profile_table.
+
+    Returns:
+    - None
+    """
+    client.put_object(
+        Bucket=bucket,
+        Key=profile_key(key),
+        Body=json.dumps(profile, default=str),
+        ContentType="application/json",
+    )
@@ -0,0 +1,337 @@
+import logging
+from datetime import date
+from pg8000.native import identifier
+# pandas and pyarrow are imported where used, see parquet_stream
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# fact tables are range partitioned on this column, one partition
+# per calendar month
+PARTITION_COLUMN = "created_date"
+
+# {table: partition column, None if not partitioned} as looked up
+# by this process
+partition_columns = {}
+# partitions known to exist
+known_partitions = set()
+
+
+def get_partition_column(con, table_name):
+    """
+    Reads the column a table is range partitioned on.
+
+    Returns:
+    - str | None: The partition column, or None if the table is not
+    range partitioned on a single column.
+    """
+    rows = con.run(
+        """
+        SELECT a.attname
+        FROM pg_partitioned_table p
+        JOIN pg_attribute a
+        ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+        WHERE p.partrelid = to_regclass(:table_name)
+        AND p.partstrat = 'r' AND p.partnatts = 1;
+        """,
+        table_name=table_name,
+    )
+    return rows[0][0] if rows else None
+
+
+def partition_column(con, table_name):
+    """Returns get_partition_column, looked up once per process."""
+    if table_name not in partition_columns:
+        partition_columns[table_name] = get_partition_column(con, table_name)
+    return partition_columns[table_name]
+
+
+def month_of(day):
+    """Returns the first day of the month of a date or timestamp."""
+    return date(day.year, day.month, 1)
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(table_name, month):
+    """
+    Returns the name of the partition of a month.
+
+    Example:
+    ```
+    partition_name("fact_payment", date(2024, 2, 1))
+    # "fact_payment_2024_02"
+    ```
+    """
+    return f"{table_name}_{month:%Y_%m}"
+
+
+def months_of(values):
+    """
+    Returns the months of partition column values, a pandas Series or
+    an Arrow array, ignoring nulls.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        days = values.unique().to_pylist()
+    else:
+        days = pd.unique(values.dropna())
+    return {month_of(pd.Timestamp(day)) for day in days if day is not None}
+
+
+def get_partitions(con, table_name):
+    """Reads the names of a table's partitions."""
+    return {
+        name
+        for [name] in con.run(
+            """
+            SELECT CAST(inhrelid AS regclass) FROM pg_inherits
+            WHERE inhparent = to_regclass(:table_name);
+            """,
+            table_name=table_name,
+        )
+    }
+
+
+def create_partition(con, table_name, month):
+    """
+    Creates the partition of one month of a table.
+
+    Notes:
+    - A partition another load created meanwhile is not an error.
+    The race is caught inside the statement's own block, which
+      rolls back to a savepoint of its own, so it is safe within a
+      caller's transaction as well as outside one.
+    """
+    name = partition_name(table_name, month)
+    con.run(
+        f"""
+        DO $$
+        BEGIN
+            CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table_name}
+            FOR VALUES FROM ('{month}') TO ('{next_month(month)}');
+        EXCEPTION WHEN duplicate_table OR unique_violation THEN
+            NULL;
+        END
+        $$;
+        """
+    )
+    logger.info(f"🗂️ Created partition {name}")
+    return name
+
+
+def missing_partitions(table_name, values):
+    """
+    Returns the months of values whose partitions are not known to
+    exist, without a round trip.
+    """
+    return {
+        month
+        for month in months_of(values)
+        if partition_name(table_name, month) not in known_partitions
+    }
+
+
+def ensure_partitions(con, table_name, values):
+    """
+    Creates the partitions a batch is routed to before it is loaded.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): The name of the database table.
+    - values (pd.Series | pa.Array): The partition column of the
+    batch.
+
+    Returns:
+    - list: The partitions created.
+
+    Notes:
+    - Partitions are looked up in the catalog only when the batch
+    holds a month not seen before by this process.
+    - Rows with a NULL partition column have no partition and are
+    rejected by the load.
+    """
+    months = missing_partitions(table_name, values)
+    if not months:
+        return []
+    known_partitions.update(get_partitions(con, table_name))
+    created = [
+        create_partition(con, table_name, month)
+        for month in sorted(months)
+        if partition_name(table_name, month) not in known_partitions
+    ]
+    known_partitions.update(
+        partition_name(table_name, month) for month in months
+    )
+    return created
+
+
+def detach_partition(con, table_name, month):
+    """
+    Detaches the partition of one month from its table, leaving its
+    rows in a table of their own to archive or drop.
+
+    Returns:
+    - str: The name of the detached table.
+    """
+    name = partition_name(table_name, month)
+    con.run(f"ALTER TABLE {table_name} DETACH PARTITION {name}")
+    known_partitions.discard(name)
+    logger.info(f"📦 Detached partition {name}")
+    return name
+
+
+def get_table_dependents(con, table_name):
+    """
+    Reads the definitions a table loses when it is recreated.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): The table to describe.
+
+    Returns:
+    - list: The statements recreating its indexes other than the
+    primary key, its unique and exclusion constraints, the
+      foreign keys it declares and those referencing it, then its
+      triggers, in that order.
+    """
+    return [
+        statement
+        for [statement, _] in con.run(
+            """
+            SELECT pg_get_indexdef(i.indexrelid), 1 AS step
+            FROM pg_index i
+            WHERE i.indrelid = to_regclass(:table_name)
+            AND NOT i.indisprimary
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_constraint c
+                WHERE c.conindid = i.indexrelid
+            )
+            UNION ALL
+            SELECT format(
+                'ALTER TABLE %s ADD CONSTRAINT %I %s',
+                CAST(conrelid AS regclass), conname,
+                pg_get_constraintdef(oid)
+            ), CASE contype WHEN 'f' THEN 3 ELSE 2 END
+            FROM pg_constraint
+            WHERE (contype IN ('u', 'x')
+            AND conrelid = to_regclass(:table_name))
+            OR (contype = 'f' AND (conrelid = to_regclass(:table_name)
+            OR confrelid = to_regclass(:table_name)))
+            UNION ALL
+            SELECT pg_get_triggerdef(oid), 4
+            FROM pg_trigger
+            WHERE tgrelid = to_regclass(:table_name)
+            AND NOT tgisinternal
+            ORDER BY step;
+            """,
+            table_name=table_name,
+        )
+    ]
+
+
+def get_referencing_constraints(con, table_name):
+    """Reads (table, constraint) of the foreign keys to a table."""
+    return [
+        tuple(row)
+        for row in con.run(
+            """
+            SELECT CAST(CAST(conrelid AS regclass) AS TEXT), conname
+            FROM pg_constraint
+            WHERE contype = 'f' AND confrelid = to_regclass(:table_name)
+            AND conrelid <> confrelid;
+            """,
+            table_name=table_name,
+        )
+    ]
+
+
+def partition_table(con, table_name, primary_key, column=PARTITION_COLUMN):
+    """
+    Converts a heap table into a table range partitioned by month.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): The table to convert, e.g. "fact_payment".
+    - primary_key (str): Its primary key column.
+    - column (str): The date column to partition on.
+
+    Returns:
+    - list: The partitions created.
+
+    Notes:
+    - The primary key becomes (primary_key, column), a partitioned
+    table's unique keys must hold its partition column, and the
+      loader's upserts conflict on both (see loader.conflict_target).
+    - The rows are copied in one transaction, the table is locked
+    until it commits. Rows with a NULL column fail the conversion.
+    - Defaults, check constraints and sequences are kept. Secondary
+    indexes, unique constraints, foreign keys in both directions
+      and triggers, the summary triggers included, are recreated
+      on the partitioned table (see get_table_dependents).
+    - A unique index, or a foreign key referencing the table, that
+    does not hold the partition column can't be recreated, the
+      conversion fails and is rolled back.
+    """
+    old_table = f"{table_name}_unpartitioned"
+    con.run("START TRANSACTION")
+    try:
+        con.run(f"LOCK TABLE {table_name} IN ACCESS EXCLUSIVE MODE")
+        dependents = get_table_dependents(con, table_name)
+        for referencing, name in get_referencing_constraints(
+            con, table_name
+        ):
+            con.run(
+                f"ALTER TABLE {referencing} DROP CONSTRAINT {identifier(name)}"
+            )
+        con.run(f"ALTER TABLE {table_name} RENAME TO {old_table}")
+        con.run(
+            f"CREATE TABLE {table_name} "
+            f"(LIKE {old_table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE ({column})"
+        )
+        months = {
+            month_of(day)
+            for [day] in con.run(
+                f"SELECT DISTINCT {column} FROM {old_table} "
+                f"WHERE {column} IS NOT NULL"
+            )
+        }
+        created = [
+            create_partition(con, table_name, month)
+            for month in sorted(months)
+        ]
+        con.run(f"INSERT INTO {table_name} SELECT * FROM {old_table}")
+        for [col, sequence] in con.run(
+            """
+            SELECT attname, pg_get_serial_sequence(:old_table, attname)
+            FROM pg_attribute
+            WHERE attrelid = to_regclass(:old_table) AND attnum > 0
+            AND pg_get_serial_sequence(:old_table, attname) IS NOT NULL;
+            """,
+            old_table=old_table,
+        ):
+            con.run(f"ALTER SEQUENCE {sequence} OWNED BY {table_name}.{col}")
+        con.run(f"DROP TABLE {old_table}")
+        con.run(
+            f"ALTER TABLE {table_name} "
+            f"ADD PRIMARY KEY ({primary_key}, {column})"
+        )
+        for statement in dependents:
+            con.run(statement)
+        con.run("COMMIT")
+    except Exception:
+        con.run("ROLLBACK")
+        raise
+    partition_columns[table_name] = column
+    known_partitions.update(created)
+    logger.info(
+        f"🗂️ Partitioned {table_name} by {column} into "
+        f"{len(created)} partitions, {len(dependents)} indexes, "
+        "constraints and triggers recreated"
+    )
+    return created
@@ -0,0 +1,295 @@
+import json
+import logging
+from uuid import uuid4
+# numpy, pandas and pyarrow are imported where used, see parquet_stream
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# the date ranges emitted to dim_date by any fact table, see load_ranges
+EMITTED_RANGES_PREFIX = "dim_date/emitted_ranges"
+# range parts merged into one once there are more
+MAX_RANGE_PARTS = 16
+
+# date columns of the transformed fact tables that reference dim_date
+DATE_COLUMNS = [
+    "created_date",
+    "last_updated_date",
+    "agreed_delivery_date",
+    "agreed_payment_date",
+    "payment_date",
+]
+
+DAY_NAMES = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+MONTH_NAMES = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+
+
+def batch_date_range(df):
+    """
+    Finds the first and last date referenced by a transformed batch.
+
+    Parameters:
+    - df (DataFrame): A transformed fact DataFrame.
+
+    Returns:
+    - tuple | None: (first, last) as numpy datetime64[D], or None
+    if the batch holds no dates.
+    """
+    import numpy as np
+    import pandas as pd
+
+    dates = [
+        pd.to_datetime(df[col], errors="coerce")
+        .to_numpy(dtype="datetime64[ns]")
+        .astype("datetime64[D]")
+        for col in DATE_COLUMNS
+        if col in df.columns
+    ]
+    if not dates:
+        return None
+    dates = np.concatenate(dates)
+    dates = dates[~np.isnat(dates)]
+    if len(dates) == 0:
+        return None
+    return dates.min(), dates.max()
+
+
+def generate_dim_date(start, end):
+    """
+    Generates the dim_date rows of every day from start to end.
+
+    Parameters:
+    - start (np.datetime64): First day, inclusive.
+    - end (np.datetime64): Last day, inclusive.
+
+    Returns:
+    - pa.Table: One row per day with date_id, year, month, day,
+    day_of_week (1 = Monday), day_name, month_name and quarter.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    one_day = np.timedelta64(1, "D")
+    dates = np.arange(start, end + one_day, dtype="datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    month = months.astype("int64") % 12
+    day_of_week = (dates.astype("int64") + 3) % 7
+    return pa.table(
+        {
+            "date_id": pa.array(dates),
+            "year": dates.astype("datetime64[Y]").astype("int64") + 1970,
+            "month": month + 1,
+            "day": (dates - months).astype("int64") + 1,
+            "day_of_week": day_of_week + 1,
+            "day_name": np.array(DAY_NAMES)[day_of_week],
+            "month_name": np.array(MONTH_NAMES)[month],
+            "quarter": month // 3 + 1,
+        }
+    )
+
+
+def dates_key(file_key, table):
+    """
+    Returns the key of the dim_date rows emitted by a fact file, one
+    per fact table so the tables of a run never overwrite each other.
+
+    Example:
+    ```
+    dates_key("2024-02-15T19:01:53/sales_order.pqt", "sales_order")
+    # "2024-02-15T19:01:53/date_sales_order.pqt"
+    ```
+    """
+    return f"{file_key.split('/')[0]}/date_{table}.pqt"
+
+
+def read_ranges(client, bucket, key):
+    """Reads one ranges object, None if it is gone."""
+    import numpy as np
+
+    try:
+        body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except client.exceptions.NoSuchKey:
+        return None
+    return [
+        (np.datetime64(first, "D"), np.datetime64(last, "D"))
+        for first, last in json.loads(body)
+    ]
+
+
+def load_ranges(client, bucket):
+    """
+    Reads the date ranges already emitted to dim_date.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The control bucket.
+
+    Returns:
+    - list: Sorted, non-overlapping (first, last) datetime64[D] pairs.
+
+    Notes:
+    - One set of ranges is shared by every fact table, so a date is
+    emitted once whichever table references it first.
+    - The ranges are the union of every part under
+    EMITTED_RANGES_PREFIX, the per-table ranges of earlier versions
+      included. Parts are only ever added, so concurrent writers
+      never lose each other's ranges.
+    - Over MAX_RANGE_PARTS parts are merged into a new part and the
+    merged ones deleted. A part read is contained in the merged
+      part before it goes, so concurrent merges are safe as well.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    parts = [
+        item["Key"]
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=f"{EMITTED_RANGES_PREFIX}/"
+        )
+        for item in page.get("Contents", [])
+    ]
+    ranges = merge_ranges(
+        [
+            pair
+            for key in parts
+            for pair in read_ranges(client, bucket, key) or []
+        ]
+    )
+    if len(parts) > MAX_RANGE_PARTS:
+        save_ranges(client, bucket, ranges)
+        for key in parts:
+            client.delete_object(Bucket=bucket, Key=key)
+    return ranges
+
+
+def save_ranges(client, bucket, ranges):
+    """
+    Writes date ranges emitted to dim_date as a new part, see
+    load_ranges.
+
+    Notes:
+    - Two fact tables transformed at once may both emit the same
+    dates before either part is written, which only emits those
+      rows twice under their own dates_key, the dim_date upsert
+      is idempotent.
+    """
+    client.put_object(
+        Bucket=bucket,
+        Key=f"{EMITTED_RANGES_PREFIX}/{uuid4().hex}.json",
+        Body=json.dumps([[str(first), str(last)] for first, last in ranges]),
+    )
+
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping and adjacent inclusive date ranges.
+
+    Parameters:
+    - ranges (list): (first, last) datetime64[D] pairs.
+
+    Returns:
+    - list: Sorted, non-overlapping pairs.
+    """
+    import numpy as np
+
+    one_day = np.timedelta64(1, "D")
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + one_day:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def missing_ranges(first, last, ranges):
+    """
+    Finds the parts of a date range not covered by emitted ranges.
+
+    Parameters:
+    - first (np.datetime64): First day wanted, inclusive.
+    - last (np.datetime64): Last day wanted, inclusive.
+    - ranges (list): Sorted, non-overlapping emitted ranges.
+
+    Returns:
+    - list: The uncovered (first, last) pairs.
+    """
+    import numpy as np
+
+    one_day = np.timedelta64(1, "D")
+    missing = []
+    for emitted_first, emitted_last in ranges:
+        if emitted_last < first or emitted_first > last:
+            continue
+        if emitted_first > first:
+            missing.append((first, emitted_first - one_day))
+        first = emitted_last + one_day
+        if first > last:
+            return missing
+    missing.append((first, last))
+    return missing
+
+
+def emit_dim_date(client, bucket, df):
+    """
+    Generates the dim_date rows a batch needs that no fact table has
+    emitted before.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The control bucket holding the emitted ranges.
+    - df (DataFrame): A transformed fact DataFrame.
+
+    Returns:
+    - tuple | None: (new dim_date rows as a pa.Table, the ranges
+    they cover), or None if every date in the batch's range has
+    already been emitted.
+
+    Example:
+    ```
+    emitted = emit_dim_date(s3, control_bucket, fact_df)
+    if emitted is not None:
+        table, ranges = emitted
+        upload_parquet(s3, bucket, dates_key(key, "sales_order"), table)
+        save_ranges(s3, control_bucket, ranges)
+    ```
+
+    Notes:
+    - The whole span from the batch's first to last date is covered
+    so dim_date has no gaps between the dates facts reference.
+    - The ranges are only saved by the caller once the rows are
+    uploaded, so a failed upload is retried by the next batch.
+    """
+    import pyarrow as pa
+
+    span = batch_date_range(df)
+    if span is None:
+        return None
+    ranges = load_ranges(client, bucket)
+    missing = missing_ranges(span[0], span[1], ranges)
+    if not missing:
+        return None
+    table = pa.concat_tables(
+        [generate_dim_date(first, last) for first, last in missing]
+    )
+    logger.info(f"emitting {table.num_rows} dim_date rows")
+    return table, missing
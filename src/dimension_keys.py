@@ -0,0 +1,277 @@
+import logging
+from io import BytesIO
+from uuid import uuid4
+# numpy is imported where used, see parquet_stream
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+KEYS_PREFIX = "dimension_keys"
+# key array parts of a dimension merged into one once there are more
+MAX_KEY_PARTS = 16
+
+# dimension source table -> its record id column after transformation
+DIMENSION_KEY_COLUMNS = {
+    "address": "location_record_id",
+    "counterparty": "counterparty_record_id",
+    "currency": "currency_record_id",
+    "design": "design_record_id",
+    "payment_type": "payment_type_record_id",
+    "staff": "staff_record_id",
+    "transaction": "transaction_record_id",
+}
+
+# fact source table -> its record id column after transformation
+FACT_KEY_COLUMNS = {
+    "payment": "payment_record_id",
+    "purchase_order": "purchase_record_id",
+    "sales_order": "sales_record_id",
+}
+
+# fact source table -> {foreign key column: dimension source table}
+FACT_FOREIGN_KEYS = {
+    "sales_order": {
+        "design_record_id": "design",
+        "sales_staff_id": "staff",
+        "counterparty_record_id": "counterparty",
+        "currency_record_id": "currency",
+        "agreed_delivery_location_id": "address",
+    },
+    "purchase_order": {
+        "staff_record_id": "staff",
+        "counterparty_record_id": "counterparty",
+        "currency_record_id": "currency",
+        "agreed_delivery_location_id": "address",
+    },
+    "payment": {
+        "transaction_record_id": "transaction",
+        "counterparty_record_id": "counterparty",
+        "currency_record_id": "currency",
+        "payment_type_record_id": "payment_type",
+    },
+}
+
+
+def keys_object_key(dimension):
+    """
+    Returns the key of the single key array a dimension was stored
+    in before key arrays were written in parts, see load_keys.
+    """
+    return f"{KEYS_PREFIX}/{dimension}.npy"
+
+
+def keys_prefix(dimension):
+    """Returns the prefix of the key array parts of a dimension."""
+    return f"{KEYS_PREFIX}/{dimension}/"
+
+
+def read_keys(client, bucket, key):
+    """Reads one key array, None if it is gone."""
+    import numpy as np
+
+    try:
+        body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except client.exceptions.NoSuchKey:
+        return None
+    return np.load(BytesIO(body), allow_pickle=False)
+
+
+def load_keys(client, bucket, dimension):
+    """
+    Reads the sorted array of known keys of a dimension.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The control bucket.
+    - dimension (str): The dimension source table name.
+
+    Returns:
+    - np.ndarray | None: The sorted, unique int64 keys, or None
+    if no file of that dimension has been transformed yet.
+
+    Notes:
+    - The keys are the union of every part under keys_prefix, plus
+    the single array of earlier versions. Parts are only ever
+      added, so concurrent writers never lose each other's keys.
+    - Over MAX_KEY_PARTS parts are merged into a new part and the
+    merged ones deleted. A part read is contained in the merged
+      part before it goes, so concurrent merges are safe as well.
+    """
+    import numpy as np
+
+    paginator = client.get_paginator("list_objects_v2")
+    parts = [
+        item["Key"]
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=keys_prefix(dimension)
+        )
+        for item in page.get("Contents", [])
+    ]
+    arrays = [
+        keys
+        for keys in (
+            read_keys(client, bucket, key)
+            for key in parts + [keys_object_key(dimension)]
+        )
+        if keys is not None
+    ]
+    if not arrays:
+        return None
+    keys = np.unique(np.concatenate(arrays))
+    if len(parts) > MAX_KEY_PARTS:
+        save_keys(client, bucket, dimension, keys)
+        for key in parts + [keys_object_key(dimension)]:
+            client.delete_object(Bucket=bucket, Key=key)
+    return keys
+
+
+def save_keys(client, bucket, dimension, keys):
+    """Writes keys of a dimension as a new part, see load_keys."""
+    import numpy as np
+
+    buffer = BytesIO()
+    np.save(buffer, keys, allow_pickle=False)
+    client.put_object(
+        Bucket=bucket,
+        Key=f"{keys_prefix(dimension)}{uuid4().hex}.npy",
+        Body=buffer.getvalue(),
+    )
+
+
+def to_keys(values):
+    """
+    Converts a column of ids to a sorted, unique int64 array,
+    dropping nulls.
+    """
+    import numpy as np
+
+    values = values[values.notna()]
+    return np.unique(values.to_numpy(dtype="int64"))
+
+
+def record_dimension_keys(client, bucket, dimension, values):
+    """
+    Merges the ids of a transformed dimension batch into the
+    stored key array of that dimension.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The control bucket.
+    - dimension (str): The dimension source table name.
+    - values (Series): The record id column of the batch.
+
+    Returns:
+    - np.ndarray: The keys known after the batch.
+
+    Notes:
+    - Only the keys not known yet are written, as a part of their
+    own (see load_keys).
+    """
+    import numpy as np
+
+    known = load_keys(client, bucket, dimension)
+    keys = to_keys(values)
+    if known is not None:
+        keys = keys[~contains(known, keys)]
+        if len(keys) == 0:
+            return known
+    save_keys(client, bucket, dimension, keys)
+    return keys if known is None else np.union1d(known, keys)
+
+
+def contains(keys, values):
+    """
+    Vectorised membership test of values against a sorted key array.
+
+    Parameters:
+    - keys (np.ndarray): Sorted, unique keys.
+    - values (np.ndarray): The values to look up.
+
+    Returns:
+    - np.ndarray: Boolean mask, True where the value is a known key.
+    """
+    import numpy as np
+
+    if len(keys) == 0:
+        return np.zeros(len(values), dtype=bool)
+    index = np.searchsorted(keys, values)
+    index[index == len(keys)] = 0
+    return keys[index] == values
+
+
+def find_orphans(df, key_sets):
+    """
+    Flags the rows of a fact DataFrame whose foreign keys are
+    not known dimension keys.
+
+    Parameters:
+    - df (DataFrame): A transformed fact DataFrame.
+    - key_sets (dict): {foreign key column: sorted key array}.
+
+    Returns:
+    - tuple: (boolean orphan mask as np.ndarray, list with the
+    comma-separated names of the offending columns for every row).
+    """
+    import numpy as np
+
+    orphan = np.zeros(len(df), dtype=bool)
+    reasons = [[] for _ in range(len(df))]
+    for column, keys in key_sets.items():
+        present = df[column].notna().to_numpy()
+        values = df[column].to_numpy()[present].astype("int64")
+        missing = np.zeros(len(df), dtype=bool)
+        missing[present] = ~contains(keys, values)
+        orphan |= missing
+        for row in np.flatnonzero(missing):
+            reasons[row].append(column)
+    return orphan, [",".join(reason) for reason in reasons]
+
+
+def check_fact_keys(client, bucket, file_key, table, df):
+    """
+    Checks the foreign keys of a transformed fact batch against the
+    known dimension keys and reports the orphaned rows.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The control bucket, holding key arrays.
+    - file_key (str): The key of the batch being transformed.
+    - table (str): The fact source table name.
+    - df (DataFrame): The transformed fact DataFrame.
+
+    Returns:
+    - dict: {"rows": orphaned rows, "columns": {foreign key column:
+    the rows it leaves unresolved}}.
+
+    Notes:
+    - Orphans are reported, not removed. Files are transformed
+    concurrently, a fact file may be checked before the dimension
+      file of the same run has recorded its keys, so an orphan here
+      is often only early. Rows whose keys never resolve are
+      rejected by the warehouse's foreign keys and quarantined by
+      the loader.
+    - Dimensions that have never been transformed have no key array
+    yet, their columns are not checked rather than orphaning
+    every row.
+    """
+    key_sets = {}
+    for column, dimension in FACT_FOREIGN_KEYS[table].items():
+        if column not in df.columns:
+            continue
+        keys = load_keys(client, bucket, dimension)
+        if keys is None:
+            logger.warning(f"no known keys for {dimension}, not checked")
+            continue
+        key_sets[column] = keys
+
+    orphan, reasons = find_orphans(df, key_sets)
+    columns = {}
+    for reason in reasons:
+        for column in filter(None, reason.split(",")):
+            columns[column] = columns.get(column, 0) + 1
+    if orphan.any():
+        logger.warning(
+            f"{file_key}: {int(orphan.sum())} {table} rows with keys "
+            f"not known yet {columns}"
+        )
+    return {"rows": int(orphan.sum()), "columns": columns}
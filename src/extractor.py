@@ -1,11 +1,13 @@
 from datetime import datetime
 import logging
 from os import environ
-import pandas as pd
+from os.path import getsize
 from time import sleep
 import pg8000.native as pg
 from boto3 import client
 from botocore.exceptions import ClientError
+from lineage import arrow_with_lineage, change_range, stamp
+from metrics import stage, table_of
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
@@ -107,17 +109,33 @@ def extract(client, conn: pg.Connection, bucket, table, time, since):
     Returns:
         None
 
+    Notes:
+        The query, build_frame, serialize and upload stages
+        emit their metrics (see metrics.stage).
+        The file's lineage holds the range of last_updated
+        of its rows, the event time and the extraction time
+        (see lineage).
     """
     logger.info(f"extracting {table}")
     sql = get_query(table, since, time)
-    rows = conn.run(sql)
+    with stage("extractor", "query", table) as measured:
+        rows = conn.run(sql)
+        measured["rows"] = len(rows)
     if len(rows) > 0:
+        # pandas is most of the extractor's import time, runs finding
+        # no changes never need it
+        import pandas as pd
+
         timestring = time.strftime("%Y-%m-%dT%H:%M:%S")
-        data = rows_to_dict(rows, conn.columns)
-        df = pd.DataFrame(data=data)
+        with stage("extractor", "build_frame", table, rows=len(rows)):
+            data = rows_to_dict(rows, conn.columns)
+            df = pd.DataFrame(data=data)
         key = f"{timestring}/{table}.pqt"
         logger.info(f"output key is {key}")
-        upload_parquet(client, bucket, key, df)
+        lineage = stamp(change_range(df), "event_time", time)
+        upload_parquet(
+            client, bucket, key, df, lineage=stamp(lineage, "extracted_at")
+        )
 
 
 def lambda_handler(event, context):
@@ -199,7 +217,7 @@ def lambda_handler(event, context):
         raise e
 
 
-def upload_parquet(client, bucket, key, data):
+def upload_parquet(client, bucket, key, data, lineage=None):
     """
     Uploads a Pandas DataFrame as a Parquet file
     to an S3 bucket.
@@ -213,13 +231,27 @@ def upload_parquet(client, bucket, key, data):
         for the Parquet file within the S3 bucket.
         data (pd.DataFrame): The Pandas DataFrame
         to be uploaded as a Parquet file.
+        lineage (dict): If given, stamped into the file's
+        key-value metadata (see lineage).
 
     Returns:
         None: The function does not return a specific value.
         It performs the upload operation directly.
     """
-    data.to_parquet(path="/tmp/output.parquet")
-    client.upload_file(Bucket=bucket, Key=key, Filename="/tmp/output.parquet")
+    import pyarrow.parquet as pq
+
+    table = table_of(key)
+    with stage("extractor", "serialize", table, rows=len(data)) as measured:
+        pq.write_table(
+            arrow_with_lineage(data, lineage), "/tmp/output.parquet"
+        )
+        measured["bytes"] = getsize("/tmp/output.parquet")
+    with stage(
+        "extractor", "upload", table, rows=len(data), size=measured["bytes"]
+    ):
+        client.upload_file(
+            Bucket=bucket, Key=key, Filename="/tmp/output.parquet"
+        )
 
 
 def rows_to_dict(items, columns):
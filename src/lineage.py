@@ -0,0 +1,251 @@
+import json
+import logging
+from datetime import datetime, timezone
+# pyarrow is imported where used, the extractor imports this module
+# even on runs with nothing to extract
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# Parquet key-value metadata key of the lineage of a file
+LINEAGE_KEY = b"totesys.lineage"
+# DataFrame.attrs key of the lineage of the file a frame was read from
+LINEAGE_ATTR = "lineage"
+# lineage timestamps, in pipeline order
+STAMPS = [
+    "first_change",
+    "last_change",
+    "event_time",
+    "extracted_at",
+    "transformed_at",
+    "loaded_at",
+]
+# stage -> (from, to) stamps its latency is measured between
+STAGE_LATENCIES = {
+    "extract": ("event_time", "extracted_at"),
+    "transform": ("extracted_at", "transformed_at"),
+    "load": ("transformed_at", "loaded_at"),
+    # the longest any change of a file waited to reach the warehouse
+    "end_to_end": ("first_change", "loaded_at"),
+}
+PERCENTILES = [0.5, 0.9, 0.99]
+AUDIT_TABLE = "load_audit"
+
+
+def as_utc(value):
+    """
+    Returns a datetime, Timestamp or ISO string as an aware UTC
+    datetime. Naive values are taken as UTC, as the source database
+    and Lambda clocks are.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    elif hasattr(value, "to_pydatetime"):
+        value = value.to_pydatetime()
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+def stamp(lineage, name, value=None):
+    """
+    Returns a copy of a lineage with one more timestamp.
+
+    Parameters:
+    - lineage (dict | None): {stamp: ISO string}, None if the
+    upstream file had none.
+    - name (str): One of STAMPS.
+    - value (datetime): The time, defaults to now.
+
+    Example:
+    ```
+    lineage = stamp(None, "event_time", datetime(2024, 2, 13, 10, 45))
+    # {"event_time": "2024-02-13T10:45:00+00:00"}
+    stamp(lineage, "extracted_at")
+    # {"event_time": ..., "extracted_at": now, as an ISO string}
+    ```
+    """
+    stamped = dict(lineage or {})
+    stamped[name] = as_utc(now() if value is None else value).isoformat()
+    return stamped
+
+
+def change_range(df, column="last_updated"):
+    """
+    Returns the first_change and last_change stamps of a source batch,
+    the oldest and newest of its last_updated.
+    """
+    if column not in df.columns or df[column].dropna().empty:
+        return {}
+    changes = df[column].dropna()
+    return {
+        "first_change": as_utc(changes.min()).isoformat(),
+        "last_change": as_utc(changes.max()).isoformat(),
+    }
+
+
+def with_lineage(table, lineage):
+    """
+    Returns an Arrow table with its lineage in the schema metadata,
+    the metadata already there (pandas' included) is kept.
+    """
+    if not lineage:
+        return table
+    metadata = dict(table.schema.metadata or {})
+    metadata[LINEAGE_KEY] = json.dumps(lineage).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def lineage_of(metadata):
+    """
+    Reads the lineage out of Parquet or Arrow key-value metadata.
+
+    Returns:
+    - dict | None: The lineage, None if the file has none.
+    """
+    if not metadata or LINEAGE_KEY not in metadata:
+        return None
+    return json.loads(metadata[LINEAGE_KEY])
+
+
+def ensure_audit_table(con):
+    """Creates the load audit table if it does not exist."""
+    con.run(
+        f"""
+        CREATE TABLE IF NOT EXISTS {AUDIT_TABLE} (
+            audit_id BIGSERIAL PRIMARY KEY,
+            table_name VARCHAR NOT NULL,
+            file_key VARCHAR NOT NULL,
+            rows BIGINT,
+            first_change TIMESTAMPTZ,
+            last_change TIMESTAMPTZ,
+            event_time TIMESTAMPTZ,
+            extracted_at TIMESTAMPTZ,
+            transformed_at TIMESTAMPTZ,
+            loaded_at TIMESTAMPTZ NOT NULL
+        );
+        """
+    )
+
+
+def record_load(con, table_name, file_key, rows, lineage):
+    """
+    Adds a loaded file to the audit table, stamped with its load
+    time.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): The warehouse table loaded.
+    - file_key (str): The file loaded.
+    - rows (int): The rows of the file.
+    - lineage (dict | None): The lineage read from the file, files
+    written before lineage was stamped are recorded with only
+      their load time.
+
+    Returns:
+    - dict: The lineage with loaded_at.
+    """
+    lineage = stamp(lineage, "loaded_at")
+    con.run(
+        f"""
+        INSERT INTO {AUDIT_TABLE} (table_name, file_key, rows,
+            {", ".join(STAMPS)})
+        VALUES (:table_name, :file_key, :rows,
+            {", ".join(f"CAST(:{name} AS TIMESTAMPTZ)" for name in STAMPS)});
+        """,
+        table_name=table_name,
+        file_key=file_key,
+        rows=rows,
+        **{name: lineage.get(name) for name in STAMPS},
+    )
+    return lineage
+
+
+def freshness(con):
+    """
+    Reads how stale every audited warehouse table is.
+
+    Returns:
+    - dict: {table: {"last_load", "as_of", "newest_change",
+    "staleness"}}. as_of is the latest event time loaded, the
+      source as the table reflects it, and staleness is the time
+      since then in seconds.
+
+    Notes:
+    - A table whose source did not change gets no new files, its
+    staleness grows until it changes again.
+    """
+    rows = con.run(
+        f"""
+        SELECT table_name, max(loaded_at), max(event_time),
+            max(last_change),
+            EXTRACT(EPOCH FROM now() - max(event_time))
+        FROM {AUDIT_TABLE}
+        GROUP BY table_name
+        ORDER BY table_name;
+        """
+    )
+    return {
+        table: {
+            "last_load": last_load,
+            "as_of": as_of,
+            "newest_change": newest_change,
+            "staleness": None if staleness is None else float(staleness),
+        }
+        for table, last_load, as_of, newest_change, staleness in rows
+    }
+
+
+def stage_latencies(con, since=None):
+    """
+    Computes latency percentiles of every stage of every table from
+    the audit table.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - since (datetime): Only files loaded from then on, defaults to
+    all of them.
+
+    Returns:
+    - dict: {table: {stage: [p50, p90, p99] in seconds}}, a stage
+    is None where no file has both of its stamps.
+
+    Example:
+    ```
+    stage_latencies(con)["dim_design"]["end_to_end"]
+    # [312.5, 641.0, 730.2]
+    ```
+    """
+    columns = ", ".join(
+        f"percentile_cont(ARRAY{PERCENTILES}) WITHIN GROUP "
+        f"(ORDER BY EXTRACT(EPOCH FROM {end} - {start}))"
+        for start, end in STAGE_LATENCIES.values()
+    )
+    rows = con.run(
+        f"""
+        SELECT table_name, {columns}
+        FROM {AUDIT_TABLE}
+        WHERE loaded_at >= COALESCE(CAST(:since AS TIMESTAMPTZ), '-infinity')
+        GROUP BY table_name
+        ORDER BY table_name;
+        """,
+        since=None if since is None else as_utc(since).isoformat(),
+    )
+    return {
+        table: {
+            name: None if values is None else [float(v) for v in values]
+            for name, values in zip(STAGE_LATENCIES, percentiles)
+        }
+        for table, *percentiles in rows
+    }
+
+
+def arrow_with_lineage(df, lineage):
+    """Converts a DataFrame to Arrow as to_parquet does, with lineage."""
+    import pyarrow as pa
+
+    return with_lineage(pa.Table.from_pandas(df), lineage)
@@ -0,0 +1,261 @@
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import environ
+from dimension_keys import FACT_FOREIGN_KEYS
+from loader import get_connection, get_table_name, load_file, table_relations
+from clients import get_client
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+DEFAULT_WORKERS = 4
+
+# outcome of every table of a run
+LOADED = "loaded"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+# suffix of the manifests listing a run's Hive partition files
+MANIFEST = ".manifest.json"
+
+
+def lambda_handler(event, context):
+    """
+    Loads every table file of one transformation run into the
+    warehouse, dimensions before the facts referencing them.
+
+    Parameters:
+    - event (dict): "run", the extraction timestamp of the run,
+    e.g. "2024-02-15T19:01:53", and optionally "bucket" (defaults
+    to $S3_TRANSFORMATION_BUCKET) and "workers" (defaults to
+    $LOAD_WORKERS or DEFAULT_WORKERS).
+    - context (LambdaContext): The Lambda execution context.
+
+    Returns:
+    - dict: {warehouse table: "loaded" | "failed" | "blocked"}.
+
+    Notes:
+    - Independent tables are loaded concurrently, each load
+    opening its own connection.
+    - A fact table starts as soon as every dimension it references
+    has committed, it is "blocked" if one of them failed.
+    - Not deployed by the Terraform, nothing invokes it on its own.
+    It is run by hand to load or reload a single run, e.g. a
+      backfill, while the per-file loader stays on the bucket
+      notification. schedule and dependency_graph are also used
+      by the coalesced load (see coalesce).
+    """
+    bucket = event.get(
+        "bucket", environ.get("S3_TRANSFORMATION_BUCKET", "processed")
+    )
+    workers = int(
+        event.get("workers", environ.get("LOAD_WORKERS", DEFAULT_WORKERS))
+    )
+    files = list_run_files(get_client("s3"), bucket, event["run"])
+    return load_run(bucket, files, dependency_graph(), workers)
+
+
+def list_run_files(client, bucket, run):
+    """
+    Finds the table files a transformation run wrote.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - run (str): The extraction timestamp of the run.
+
+    Returns:
+    - dict: {warehouse table: [file keys]}, covering both the
+    "{run}/{table}.pqt" and the Hive-partitioned
+    "table={table}/.../{run}.pqt" layouts.
+
+    Notes:
+    - Only the run's own "{run}/" prefix is listed. Hive partition
+    files are read from the "{run}/{table}.manifest.json"
+      manifests the transformation writes next to them (see
+      transformation.upload_manifest), so the listing does not grow
+      with the history of the tables.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    keys = [
+        item["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{run}/")
+        for item in page.get("Contents", [])
+    ]
+    for manifest in [key for key in keys if key.endswith(MANIFEST)]:
+        body = client.get_object(Bucket=bucket, Key=manifest)["Body"]
+        keys += json.loads(body.read())
+
+    files = {}
+    for key in sorted(keys):
+        if not key.endswith(".pqt"):
+            continue
+        table = get_table_name(key)
+        if table in table_relations:
+            files.setdefault(table_relations[table][0], []).append(key)
+    return files
+
+
+def static_dependencies():
+    """
+    Returns the warehouse tables every fact table references,
+    from FACT_FOREIGN_KEYS plus dim_date for their date columns.
+    """
+    return {
+        table_relations[fact][0]: {
+            table_relations[dimension][0] for dimension in keys.values()
+        }
+        | {"dim_date"}
+        for fact, keys in FACT_FOREIGN_KEYS.items()
+    }
+
+
+def get_foreign_keys(con):
+    """
+    Reads the foreign keys declared between warehouse tables.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+
+    Returns:
+    - dict: {table: set of the tables it references}, for the
+    tables of table_relations.
+    """
+    targets = {table for table, _ in table_relations.values()}
+    rows = con.run(
+        """
+        SELECT CAST(CAST(conrelid AS regclass) AS TEXT),
+        CAST(CAST(confrelid AS regclass) AS TEXT)
+        FROM pg_constraint
+        WHERE contype = 'f';
+        """
+    )
+    dependencies = {}
+    for table, referenced in rows:
+        if table in targets and referenced in targets and table != referenced:
+            dependencies.setdefault(table, set()).add(referenced)
+    return dependencies
+
+
+def dependency_graph():
+    """
+    Builds the foreign-key graph of the warehouse tables.
+
+    Returns:
+    - dict: {table: set of the tables it references}.
+
+    Notes:
+    - The keys declared in the warehouse are merged into the
+    static ones, so a schema without constraints is still
+    loaded in order. If the catalog cannot be read the static
+    graph is used alone.
+    """
+    dependencies = static_dependencies()
+    try:
+        with get_connection() as con:
+            declared = get_foreign_keys(con)
+    except Exception as e:
+        logger.warning(f"foreign keys not read, using static graph: {e}")
+        return dependencies
+    for table, referenced in declared.items():
+        dependencies.setdefault(table, set()).update(referenced)
+    return dependencies
+
+
+def load_table(bucket, keys):
+    """
+    Loads the files of one table in key order.
+
+    Returns:
+    - bool: True if every file loaded, stops at the first failure.
+    """
+    for key in keys:
+        if load_file(key, bucket) is None:
+            return False
+    return True
+
+
+def schedule(tables, dependencies, load, workers=DEFAULT_WORKERS):
+    """
+    Runs a load per table, each once the tables it depends on
+    have loaded, running independent tables concurrently.
+
+    Parameters:
+    - tables (iterable): The tables to load.
+    - dependencies (dict): {table: set of the tables it references},
+    tables outside of `tables` count as already loaded.
+    - load (callable): load(table) -> bool, True on success.
+    - workers (int): The most loads running at once.
+
+    Returns:
+    - dict: {table: LOADED | FAILED | BLOCKED}, BLOCKED when a table
+    it depends on did not load.
+
+    Raises:
+    - ValueError: If the dependencies between tables form a cycle.
+    """
+    pending = set(tables)
+    needed = {
+        table: dependencies.get(table, set()) & (pending - {table})
+        for table in pending
+    }
+    outcomes = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            blocked = True
+            # blocking a table can block the tables depending on it
+            while blocked:
+                blocked = False
+                for table in sorted(pending):
+                    states = [outcomes.get(dep) for dep in needed[table]]
+                    if FAILED in states or BLOCKED in states:
+                        logger.error(f"⛔ {table} blocked by a dependency")
+                        outcomes[table] = BLOCKED
+                        pending.remove(table)
+                        blocked = True
+                    elif all(state == LOADED for state in states):
+                        logger.info(f"🚀 Starting load of {table}")
+                        running[pool.submit(load, table)] = table
+                        pending.remove(table)
+            if not running:
+                if pending:
+                    raise ValueError(
+                        f"dependency cycle between {sorted(pending)}"
+                    )
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)
+                try:
+                    loaded = future.result()
+                except Exception as e:
+                    logger.error(f"❗ Load of {table} raised: {e}")
+                    loaded = False
+                outcomes[table] = LOADED if loaded else FAILED
+    return outcomes
+
+
+def load_run(bucket, files, dependencies, workers=DEFAULT_WORKERS):
+    """
+    Loads the files of a run in dependency order.
+
+    Parameters:
+    - bucket (str): The transformed bucket.
+    - files (dict): {warehouse table: [file keys]}, from
+    list_run_files.
+    - dependencies (dict): The dependency_graph.
+    - workers (int): The most tables loaded at once.
+
+    Returns:
+    - dict: {warehouse table: LOADED | FAILED | BLOCKED}.
+    """
+    outcomes = schedule(
+        files,
+        dependencies,
+        lambda table: load_table(bucket, files[table]),
+        workers,
+    )
+    logger.info(f"📊 Run loaded: {outcomes}")
+    return outcomes
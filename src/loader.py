@@ -1,17 +1,78 @@
-import boto3
 import logging
+import json
+import socket
+import threading
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pg8000.native as pg
+from io import BytesIO, StringIO
+from parquet_stream import iter_batches, open_parquet, prefetch, to_frame
+from maintenance import maintain, needs_check, record_changes
+from metrics import stage
+from clients import get_client
+from lineage import LINEAGE_ATTR, ensure_audit_table, lineage_of, record_load
+from aggregates import aggregates_of, ensure_aggregates, installed
+from date_partitions import (
+    ensure_partitions,
+    missing_partitions,
+    partition_column,
+    partition_columns,
+)
 
-# import pandas as pd
 # from io import BytesIO
-import awswrangler as wr
 from os import environ
-import numpy as np
+# pandas, numpy, pyarrow and pg_binary_copy (which needs them) are
+# imported where used, most notifications the loader gets are for
+# keys it skips without reading a file
 
-s3 = boto3.client("s3")
+# the S3 client, created on first use (see s3_client)
+s3 = None
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
+COPY_NULL = r"\N"
+
+# pg8000 sends the parameter count of a statement as a 16 bit integer
+MAX_QUERY_PARAMETERS = 32767
+# pg8000 maps named placeholders in quadratic time when preparing,
+# statements of about this many parameters loaded fastest
+AUTO_BATCH_PARAMETERS = 500
+
+# files this large are upserted in concurrent partitions
+DEFAULT_PARTITION_ROWS = 100_000
+DEFAULT_PARTITIONS = 8
+DEFAULT_LOAD_CONNECTIONS = 4
+DEFAULT_PARTITION_RETRIES = 1
+PROGRESS_PREFIX = "load_progress"
+LOAD_QUARANTINE_PREFIX = "quarantine/load"
+
+# connections kept open between warm invocations
+DEFAULT_IDLE_CONNECTIONS = 4
+# prepared statements kept per table on a connection
+MAX_CACHED_STATEMENTS = 32
+
+# one row: the table's oid and a digest of its column names and types,
+# changing whenever the table is altered or dropped and recreated
+SCHEMA_FINGERPRINT_QUERY = """
+    SELECT CAST(attrelid AS TEXT) || ' ' || md5(string_agg(
+        attname || ' ' || format_type(atttypid, atttypmod), ','
+        ORDER BY attnum))
+    FROM pg_attribute
+    WHERE attrelid = CAST(:table_name AS regclass)
+    AND attnum > 0 AND NOT attisdropped
+    GROUP BY attrelid;
+"""
+
+# databases the load audit table is known to exist in
+audited_databases = set()
+# {connection settings: [idle pg.Connection]}
+idle_connections = {}
+# {pg.Connection: {table: (schema fingerprint, {key: statement})}}
+statement_caches = weakref.WeakKeyDictionary()
+connection_lock = threading.Lock()
+
 
 table_relations = {
     "currency": ("dim_currency", "currency_record_id"),
@@ -24,9 +85,21 @@ table_relations = {
     "purchase_order": ("fact_purchase_order", "purchase_record_id"),
     "payment_type": ("dim_payment_type", "payment_type_record_id"),
     "sales_order": ("fact_sales_order", "sales_record_id"),
+    # the dim_date rows each fact table emits, see dim_date.dates_key
+    "date_payment": ("dim_date", "date_id"),
+    "date_purchase_order": ("dim_date", "date_id"),
+    "date_sales_order": ("dim_date", "date_id"),
 }
 
 
+def s3_client():
+    """
+    Returns the S3 client of the loader, created on first use (see
+    clients.get_client). Tests patch s3 to substitute their own.
+    """
+    return get_client("s3") if s3 is None else s3
+
+
 def lambda_handler(event, context):
     """
     Handles Lambda events triggered by S3 object creations,
@@ -54,6 +127,20 @@ def lambda_handler(event, context):
     and inserts the data into
       the appropriate database table based on predefined
       table relations.
+    - By default the batch is upserted in multi-row statements of
+    LOAD_BATCH_SIZE rows ("auto" unless set, 1 loads row by row).
+    - With LOAD_MODE=copy the batch is bulk loaded through a
+    staging table (df_copy_insertion) instead,
+      LOAD_MODE=binary does the same with binary COPY straight
+      from Arrow (arrow_copy_insertion).
+    - With LOAD_COALESCE=true table files are left for the scheduled
+    coalesced load (coalesce.lambda_handler) and "Deferred" is
+    returned.
+    - With LOAD_AGGREGATES=true the summary tables of a fact table
+    are installed before its first load (see maintain_aggregates).
+    - With LOAD_DATE_PARTITIONS=true tables partitioned on a date
+    get the partitions of every batch before it is loaded (see
+      prepare_partitions).
     - If successful, it returns 'Ok'. If an error occurs,
     it logs the error and does not
       raise an exception.
@@ -65,23 +152,336 @@ def lambda_handler(event, context):
             "%3A", ":"
         )
         table_name = get_table_name(file_key)
-        # get dataframe
-        logger.info(f"📂 Processing file {file_key} from bucket {bucket_name}")
-        df = get_df_from_parquet(file_key, bucket_name)
-        # get db_table_name and primary_key
-        table_name, primary_key = table_relations[table_name]
-        # create query template for specific table fill with placeholders
-        sql_query_template = create_query(table_name, primary_key, df)
-        # insert
-        logger.info(f"🚀 Executing SQL query on table {table_name}")
-        df_insertion(sql_query_template, df, table_name)
-        logger.info(f"✅ Successfully inserted data into {table_name}")
+        # compacted files, manifests and sidecars share the bucket
+        if not file_key.endswith(".pqt") or table_name not in table_relations:
+            logger.info(f"⏭️ Skipping {file_key}, not a table file")
+            return "Skipped"
+        if environ.get("LOAD_COALESCE", "false") == "true":
+            logger.info(f"⏳ Deferring {file_key} to the coalesced load")
+            return "Deferred"
+        load_file(file_key, bucket_name)
         return "Ok"
     except Exception as e:
         logger.error(f"❌ Failed to process file: {str(e)}")
 
 
-def create_query(table_name, primary_key, df):
+def load_file(file_key, bucket_name):
+    """
+    Loads one transformed Parquet file into its warehouse table.
+
+    Parameters:
+    - file_key (str): The key of a table file, e.g.
+    "2024-02-15T19:01:53/design.pqt".
+    - bucket_name (str): The bucket holding the file.
+
+    Returns:
+    - str | None: The status message of the insertion, or None
+    if it failed (the error is logged).
+
+    Notes:
+    - The load path is chosen by LOAD_MODE, see lambda_handler
+    and load_frame.
+    - With LOAD_STREAM_ROWS set the file is read and loaded in
+    batches of that many rows (see stream_file), otherwise it
+      is read whole.
+    - The table is ANALYZEd afterwards if enough of it changed
+    (see maintain_table).
+    - The download and insert stages emit their metrics (see
+    metrics.stage), streamed files those of every batch inserted.
+    - With LOAD_AUDIT=true the file's lineage is recorded in the
+    load audit table once it is loaded (see audit_load). It is
+      taken from the file as the load path read it, not fetched
+      again.
+    """
+    logger.info(f"📂 Processing file {file_key} from bucket {bucket_name}")
+    # get db_table_name and primary_key
+    table_name, primary_key = table_relations[get_table_name(file_key)]
+    maintain_aggregates(table_name)
+    stream_rows = environ.get("LOAD_STREAM_ROWS")
+    if stream_rows:
+        parquet = open_parquet(s3_client(), bucket_name, file_key)
+        lineage = lineage_of(parquet.metadata.metadata)
+        rows = parquet.metadata.num_rows
+        status = stream_file(
+            file_key,
+            bucket_name,
+            table_name,
+            primary_key,
+            int(stream_rows),
+            parquet,
+        )
+    elif environ.get("LOAD_MODE", "row") == "binary":
+        with stage("loader", "download", table_name) as measured:
+            table = get_table_from_parquet(file_key, bucket_name)
+            measured["rows"] = table.num_rows
+        lineage, rows = lineage_of(table.schema.metadata), table.num_rows
+        logger.info(f"🚀 Binary COPY into table {table_name}")
+        with stage(
+            "loader", "insert", table_name, rows=table.num_rows
+        ) as measured:
+            status = arrow_copy_insertion(table, table_name, primary_key)
+            measured["failed"] = status is None
+    else:
+        # get dataframe
+        with stage("loader", "download", table_name) as measured:
+            df = get_df_from_parquet(file_key, bucket_name)
+            measured["rows"] = len(df)
+        lineage, rows = df.attrs.pop(LINEAGE_ATTR, None), len(df)
+        with stage("loader", "insert", table_name, rows=len(df)) as measured:
+            status = load_frame(df, table_name, primary_key, file_key)
+            measured["failed"] = status is None
+    if status is not None:
+        logger.info(f"✅ Successfully inserted data into {table_name}")
+        if environ.get("LOAD_AUDIT", "false") == "true":
+            audit_load(table_name, file_key, rows, lineage)
+    maintain_table(table_name)
+    return status
+
+
+def audit_load(table_name, file_key, rows, lineage):
+    """
+    Records a loaded file and its lineage in the load audit table,
+    creating the table on first use.
+
+    Parameters:
+    - table_name (str): The name of the database table.
+    - file_key (str): The key of the file loaded.
+    - rows (int): The rows of the file.
+    - lineage (dict | None): The lineage read from the file.
+
+    Notes:
+    - Freshness and stage latencies are computed from the audit
+    table, see lineage.freshness and lineage.stage_latencies.
+    - A failed audit is logged, the load it follows stands.
+    """
+    try:
+        with warm_connection() as con:
+            settings = connection_settings()
+            if settings not in audited_databases:
+                ensure_audit_table(con)
+                audited_databases.add(settings)
+            lineage = record_load(con, table_name, file_key, rows, lineage)
+        logger.info(
+            f"🧾 {file_key}: changed from {lineage.get('first_change')}, "
+            f"extracted at {lineage.get('extracted_at')}, "
+            f"loaded at {lineage['loaded_at']}"
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Audit of {file_key} failed: {str(e)}")
+
+
+def maintain_aggregates(table_name):
+    """
+    Installs the summary tables of a warehouse table before it is
+    loaded, if LOAD_AGGREGATES is "true".
+
+    Parameters:
+    - table_name (str): The name of the database table.
+
+    Notes:
+    - Once installed a summary is kept up to date by triggers on
+    its fact table, within the statements of every load path
+      (see aggregates).
+    - Summaries already found installed cost no round trip.
+    """
+    if environ.get("LOAD_AGGREGATES", "false") != "true":
+        return
+    if installed.issuperset(aggregates_of(table_name)):
+        return
+    with warm_connection() as con:
+        ensure_aggregates(con, table_name)
+
+
+def prepare_partitions(table_name, batch):
+    """
+    Looks up whether a table is partitioned on a date and, if
+    LOAD_DATE_PARTITIONS is "true", creates the partitions a batch
+    is routed to.
+
+    Parameters:
+    - table_name (str): The name of the database table.
+    - batch (DataFrame | pa.Table): The rows about to be loaded.
+
+    Notes:
+    - The partition column is looked up whatever the flag, upserts
+    into a partitioned table must conflict on it too (see
+      conflict_target). The flag only gates creating partitions.
+    - Inserting into the partitioned table routes every row to its
+    partition, the upsert's conflict lookups only search the index
+      of that partition.
+    - Once a table's partition column and the months of a batch are
+    known, nothing is sent to the server.
+    """
+    import pyarrow as pa
+
+    if isinstance(batch, pa.Table):
+        columns = batch.column_names
+    else:
+        columns = list(batch.columns)
+    if table_name not in partition_columns:
+        with warm_connection() as con:
+            partition_column(con, table_name)
+    column = partition_columns[table_name]
+    if environ.get("LOAD_DATE_PARTITIONS", "false") != "true":
+        return
+    if column not in columns:
+        return
+    if not missing_partitions(table_name, batch[column]):
+        return
+    with warm_connection() as con:
+        ensure_partitions(con, table_name, batch[column])
+
+
+def maintain_table(table_name):
+    """
+    ANALYZEs (or VACUUMs) a table after a load once the rows changed
+    since its last maintenance reach a share of its size.
+
+    Parameters:
+    - table_name (str): The name of the database table.
+
+    Notes:
+    - Thresholds and the tables to VACUUM are configured by
+    LOAD_MAINTENANCE_ROWS, LOAD_MAINTENANCE_FRACTION and
+      LOAD_VACUUM_TABLES, see maintenance.maintain.
+    - Below the threshold of a table of known size nothing is sent
+    to the server.
+    - A failed maintenance is logged, the load it follows stands.
+    """
+    if not needs_check(table_name):
+        return
+    try:
+        with warm_connection() as con:
+            maintain(con, table_name)
+    except Exception as e:
+        logger.warning(f"⚠️ Maintenance of {table_name} failed: {str(e)}")
+
+
+def batch_key(file_key, number):
+    """
+    Returns the key the rows of a streamed batch are recorded under,
+    the file's own key for the first batch.
+    """
+    return file_key if number == 0 else f"{file_key[:-4]}-batch-{number}.pqt"
+
+
+def stream_file(
+    file_key, bucket_name, table_name, primary_key, rows, parquet=None
+):
+    """
+    Loads a Parquet file one batch of rows at a time, reading it
+    from S3 one row group at a time.
+
+    Parameters:
+    - file_key (str): The key of a table file.
+    - bucket_name (str): The bucket holding the file.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - rows (int): The most rows per batch.
+    - parquet (pq.ParquetFile | None): The file already opened with
+    parquet_stream.open_parquet, e.g. to read its lineage.
+
+    Returns:
+    - str | None: The status message of the insertion, or None as
+    soon as a batch failed (the error is logged).
+
+    Notes:
+    - Memory is bounded by two batches whatever the file size, the
+    next batch is downloaded and decoded while the current one
+      is written (see parquet_stream.prefetch).
+    - Every batch goes through the load path of LOAD_MODE and
+    commits on its own, batches of LOAD_PARTITION_ROWS rows or
+      more are loaded in concurrent partitions.
+    - Batches are loaded in file order, so a key repeated in a
+    later batch wins as it does within a batch. A file failing
+      part way is retried whole, the upserts are idempotent.
+    - Rejected rows and partition progress of a batch are recorded
+    under batch_key.
+    """
+    import pyarrow as pa
+
+    binary = environ.get("LOAD_MODE", "row") == "binary"
+    batches = iter_batches(s3_client(), bucket_name, file_key, rows, parquet)
+    if not binary:
+        batches = map(to_frame, batches)
+    status = f"{table_name} Loaded ✅️🤘️"
+    for number, batch in enumerate(prefetch(batches)):
+        batch_rows = batch.num_rows if binary else len(batch)
+        with stage(
+            "loader", "insert", table_name, rows=batch_rows
+        ) as measured:
+            if binary:
+                status = arrow_copy_insertion(
+                    pa.Table.from_batches([batch]), table_name, primary_key
+                )
+            else:
+                status = load_frame(
+                    batch, table_name, primary_key, batch_key(file_key, number)
+                )
+            measured["failed"] = status is None
+        if status is None:
+            return None
+    return status
+
+
+def load_frame(df, table_name, primary_key, file_key):
+    """
+    Loads a DataFrame into its warehouse table with the load path
+    chosen by LOAD_MODE.
+
+    Parameters:
+    - df (DataFrame): The rows to load.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - file_key (str): The key of the file the rows come from,
+    rejected rows and partition progress are recorded under it.
+
+    Returns:
+    - str | None: The status message of the insertion, or None
+    if it failed (the error is logged).
+
+    Notes:
+    - Outside of binary mode, frames of LOAD_PARTITION_ROWS rows or
+    more are loaded by partitioned_insertion.
+    - Outside of binary mode, rows the database rejects are
+    quarantined (see quarantine_rows) and the rest still loads.
+    - The partitions the rows are routed to are created first (see
+    prepare_partitions).
+    """
+    load_mode = environ.get("LOAD_MODE", "row")
+    partition_rows = int(
+        environ.get("LOAD_PARTITION_ROWS", DEFAULT_PARTITION_ROWS)
+    )
+    if load_mode == "binary":
+        import pyarrow as pa
+
+        logger.info(f"🚀 Binary COPY into table {table_name}")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        return arrow_copy_insertion(table, table_name, primary_key)
+    prepare_partitions(table_name, df)
+    if len(df) >= partition_rows:
+        logger.info(f"🚀 Loading table {table_name} in partitions")
+        return partitioned_insertion(df, table_name, primary_key, file_key)
+    if load_mode == "copy":
+        logger.info(f"🚀 Bulk loading table {table_name}")
+        return df_copy_insertion(df, table_name, primary_key, file_key)
+    # create query template for specific table fill
+    # with placeholders
+    batch_size = min(get_batch_size(len(df.columns)), max(len(df), 1))
+    sql_query_template = create_query(table_name, primary_key, df, batch_size)
+    # insert
+    logger.info(f"🚀 Executing SQL query on table {table_name}")
+    return df_insertion(
+        sql_query_template,
+        df,
+        table_name,
+        primary_key,
+        batch_size,
+        file_key,
+    )
+
+
+def create_query(table_name, primary_key, df, rows=1):
     """
     Creates an SQL query template for inserting data
     into a specified table.
@@ -91,6 +491,8 @@ def create_query(table_name, primary_key, df):
     - primary_key (str): The name of the primary key column.
     - df (DataFrame): The pandas DataFrame containing
     the data to be inserted.
+    - rows (int): The number of rows the statement inserts,
+    defaults to 1.
 
     Returns:
     - str: An SQL query template for inserting data
@@ -110,28 +512,186 @@ def create_query(table_name, primary_key, df):
     - It assumes that the primary key column is
     specified and that conflicts are resolved
       by updating existing rows.
+    - With rows > 1 the statement has one VALUES tuple per row
+    and the placeholders are suffixed with the row number,
+      e.g. ":id_0", see batch_parameters.
     """
     columns = list(df.columns)
-    placeholders = ", ".join([f":{col}" for col in columns])
-    assignments = ", ".join(
-        [f"{col} = EXCLUDED.{col}" for col in columns if col != primary_key])
+
+    def placeholder(col, row):
+        return f":{col}" if rows == 1 else f":{col}_{row}"
+
+    values = ", ".join(
+        "(" + ", ".join(placeholder(col, row) for col in columns) + ")"
+        for row in range(rows)
+    )
 
     sql_query_template = f"""
     INSERT INTO {table_name} ({', '.join(columns)})
-    VALUES ({placeholders})
-    ON CONFLICT ({primary_key})
-    DO UPDATE SET {assignments};
+    VALUES {values}
+    {conflict_clause(table_name, primary_key, columns)}
+    RETURNING {inserted_flag(table_name)} AS inserted;
     """
-    if table_name == "dim_transaction":
-        sql_query_template = sql_query_template.replace(
-            ":sales_order_id", "nullif(:sales_order_id, -1)"
-        )
-        sql_query_template = sql_query_template.replace(
-            ":purchase_order_id", "nullif(:purchase_order_id, -1)"
-        )
     return sql_query_template
 
 
+def conflict_clause(table_name, primary_key, columns):
+    """
+    Creates the ON CONFLICT clause of the upserts, which only
+    updates rows whose values changed.
+
+    Parameters:
+    - table_name (str): The name of the target table.
+    - primary_key (str): The name of the primary key column.
+    - columns (list): The columns being inserted.
+
+    Returns:
+    - str: The ON CONFLICT ... DO UPDATE ... WHERE clause.
+
+    Notes:
+    - Re-delivered, unchanged rows fail the IS DISTINCT FROM guard,
+    so they write no new tuple and no WAL, and are not returned.
+    - The conflict target is conflict_target's.
+    """
+    target = conflict_target(table_name, primary_key)
+    updated = [col for col in columns if col not in target.split(", ")]
+    if not updated:
+        return f"ON CONFLICT ({target}) DO NOTHING"
+    assignments = ", ".join([f"{col} = EXCLUDED.{col}" for col in updated])
+    current = ", ".join([f"{table_name}.{col}" for col in updated])
+    excluded = ", ".join([f"EXCLUDED.{col}" for col in updated])
+    return (
+        f"ON CONFLICT ({target})\n"
+        f"    DO UPDATE SET {assignments}\n"
+        f"    WHERE ({current}) IS DISTINCT FROM ({excluded})"
+    )
+
+
+def conflict_target(table_name, primary_key):
+    """
+    Returns the columns an upsert into a table conflicts on.
+
+    Notes:
+    - A table partitioned on a date (see date_partitions) is keyed
+    on its primary key and partition column, the partition column
+      of a row never changes once created.
+    - Tables are known to be partitioned once a batch was prepared
+    for them by this process (see prepare_partitions), which every
+      load does before building its statements.
+    """
+    column = partition_columns.get(table_name)
+    return f"{primary_key}, {column}" if column else primary_key
+
+
+def inserted_flag(table_name):
+    """
+    Returns the expression an upsert returns for every row it wrote,
+    true for inserted rows.
+
+    Notes:
+    - System columns cannot be read back through a partitioned
+    table, upserts into one return NULL for inserted and updated
+      rows alike.
+    """
+    return "NULL" if partition_columns.get(table_name) else "(xmax = 0)"
+
+
+def upsert_counts(sent, returned):
+    """
+    Counts the outcome of an upsert from create_query.
+
+    Parameters:
+    - sent (int): The number of rows sent.
+    - returned (list): The rows the statement returned.
+
+    Returns:
+    - Counter: The inserted, updated and unchanged rows.
+
+    Notes:
+    - The statement returns (xmax = 0) for every row it wrote, which
+    is true for inserted rows, rows left unchanged are not returned.
+    - Rows written to a partitioned table return NULL (see
+    inserted_flag) and are counted as written.
+    - Statements without a RETURNING clause return None and are
+    not counted.
+    """
+    if returned is None:
+        return Counter()
+    flags = Counter(row[0] for row in returned)
+    return Counter(
+        inserted=flags[True],
+        updated=flags[False],
+        written=flags[None],
+        unchanged=sent - len(returned),
+    )
+
+
+def log_counts(table_name, counts):
+    """
+    Logs the inserted, updated and unchanged rows of a batch,
+    and the rejected ones if there were any.
+
+    Notes:
+    - The changed rows are recorded for maintain_table.
+    """
+    if not counts:
+        return
+    record_changes(table_name, counts)
+    written = (
+        f", {counts['written']} inserted or updated"
+        if counts["written"]
+        else ""
+    )
+    rejected = (
+        f", {counts['rejected']} rejected" if counts["rejected"] else ""
+    )
+    logger.info(
+        f"📊 {table_name}: {counts['inserted']} inserted, "
+        f"{counts['updated']} updated, {counts['unchanged']} unchanged"
+        f"{written}{rejected}"
+    )
+
+
+def get_batch_size(column_count, requested=None):
+    """
+    Chooses how many rows each multi-row upsert inserts.
+
+    Parameters:
+    - column_count (int): The number of columns of the batch.
+    - requested (int | str): The wanted batch size or "auto",
+    defaults to the LOAD_BATCH_SIZE environment variable.
+
+    Returns:
+    - int: The batch size, capped so a statement stays
+    within MAX_QUERY_PARAMETERS placeholders.
+
+    Notes:
+    - "auto" takes as many rows as fit in AUTO_BATCH_PARAMETERS
+    placeholders, see scripts/bench_upsert.py.
+    """
+    if requested is None:
+        requested = environ.get("LOAD_BATCH_SIZE", "auto")
+    if str(requested) == "auto":
+        requested = AUTO_BATCH_PARAMETERS // column_count
+    limit = MAX_QUERY_PARAMETERS // column_count
+    return max(1, min(int(requested), limit))
+
+
+def batch_parameters(columns, rows):
+    """
+    Builds the parameters of a statement from create_query for
+    the given rows, e.g. {"id_0": 1, "id_1": 2}, a single row
+    keeps the plain column names as its placeholders do.
+    """
+    if len(rows) == 1:
+        return dict(zip(columns, rows[0]))
+    return {
+        f"{col}_{number}": value
+        for number, row in enumerate(rows)
+        for col, value in zip(columns, row)
+    }
+
+
 def get_df_from_parquet(key, bucket_name):
     """
     Reads a Parquet file from an S3 bucket into a DataFrame.
@@ -152,14 +712,17 @@ def get_df_from_parquet(key, bucket_name):
 
     Notes:
     - This function reads a Parquet file located
-    in the specified S3 bucket.
-    - It uses the AWS Data Wrangler library (wr)
-    to read the Parquet file into a DataFrame.
+    in the specified S3 bucket, in one GET.
+    - Columns get the nullable dtypes awswrangler gives them
+    (see parquet_stream.to_frame).
+    - The lineage of the file is kept in df.attrs[LINEAGE_ATTR],
+    so it is not read from S3 a second time.
     - Ensure that appropriate permissions are set
     for accessing the S3 bucket.
     """
-    pqt_object = [f"s3://{bucket_name}/{key}"]
-    df = wr.s3.read_parquet(path=pqt_object)
+    table = get_table_from_parquet(key, bucket_name)
+    df = to_frame(table)
+    df.attrs[LINEAGE_ATTR] = lineage_of(table.schema.metadata)
     return df
 
 
@@ -186,11 +749,19 @@ def get_table_name(key):
     - It extracts the table name by removing the file
     extension and then splitting the key
       by slashes and returning the second element.
+    - Hive-partitioned keys
+    ("table=design/last_updated_date=.../....pqt") take
+      the table name from their "table=" segment instead.
     """
+    for segment in key.split("/"):
+        if segment.startswith("table="):
+            return segment[len("table="):]
     return key[:-4].split("/")[1]
 
 
-def df_insertion(query, df, table_name):
+def df_insertion(
+    query, df, table_name, primary_key=None, batch_size=1, file_key=None
+):
     """
     Inserts data from a DataFrame into a PostgreSQL database
     table using the provided query.
@@ -201,6 +772,13 @@ def df_insertion(query, df, table_name):
     - df (DataFrame): The pandas DataFrame containing the
     data to be inserted.
     - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column,
+    needed when batch_size > 1.
+    - batch_size (int): The number of rows the query inserts,
+    defaults to 1.
+    - file_key (str): The key of the file being loaded, if given
+    rows the database rejects are quarantined under it instead of
+    failing the whole batch.
 
     Returns:
     - str: A status message indicating the success of the data
@@ -219,32 +797,882 @@ def df_insertion(query, df, table_name):
     - It uses environment variables to retrieve connection
     parameters for accessing the PostgreSQL
       database.
-    - The data insertion process is performed row by row
-    using the prepared statement.
-    """
-    try:
-        username = environ.get("PGUSER2", "testing")
-        password = environ.get("PGPASSWORD2", "testing")
-        host = environ.get("PGHOST2", "testing")
-        port = environ.get("PGPORT2", "5432")
-        database = environ.get("PGDATABASE2")
-        if table_name == "dim_transaction":
-            df = df.replace({np.nan: -1})
-            df = df.astype(
-                {col: "int64" for col in df.select_dtypes("float64").columns}
-            )
-        with pg.Connection(
-            username,
-            password=password,
-            host=host,
-            port=port,
-            database=database,
-        ) as con:
-            ps = con.prepare(query)
-            for _, row in df.iterrows():
-                logger.info(str(row.to_dict()))
-                ps.run(**row.to_dict())
+    - Rows are sent in statements of batch_size rows by
+    upsert_batches. Only without a file_key (nowhere to quarantine
+      to) and with batch_size 1 is the data inserted row by row
+      using the prepared statement, the first bad row failing it.
+    - The inserted, updated and unchanged rows are logged.
+    - The connection and its prepared statements are reused by the
+    next load (see warm_connection).
+    """
+    try:
+        with warm_connection() as con:
+            if batch_size > 1 or file_key is not None:
+                rejected = None if file_key is None else []
+                counts = upsert_batches(
+                    con,
+                    query,
+                    df,
+                    table_name,
+                    primary_key,
+                    batch_size,
+                    rejected,
+                )
+                if rejected:
+                    quarantine_rows(file_key, list(df.columns), rejected)
+            else:
+                counts = Counter()
+                ps = prepared(
+                    con, statement_cache(con, table_name), df.columns, query
+                )
+                for _, row in nulls_as_none(df).iterrows():
+                    logger.info(str(row.to_dict()))
+                    counts.update(upsert_counts(1, ps.run(**row.to_dict())))
             #
+        log_counts(table_name, counts)
+        return f"{table_name} Loaded ✅️🤘️"
+    except Exception as e:
+        logger.error(f"❗ Failed to insert data into {table_name}: {str(e)}")
+
+
+def upsert_batches(
+    con, query, df, table_name, primary_key, batch_size, rejected=None
+):
+    """
+    Upserts a DataFrame in multi-row statements, in one transaction.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - query (str): A create_query template for batch_size rows.
+    - df (DataFrame): The data to be inserted.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - batch_size (int): The number of rows the query inserts.
+    - rejected (list): If given, rows the database rejects are
+    appended to it as (row, error) pairs instead of failing
+    the load.
+
+    Returns:
+    - Counter: The inserted, updated and unchanged rows, and the
+    rejected ones.
+
+    Notes:
+    - One statement cannot update the same row twice, so rows
+    repeating a primary key are reduced to the last one first,
+      as the row by row load would have left it.
+    - A final, shorter batch gets a statement of its own. Statements
+    come from the connection's statement_cache, so loads of the same
+      table and columns on a warm connection prepare nothing.
+    - The transaction is rolled back on any error. With `rejected`
+    the load is then redone by isolate_rows, which bisects the
+      failing batches under savepoints, so loads without bad rows
+      pay nothing for it.
+    """
+    df = df.drop_duplicates(subset=[primary_key], keep="last")
+    columns = list(df.columns)
+    rows = list(nulls_as_none(df).itertuples(index=False, name=None))
+    batches = [
+        rows[start:start + batch_size]
+        for start in range(0, len(rows), batch_size)
+    ]
+    cache = statement_cache(con, table_name)
+
+    def statement(rows):
+        if rows != batch_size:
+            query_rows = create_query(table_name, primary_key, df, rows)
+        else:
+            query_rows = query
+        return prepared(con, cache, columns, query_rows)
+
+    counts = Counter()
+    con.run("START TRANSACTION")
+    try:
+        for batch in batches:
+            returned = statement(len(batch)).run(
+                **batch_parameters(columns, batch)
+            )
+            counts.update(upsert_counts(len(batch), returned))
+        con.run("COMMIT")
+        return counts
+    except Exception as e:
+        con.run("ROLLBACK")
+        if rejected is None or not isinstance(e, pg.DatabaseError):
+            raise
+        logger.warning(f"⚠️ {table_name} rejected a row, isolating: {e}")
+
+    counts = Counter()
+    con.run("START TRANSACTION")
+    try:
+        for batch in batches:
+            counts.update(
+                isolate_rows(con, statement, columns, batch, rejected)
+            )
+        con.run("COMMIT")
+    except Exception:
+        con.run("ROLLBACK")
+        raise
+    return counts
+
+
+def isolate_rows(con, statement, columns, rows, rejected):
+    """
+    Upserts rows under a savepoint, bisecting them on failure
+    until the rows the database rejects are found.
+
+    Parameters:
+    - con (pg.Connection): A connection inside a transaction.
+    - statement (callable): statement(n) returns the prepared
+    upsert of n rows.
+    - columns (list): The column names of the rows.
+    - rows (list): The row tuples to upsert.
+    - rejected (list): Collects the (row, error) pairs.
+
+    Returns:
+    - Counter: The inserted, updated, unchanged and rejected rows.
+
+    Notes:
+    - A batch with one bad row costs about 2 * log2(len(rows))
+    statements, the good rows around it still commit.
+    """
+    con.run("SAVEPOINT isolate")
+    try:
+        returned = statement(len(rows)).run(
+            **batch_parameters(columns, rows)
+        )
+    except pg.DatabaseError as e:
+        con.run("ROLLBACK TO SAVEPOINT isolate")
+        con.run("RELEASE SAVEPOINT isolate")
+        if len(rows) == 1:
+            rejected.append((rows[0], str(e)))
+            return Counter(rejected=1)
+        middle = len(rows) // 2
+        counts = isolate_rows(con, statement, columns, rows[:middle], rejected)
+        counts.update(
+            isolate_rows(con, statement, columns, rows[middle:], rejected)
+        )
+        return counts
+    con.run("RELEASE SAVEPOINT isolate")
+    return upsert_counts(len(rows), returned)
+
+
+def quarantine_key(file_key):
+    """Returns the key rejected rows of a file are quarantined under."""
+    return f"{LOAD_QUARANTINE_PREFIX}/{file_key}"
+
+
+def quarantine_rows(key, columns, rejected):
+    """
+    Writes the rows the database rejected to the control bucket
+    as Parquet, with their error in a 'load_error' column.
+
+    Parameters:
+    - key (str): The key to write, see quarantine_key.
+    - columns (list): The column names of the rows.
+    - rejected (list): The (row, error) pairs.
+
+    Returns:
+    - None
+    """
+    import pandas as pd
+
+    bad = pd.DataFrame([row for row, _ in rejected], columns=columns)
+    bad["load_error"] = [error for _, error in rejected]
+    buffer = BytesIO()
+    bad.to_parquet(buffer)
+    s3_client().put_object(
+        Bucket=environ.get("S3_CONTROL_BUCKET", "control_bucket"),
+        Key=quarantine_key(key),
+        Body=buffer.getvalue(),
+    )
+    logger.warning(f"☣️ Quarantined {len(bad)} rejected rows of {key}")
+
+
+def isolating_upsert(con, df, table_name, primary_key, key):
+    """
+    Upserts a DataFrame in multi-row statements, quarantining
+    the rows the database rejects under `key`.
+
+    Returns:
+    - Counter: The inserted, updated, unchanged and rejected rows.
+    """
+    batch_size = min(get_batch_size(len(df.columns)), max(len(df), 1))
+    query = create_query(table_name, primary_key, df, batch_size)
+    rejected = []
+    counts = upsert_batches(
+        con, query, df, table_name, primary_key, batch_size, rejected
+    )
+    if rejected:
+        quarantine_rows(key, list(df.columns), rejected)
+    return counts
+
+
+def connection_settings():
+    """
+    Returns the warehouse connection settings from the PGUSER2,
+    PGPASSWORD2, PGHOST2, PGPORT2 and PGDATABASE2 environment
+    variables, as (user, password, host, port, database).
+    """
+    return (
+        environ.get("PGUSER2", "testing"),
+        environ.get("PGPASSWORD2", "testing"),
+        environ.get("PGHOST2", "testing"),
+        environ.get("PGPORT2", "5432"),
+        environ.get("PGDATABASE2"),
+    )
+
+
+def get_connection():
+    """
+    Opens a connection to the warehouse database.
+
+    Returns:
+    - pg.Connection: A connection built from connection_settings.
+
+    Notes:
+    - The socket is opened with TCP_NODELAY. A multi-row statement
+    spans several TCP segments and, with Nagle's algorithm on,
+      every one of them waited out the server's delayed ACK (~40ms).
+    """
+    user, password, host, port, database = connection_settings()
+    sock = socket.create_connection((host, int(port)))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return pg.Connection(
+        user,
+        password=password,
+        host=host,
+        port=port,
+        database=database,
+        sock=sock,
+    )
+
+
+def take_idle_connection(settings):
+    """Removes and returns an idle connection, or None if there is none."""
+    with connection_lock:
+        idle = idle_connections.get(settings)
+        return idle.pop() if idle else None
+
+
+def is_alive(con):
+    """Checks an idle connection still reaches the server."""
+    try:
+        con.run("SELECT 1")
+        return True
+    except Exception:
+        return False
+
+
+def discard_connection(con):
+    """Closes a connection and forgets the statements prepared on it."""
+    statement_caches.pop(con, None)
+    try:
+        con.close()
+    except Exception:
+        pass
+
+
+@contextmanager
+def warm_connection():
+    """
+    Lends a warehouse connection kept open between invocations.
+
+    Returns:
+    - contextmanager: Yields a pg.Connection, returned to the idle
+    pool on exit.
+
+    Example:
+    ```
+    with warm_connection() as con:
+        con.run("SELECT 1")
+    ```
+
+    Notes:
+    - A Lambda container is reused while warm, so its loads skip the
+    connection handshake and keep their prepared statements
+      (see statement_cache).
+    - Idle connections are checked with a round trip before being
+    lent, one the server dropped is replaced.
+    - A connection whose block raised is closed instead of kept,
+    its transaction state is unknown.
+    - At most LOAD_IDLE_CONNECTIONS (DEFAULT_IDLE_CONNECTIONS unless
+    set) are kept, each one used by a single thread at a time.
+    """
+    settings = connection_settings()
+    con = take_idle_connection(settings)
+    while con is not None and not is_alive(con):
+        discard_connection(con)
+        con = take_idle_connection(settings)
+    if con is None:
+        con = get_connection()
+    try:
+        yield con
+    except Exception:
+        discard_connection(con)
+        raise
+    limit = int(
+        environ.get("LOAD_IDLE_CONNECTIONS", DEFAULT_IDLE_CONNECTIONS)
+    )
+    with connection_lock:
+        idle = idle_connections.setdefault(settings, [])
+        if len(idle) < limit:
+            idle.append(con)
+            return
+    discard_connection(con)
+
+
+def statement_cache(con, table_name):
+    """
+    Returns the statements prepared for a table on a connection.
+
+    Parameters:
+    - con (pg.Connection): A connection lent by warm_connection.
+    - table_name (str): The table the statements write to.
+
+    Returns:
+    - dict: {(column names, query): pg.PreparedStatement}, to be
+    filled through prepared.
+
+    Notes:
+    - The table's schema fingerprint is read every call, one catalog
+    query per load. When the table was altered, or dropped and
+      recreated, since the statements were prepared they are closed
+      and the cache starts empty.
+    """
+    fingerprint = con.run(SCHEMA_FINGERPRINT_QUERY, table_name=table_name)
+    fingerprint = fingerprint[0][0] if fingerprint else None
+    tables = statement_caches.setdefault(con, {})
+    cached = tables.get(table_name)
+    if cached is None or cached[0] != fingerprint:
+        if cached is not None:
+            logger.info(f"♻️ {table_name} changed, re-preparing statements")
+            for ps in cached[1].values():
+                ps.close()
+        cached = tables[table_name] = (fingerprint, {})
+    return cached[1]
+
+
+def prepared(con, cache, columns, query):
+    """
+    Returns the prepared statement of a query, preparing it on
+    the first use.
+
+    Parameters:
+    - con (pg.Connection): The connection of the cache.
+    - cache (dict): The table's statement_cache.
+    - columns (iterable): The column names the query binds.
+    - query (str): The statement text.
+
+    Returns:
+    - pg.PreparedStatement: The cached statement.
+
+    Notes:
+    - Past MAX_CACHED_STATEMENTS the oldest statement is closed,
+    remainder batches of every size would otherwise pile up.
+    """
+    key = (tuple(columns), query)
+    if key not in cache:
+        if len(cache) >= MAX_CACHED_STATEMENTS:
+            cache.pop(next(iter(cache))).close()
+        cache[key] = con.prepare(query)
+    return cache[key]
+
+
+def nulls_as_none(df):
+    """
+    Returns df with the missing values of its nullable columns
+    (pandas extension dtypes such as Int64) as None, which pg8000
+    sends as NULL. Only columns holding missing values are converted.
+    """
+    import pandas as pd
+
+    nullable = {
+        col: df[col].astype(object).where(df[col].notna(), None)
+        for col in df.columns
+        if isinstance(df[col].dtype, pd.api.extensions.ExtensionDtype)
+        and df[col].hasnans
+    }
+    return df.assign(**nullable) if nullable else df
+
+
+def create_merge_query(table_name, primary_key, columns, staging_table):
+    """
+    Creates the set-based upsert moving a staged batch into
+    its target table.
+
+    Parameters:
+    - table_name (str): The name of the target table.
+    - primary_key (str): The name of the primary key column.
+    - columns (list): The columns loaded into the staging table.
+    - staging_table (str): The name of the staging table, or an
+    aliased subquery over it.
+
+    Returns:
+    - str: An INSERT ... SELECT ... ON CONFLICT DO UPDATE query
+    returning one row with the inserted, updated and unchanged
+    row counts.
+
+    Example:
+    ```
+    query = create_merge_query("dim_design", "design_record_id",
+    ["design_record_id", "design_name"], "staging_dim_design")
+    ```
+
+    Notes:
+    - Rows are counted on the server, only the counts are returned.
+    - Rows written to a partitioned table cannot be told apart (see
+    inserted_flag), the staged keys missing from the target are
+      counted as inserted instead. Every part of the query reads
+      the target as it was before the upsert.
+    """
+    if partition_columns.get(table_name):
+        keys = conflict_target(table_name, primary_key).split(", ")
+        matched = " AND ".join(f"existing.{k} = staged.{k}" for k in keys)
+        inserted = f"""(SELECT count(*) FROM (SELECT * FROM {staging_table})
+    AS staged WHERE NOT EXISTS (
+        SELECT 1 FROM {table_name} AS existing WHERE {matched}
+    ))"""
+        return f"""
+    WITH upserted AS (
+    INSERT INTO {table_name} ({', '.join(columns)})
+    SELECT {', '.join(columns)} FROM {staging_table}
+    {conflict_clause(table_name, primary_key, columns)}
+    RETURNING NULL
+    ), missing AS ({inserted})
+    SELECT (SELECT * FROM missing),
+    count(*) - (SELECT * FROM missing),
+    (SELECT count(*) FROM {staging_table}) - count(*)
+    FROM upserted;
+    """
+    return f"""
+    WITH upserted AS (
+    INSERT INTO {table_name} ({', '.join(columns)})
+    SELECT {', '.join(columns)} FROM {staging_table}
+    {conflict_clause(table_name, primary_key, columns)}
+    RETURNING (xmax = 0) AS inserted
+    )
+    SELECT count(*) FILTER (WHERE inserted),
+    count(*) FILTER (WHERE NOT inserted),
+    (SELECT count(*) FROM {staging_table}) - count(*)
+    FROM upserted;
+    """
+
+
+def df_to_csv(df):
+    """
+    Writes a DataFrame as headerless CSV for COPY, with
+    missing values written as \\N.
+    """
+    buffer = StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+    buffer.seek(0)
+    return buffer
+
+
+def stage_and_merge(con, table_name, primary_key, columns, copy_format,
+                    stream):
+    """
+    COPYs a batch into a temporary staging table and upserts it into
+    its target with a single query, in one transaction.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - columns (list): The columns of the batch, in stream order.
+    - copy_format (str): The COPY options, e.g. "FORMAT binary".
+    - stream: The COPY data, a file object or an iterable of bytes.
+
+    Returns:
+    - Counter: The inserted, updated and unchanged rows.
+
+    Notes:
+    - The staging table is created LIKE the target and dropped
+    on commit, the transaction is rolled back on any error.
+    """
+    staging_table = f"staging_{table_name}"
+    con.run("START TRANSACTION")
+    try:
+        con.run(
+            f"CREATE TEMPORARY TABLE {staging_table} "
+            f"(LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        con.run(
+            f"COPY {staging_table} ({', '.join(columns)}) "
+            f"FROM STDIN WITH ({copy_format})",
+            stream=stream,
+        )
+        [[inserted, updated, unchanged]] = con.run(
+            create_merge_query(table_name, primary_key, columns, staging_table)
+        )
+        con.run("COMMIT")
+    except Exception:
+        con.run("ROLLBACK")
+        raise
+    return Counter(inserted=inserted, updated=updated, unchanged=unchanged)
+
+
+def copy_or_isolate(con, df, table_name, primary_key, key=None):
+    """
+    Loads a DataFrame with the staged CSV merge, falling back to
+    isolating_upsert when the database rejects the batch and
+    a quarantine key is given.
+
+    Returns:
+    - Counter: The inserted, updated, unchanged and rejected rows.
+    """
+    try:
+        return stage_and_merge(
+            con,
+            table_name,
+            primary_key,
+            list(df.columns),
+            f"FORMAT csv, NULL '{COPY_NULL}'",
+            df_to_csv(df),
+        )
+    except pg.DatabaseError as e:
+        if key is None:
+            raise
+        logger.warning(f"⚠️ {table_name} merge failed, isolating: {e}")
+        return isolating_upsert(con, df, table_name, primary_key, key)
+
+
+def df_copy_insertion(df, table_name, primary_key, file_key=None):
+    """
+    Bulk loads a DataFrame by COPYing it into a temporary staging
+    table and upserting it into the target with a single query.
+
+    Parameters:
+    - df (DataFrame): The pandas DataFrame containing the
+    data to be inserted.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - file_key (str): The key of the file being loaded, if given
+    a batch the merge fails on is upserted again by
+    isolating_upsert, quarantining its bad rows under it.
+
+    Returns:
+    - str: A status message indicating the success of the data
+    insertion process.
+
+    Example:
+    ```
+    status_message = df_copy_insertion(my_dataframe,
+    "dim_design", "design_record_id")
+    ```
+
+    Notes:
+    - The batch is sent as CSV, see stage_and_merge.
+    - Rows repeating a primary key are reduced to the last one
+    first, as the row by row load would have left it.
+    """
+    try:
+        df = df.drop_duplicates(subset=[primary_key], keep="last")
+        with warm_connection() as con:
+            counts = copy_or_isolate(
+                con, df, table_name, primary_key, file_key
+            )
+        log_counts(table_name, counts)
+        return f"{table_name} Loaded ✅️🤘️"
+    except Exception as e:
+        logger.error(f"❗ Failed to insert data into {table_name}: {str(e)}")
+
+
+def get_table_from_parquet(key, bucket_name):
+    """
+    Reads a Parquet file from an S3 bucket into an Arrow table,
+    without going through pandas.
+
+    Parameters:
+    - key (str): The key (path) of the Parquet file
+    in the S3 bucket.
+    - bucket_name (str): The name of the S3 bucket.
+
+    Returns:
+    - pa.Table: The contents of the Parquet file.
+    """
+    import pyarrow.parquet as pq
+
+    body = s3_client().get_object(Bucket=bucket_name, Key=key)["Body"].read()
+    return pq.read_table(BytesIO(body))
+
+
+def deduplicate_keys(table, primary_key):
+    """
+    Keeps the last row of every primary key of an Arrow table,
+    in their original order.
+    """
+    import numpy as np
+
+    keys = table.column(primary_key).to_numpy()
+    _, last = np.unique(keys[::-1], return_index=True)
+    if len(last) == table.num_rows:
+        return table
+    return table.take(np.sort(table.num_rows - 1 - last))
+
+
+def arrow_copy_insertion(table, table_name, primary_key):
+    """
+    Bulk loads an Arrow table through a staging table using
+    PostgreSQL's binary COPY format.
+
+    Parameters:
+    - table (pa.Table): The batch to insert.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+
+    Returns:
+    - str: A status message indicating the success of the data
+    insertion process.
+
+    Example:
+    ```
+    status_message = arrow_copy_insertion(my_table,
+    "dim_design", "design_record_id")
+    ```
+
+    Notes:
+    - Columns are cast to the types of the target columns and
+    encoded straight from their Arrow buffers (see pg_binary_copy),
+    the encoded chunks are streamed to the server as they are built.
+    - Nulls are written from the Arrow validity bitmaps.
+    """
+    from pg_binary_copy import (
+        cast_to_column_types,
+        get_column_types,
+        iter_copy_chunks,
+    )
+
+    try:
+        table = deduplicate_keys(table, primary_key)
+        prepare_partitions(table_name, table)
+        with warm_connection() as con:
+            table = cast_to_column_types(
+                table, get_column_types(con, table_name)
+            )
+            counts = stage_and_merge(
+                con,
+                table_name,
+                primary_key,
+                table.column_names,
+                "FORMAT binary",
+                iter_copy_chunks(table),
+            )
+        log_counts(table_name, counts)
+        return f"{table_name} Loaded ✅️🤘️"
+    except Exception as e:
+        logger.error(f"❗ Failed to insert data into {table_name}: {str(e)}")
+
+
+def partition_frame(df, primary_key, partitions):
+    """
+    Splits a DataFrame into disjoint partitions by a hash of
+    its primary key.
+
+    Parameters:
+    - df (DataFrame): The batch to split.
+    - primary_key (str): The name of the primary key column.
+    - partitions (int): The number of partitions.
+
+    Returns:
+    - list: One DataFrame per partition, the same key always
+    falls into the same partition.
+    """
+    import numpy as np
+    from pandas.util import hash_array
+
+    numbers = hash_array(df[primary_key].to_numpy()) % np.uint64(partitions)
+    return [df[numbers == number] for number in range(partitions)]
+
+
+def load_partition(df, table_name, primary_key, load_mode, key):
+    """
+    Upserts one partition on its own connection, in one transaction.
+
+    Parameters:
+    - df (DataFrame): The partition.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - load_mode (str): The LOAD_MODE of the load.
+    - key (str): The key the partition's rejected rows are
+    quarantined under.
+
+    Returns:
+    - Counter: The inserted, updated, unchanged and rejected rows.
+
+    Notes:
+    - LOAD_MODE=copy stages the partition with CSV COPY, any other
+    mode sends multi-row upserts.
+    """
+    with warm_connection() as con:
+        if load_mode == "copy":
+            return copy_or_isolate(con, df, table_name, primary_key, key)
+        return isolating_upsert(con, df, table_name, primary_key, key)
+
+
+def progress_key(file_key):
+    """Returns the key of the partition progress of a file."""
+    return f"{PROGRESS_PREFIX}/{file_key}.json"
+
+
+def get_progress(client, bucket, file_key, partitions):
+    """
+    Reads which partitions of a file have already been loaded.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The control bucket.
+    - file_key (str): The key of the file being loaded.
+    - partitions (int): The number of partitions of this load.
+
+    Returns:
+    - set: The loaded partition numbers, empty if the file has no
+    progress or was split differently before.
+    """
+    try:
+        body = client.get_object(
+            Bucket=bucket, Key=progress_key(file_key)
+        )["Body"].read()
+    except client.exceptions.NoSuchKey:
+        return set()
+    progress = json.loads(body)
+    if progress.get("complete"):
+        # loaded whole before, a new load of it starts over
+        return set()
+    if progress["partitions"] != partitions:
+        logger.warning(f"⚠️ {file_key} was split differently, reloading")
+        return set()
+    return set(progress["loaded"])
+
+
+def save_progress(client, bucket, file_key, partitions, loaded,
+                  complete=False):
+    """
+    Writes the loaded partitions of a file to the control bucket,
+    marked complete once all of them are.
+
+    Notes:
+    - A complete record is overwritten rather than deleted, the
+    lambdas' role may not delete objects (see Terraform/iam.tf).
+    """
+    progress = {"partitions": partitions, "loaded": sorted(loaded)}
+    if complete:
+        progress["complete"] = True
+    client.put_object(
+        Bucket=bucket,
+        Key=progress_key(file_key),
+        Body=json.dumps(progress),
+    )
+
+
+def partitioned_insertion(
+    df,
+    table_name,
+    primary_key,
+    file_key,
+    partitions=None,
+    workers=None,
+    retries=None,
+):
+    """
+    Upserts a large DataFrame as disjoint partitions loaded
+    concurrently, each in its own transaction.
+
+    Parameters:
+    - df (DataFrame): The pandas DataFrame containing the
+    data to be inserted.
+    - table_name (str): The name of the database table.
+    - primary_key (str): The name of the primary key column.
+    - file_key (str): The key of the file being loaded, which
+    its progress is recorded under.
+    - partitions (int): Defaults to $LOAD_PARTITIONS or
+    DEFAULT_PARTITIONS.
+    - workers (int): The most connections open at once, defaults
+    to $LOAD_CONNECTIONS or DEFAULT_LOAD_CONNECTIONS.
+    - retries (int): How many more times failed partitions are
+    tried, defaults to $LOAD_PARTITION_RETRIES or
+    DEFAULT_PARTITION_RETRIES.
+
+    Returns:
+    - str: A status message indicating the success of the data
+    insertion process, None if a partition could not be loaded.
+
+    Example:
+    ```
+    status_message = partitioned_insertion(my_dataframe,
+    "fact_sales_order", "sales_record_id", file_key)
+    ```
+
+    Notes:
+    - Partitions are split by a hash of the primary key (see
+    partition_frame), so they never touch the same rows.
+    - The rejected rows of partition n are quarantined under
+    "{file_key without .pqt}-{n}.pqt", see quarantine_key.
+    - Every loaded partition is recorded in the control bucket
+    ($S3_CONTROL_BUCKET) under "load_progress/{file_key}.json".
+    Loading the file again only redoes the partitions missing from
+    it, the record is marked complete once every partition has
+      loaded and a later load of the file starts over.
+    """
+    partitions = partitions or int(
+        environ.get("LOAD_PARTITIONS", DEFAULT_PARTITIONS)
+    )
+    workers = workers or int(
+        environ.get("LOAD_CONNECTIONS", DEFAULT_LOAD_CONNECTIONS)
+    )
+    if retries is None:
+        retries = int(
+            environ.get("LOAD_PARTITION_RETRIES", DEFAULT_PARTITION_RETRIES)
+        )
+    bucket = environ.get("S3_CONTROL_BUCKET", "control_bucket")
+    load_mode = environ.get("LOAD_MODE", "row")
+    try:
+        df = df.drop_duplicates(subset=[primary_key], keep="last")
+        parts = partition_frame(df, primary_key, partitions)
+        loaded = get_progress(s3_client(), bucket, file_key, partitions)
+        todo = [number for number in range(partitions) if number not in loaded]
+        counts = Counter()
+        for attempt in range(retries + 1):
+            if not todo:
+                break
+            failed = []
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(
+                        load_partition,
+                        parts[number],
+                        table_name,
+                        primary_key,
+                        load_mode,
+                        f"{file_key[:-4]}-{number}.pqt",
+                    ): number
+                    for number in todo
+                }
+                for future in as_completed(futures):
+                    number = futures[future]
+                    try:
+                        counts.update(future.result())
+                    except Exception as e:
+                        logger.warning(
+                            f"⚠️ Partition {number} of {table_name} "
+                            f"failed (attempt {attempt + 1}): {str(e)}"
+                        )
+                        failed.append(number)
+                        continue
+                    loaded.add(number)
+                    save_progress(
+                        s3_client(), bucket, file_key, partitions, loaded
+                    )
+            todo = sorted(failed)
+        if todo:
+            logger.error(
+                f"❗ Failed to insert partitions {todo} into {table_name}"
+            )
+            return None
+        save_progress(
+            s3_client(), bucket, file_key, partitions, loaded, complete=True
+        )
+        log_counts(table_name, counts)
         return f"{table_name} Loaded ✅️🤘️"
     except Exception as e:
         logger.error(f"❗ Failed to insert data into {table_name}: {str(e)}")
@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+from collections import Counter
+from os import environ
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# a table is maintained once the rows changed since its last
+# maintenance reach DEFAULT_MAINTENANCE_ROWS plus this fraction of
+# its rows, the shape of autovacuum's own threshold
+DEFAULT_MAINTENANCE_FRACTION = 0.1
+DEFAULT_MAINTENANCE_ROWS = 1000
+
+# {table: rows changed by this process since its last maintenance}
+changed_rows = Counter()
+# {table: estimated rows, as of its last maintenance}
+table_rows = {}
+changes_lock = threading.Lock()
+
+
+def record_changes(table_name, counts):
+    """
+    Adds the rows a load inserted or updated to the changes of
+    a table.
+
+    Parameters:
+    - table_name (str): The name of the database table.
+    - counts (Counter): The counts of the load, see
+    loader.upsert_counts.
+    """
+    changed = counts["inserted"] + counts["updated"] + counts["written"]
+    if changed:
+        with changes_lock:
+            changed_rows[table_name] += changed
+
+
+def forget_changes(table_name):
+    """
+    Clears the changes of a table maintained by other means, e.g.
+    ANALYZEd at the end of a bulk load.
+    """
+    with changes_lock:
+        changed_rows.pop(table_name, None)
+        table_rows.pop(table_name, None)
+
+
+def maintenance_threshold(rows):
+    """
+    Returns the changed rows a table of `rows` rows is maintained
+    after, from LOAD_MAINTENANCE_ROWS and LOAD_MAINTENANCE_FRACTION.
+    """
+    base = int(environ.get("LOAD_MAINTENANCE_ROWS", DEFAULT_MAINTENANCE_ROWS))
+    fraction = float(
+        environ.get("LOAD_MAINTENANCE_FRACTION", DEFAULT_MAINTENANCE_FRACTION)
+    )
+    return base + int(fraction * rows)
+
+
+def vacuumed_tables():
+    """
+    Returns the tables VACUUMed as well as ANALYZEd, listed comma
+    separated in LOAD_VACUUM_TABLES ("*" for all of them).
+    """
+    listed = environ.get("LOAD_VACUUM_TABLES", "")
+    return {name.strip() for name in listed.split(",") if name.strip()}
+
+
+def get_table_rows(con, table_name):
+    """
+    Reads the planner's estimate of a table's rows, summed over its
+    partitions if it is partitioned.
+    """
+    [[rows]] = con.run(
+        """
+        SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0)
+        FROM pg_class
+        WHERE oid = to_regclass(:table_name) OR oid IN (
+            SELECT inhrelid FROM pg_inherits
+            WHERE inhparent = to_regclass(:table_name)
+        );
+        """,
+        table_name=table_name,
+    )
+    return int(rows)
+
+
+def needs_check(table_name):
+    """
+    Tells whether a table may be due for maintenance, without a
+    round trip.
+
+    Returns:
+    - bool: False if it changed less than its threshold as of its
+    last known size, True if it reached it or its size is unknown.
+    """
+    with changes_lock:
+        changed = changed_rows[table_name]
+        rows = table_rows.get(table_name)
+    if not changed:
+        return False
+    if rows is None:
+        return True
+    threshold = maintenance_threshold(rows)
+    if changed < threshold:
+        logger.info(
+            f"🧹 {table_name}: {changed} rows changed of ~{rows}, "
+            f"maintenance deferred until {threshold}"
+        )
+        return False
+    return True
+
+
+def maintain(con, table_name):
+    """
+    ANALYZEs a table, or VACUUMs and ANALYZEs it if listed in
+    LOAD_VACUUM_TABLES, once enough of it changed.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection outside of a
+    transaction, VACUUM cannot run in one.
+    - table_name (str): The name of the database table.
+
+    Returns:
+    - str | None: The statement run, or None if the table is below
+    its threshold.
+
+    Notes:
+    - The threshold is maintenance_threshold of the table's rows as
+    estimated by the planner, re-read after every maintenance.
+    - Changes are counted per process, a cold start begins from
+    zero and leaves earlier changes to autovacuum.
+    - Every decision is logged.
+    """
+    with changes_lock:
+        changed = changed_rows[table_name]
+    rows = table_rows.get(table_name)
+    if rows is None:
+        rows = table_rows[table_name] = get_table_rows(con, table_name)
+    threshold = maintenance_threshold(rows)
+    if changed < threshold:
+        logger.info(
+            f"🧹 {table_name}: {changed} rows changed of ~{rows}, "
+            f"maintenance deferred until {threshold}"
+        )
+        return None
+    vacuumed = vacuumed_tables()
+    if "*" in vacuumed or table_name in vacuumed:
+        statement = "VACUUM (ANALYZE)"
+    else:
+        statement = "ANALYZE"
+    logger.info(
+        f"🧹 {table_name}: {changed} rows changed of ~{rows}, "
+        f"threshold {threshold} reached, running {statement}"
+    )
+    start = time.perf_counter()
+    con.run(f"{statement} {table_name}")
+    with changes_lock:
+        changed_rows[table_name] -= changed
+    table_rows[table_name] = get_table_rows(con, table_name)
+    logger.info(
+        f"🧹 {table_name}: {statement} took "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+    return statement
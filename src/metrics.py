@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from os import environ
+
+DEFAULT_NAMESPACE = "Totesys"
+# every metric is published per (Service, Stage, Table)
+DIMENSIONS = ["Service", "Stage", "Table"]
+UNITS = {
+    "Duration": "Milliseconds",
+    "Rows": "Count",
+    "Bytes": "Bytes",
+    "RowsPerSecond": "Count/Second",
+    "Errors": "Count",
+}
+
+sink_lock = threading.Lock()
+
+
+def print_document(document):
+    """
+    Writes an EMF document to stdout, one line per document. In
+    Lambda stdout goes to CloudWatch Logs, which extracts the
+    metrics without any API call.
+    """
+    line = json.dumps(document, separators=(",", ":"))
+    with sink_lock:
+        print(line, flush=True)
+
+
+# receives every document emitted, see captured_metrics
+sink = print_document
+
+
+def emf_document(service, stage, table, seconds, rows=None, size=None,
+                 failed=False):
+    """
+    Builds the CloudWatch Embedded Metric Format document of one
+    stage of one table.
+
+    Parameters:
+    - service (str): The lambda, e.g. "loader".
+    - stage (str): The stage, e.g. "insert".
+    - table (str): The table the stage worked on.
+    - seconds (float): How long the stage took.
+    - rows (int): The rows it processed, if known.
+    - size (int): The bytes it moved, if known.
+    - failed (bool): Whether it failed.
+
+    Returns:
+    - dict: The document, with Duration, Errors and, when known,
+    Rows, RowsPerSecond and Bytes as metrics.
+
+    Example:
+    ```
+    emf_document("loader", "insert", "dim_design", 0.5, rows=100)
+    # {"_aws": {...}, "Service": "loader", "Stage": "insert",
+    #  "Table": "dim_design", "Duration": 500.0, "Errors": 0,
+    #  "Rows": 100, "RowsPerSecond": 200.0}
+    ```
+    """
+    values = {"Duration": seconds * 1000, "Errors": int(failed)}
+    if rows is not None:
+        values["Rows"] = rows
+        if seconds > 0 and not failed:
+            values["RowsPerSecond"] = rows / seconds
+    if size is not None:
+        values["Bytes"] = size
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": environ.get(
+                        "METRICS_NAMESPACE", DEFAULT_NAMESPACE
+                    ),
+                    "Dimensions": [DIMENSIONS],
+                    "Metrics": [
+                        {"Name": name, "Unit": UNITS[name]}
+                        for name in values
+                    ],
+                }
+            ],
+        },
+        "Service": service,
+        "Stage": stage,
+        "Table": table,
+        **values,
+    }
+
+
+def table_of(key):
+    """
+    Returns the table of a file key, flat ("{timestamp}/design.pqt")
+    or Hive-partitioned ("table=design/.../{timestamp}.pqt").
+    """
+    for segment in key.split("/"):
+        if segment.startswith("table="):
+            return segment[len("table="):]
+    return key.split("/")[-1].rsplit(".", 1)[0]
+
+
+@contextmanager
+def stage(service, name, table, rows=None, size=None):
+    """
+    Times a stage of a lambda and emits its metrics when it ends.
+
+    Parameters:
+    - service (str): The lambda, e.g. "extractor".
+    - name (str): The stage: query, build_frame, serialize, upload,
+    download, transform, orphans (its rows being the fact rows
+      with unknown keys) or insert.
+    - table (str): The table the stage works on.
+    - rows (int): The rows it processes, if known upfront.
+    - size (int): The bytes it moves, if known upfront.
+
+    Returns:
+    - dict: Yields {"rows", "bytes", "failed"}, for the stage to
+    fill in what it only knows once done.
+
+    Example:
+    ```
+    with stage("extractor", "query", "design") as measured:
+        rows = conn.run(sql)
+        measured["rows"] = len(rows)
+    ```
+
+    Notes:
+    - A stage raising is emitted with Errors 1 and the exception
+    is raised on. Stages reporting failure without raising set
+      "failed".
+    - Nothing is emitted with METRICS_ENABLED=false.
+    """
+    measured = {"rows": rows, "bytes": size, "failed": False}
+    raised = False
+    start = time.perf_counter()
+    try:
+        yield measured
+    except BaseException:
+        raised = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        if environ.get("METRICS_ENABLED", "true") != "false":
+            sink(
+                emf_document(
+                    service,
+                    name,
+                    table,
+                    seconds,
+                    measured["rows"],
+                    measured["bytes"],
+                    raised or bool(measured["failed"]),
+                )
+            )
+
+
+@contextmanager
+def captured_metrics():
+    """
+    Collects the documents emitted in the block instead of printing
+    them, for tests to assert against.
+
+    Example:
+    ```
+    with captured_metrics() as documents:
+        extract(...)
+    assert documents[0]["Stage"] == "query"
+    ```
+    """
+    global sink
+    documents = []
+    previous = sink
+    sink = documents.append
+    try:
+        yield documents
+    finally:
+        sink = previous
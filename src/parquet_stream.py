@@ -0,0 +1,165 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+# pandas and pyarrow are imported where used, the handlers importing
+# this module are invoked for keys they skip without reading a file
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+
+# small reads (footer, page headers) are served from one ranged GET
+# of this many bytes, column chunks are fetched with a GET each
+READ_BUFFER_BYTES = 1024 * 1024
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    A read-only, seekable file over an S3 object, every read is a
+    ranged GET so only the bytes asked for are downloaded.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The bucket of the object.
+    - key (str): The key of the object.
+    """
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = client.head_object(Bucket=bucket, Key=key)[
+            "ContentLength"
+        ]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        body = self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f"bytes={self.position}-{end - 1}",
+        )["Body"].read()
+        buffer[:len(body)] = body
+        self.position += len(body)
+        return len(body)
+
+
+def open_parquet(client, bucket, key):
+    """
+    Opens a Parquet object in S3 without downloading it.
+
+    Returns:
+    - pq.ParquetFile: The file, only its footer has been read.
+    """
+    import pyarrow.parquet as pq
+
+    return pq.ParquetFile(
+        io.BufferedReader(
+            S3RangeReader(client, bucket, key),
+            buffer_size=READ_BUFFER_BYTES,
+        )
+    )
+
+
+def iter_batches(client, bucket, key, rows, parquet=None):
+    """
+    Reads a Parquet object in S3 one row group at a time.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The bucket of the object.
+    - key (str): The key of the object.
+    - rows (int): The most rows per batch.
+    - parquet (pq.ParquetFile | None): The object already opened
+    with open_parquet, so its footer is not read again.
+
+    Returns:
+    - generator: pa.RecordBatch of at most `rows` rows, in file order.
+
+    Notes:
+    - Only the row group being decoded is held in memory, row groups
+    larger than `rows` are decoded in slices.
+    """
+    if parquet is None:
+        parquet = open_parquet(client, bucket, key)
+    logger.info(
+        f"📖 Streaming {key}: {parquet.metadata.num_rows} rows in "
+        f"{parquet.num_row_groups} row groups"
+    )
+    yield from parquet.iter_batches(batch_size=rows, use_threads=False)
+
+
+@cache
+def nullable_dtypes():
+    """
+    Returns {arrow type: pandas nullable dtype}, as awswrangler read
+    them, so streamed frames match get_df_from_parquet.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    return {
+        pa.int8(): pd.Int8Dtype(),
+        pa.int16(): pd.Int16Dtype(),
+        pa.int32(): pd.Int32Dtype(),
+        pa.int64(): pd.Int64Dtype(),
+        pa.uint8(): pd.UInt8Dtype(),
+        pa.uint16(): pd.UInt16Dtype(),
+        pa.uint32(): pd.UInt32Dtype(),
+        pa.uint64(): pd.UInt64Dtype(),
+        pa.bool_(): pd.BooleanDtype(),
+        pa.string(): pd.StringDtype(),
+        pa.large_string(): pd.StringDtype(),
+    }
+
+
+def to_frame(batch):
+    """Converts a record batch to a DataFrame with nullable dtypes."""
+    return batch.to_pandas(types_mapper=nullable_dtypes().get)
+
+
+def prefetch(items):
+    """
+    Yields the items of an iterator, producing the next one in a
+    background thread while the caller works on the current one.
+
+    Example:
+    ```
+    for frame in prefetch(map(to_frame, iter_batches(...))):
+        load(frame)  # the next batch downloads meanwhile
+    ```
+
+    Notes:
+    - At most two items are alive at once, the one yielded and the
+    one being produced.
+    """
+    items = iter(items)
+    done = object()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        upcoming = pool.submit(next, items, done)
+        while True:
+            item = upcoming.result()
+            if item is done:
+                return
+            upcoming = pool.submit(next, items, done)
+            yield item
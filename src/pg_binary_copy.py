@@ -0,0 +1,322 @@
+import re
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + bytes(8)
+PGCOPY_TRAILER = b"\xff\xff"
+
+# days and microseconds from the unix epoch to the postgres epoch
+PG_EPOCH_DAYS = 10957
+PG_EPOCH_MICROS = PG_EPOCH_DAYS * 86_400_000_000
+
+# integer digits of the largest int64, in base 10000 groups
+NUMERIC_INT_GROUPS = 5
+NUMERIC_NEG = 0x4000
+
+# postgres type (as printed by format_type, without modifiers)
+# -> arrow type encoded for it
+PG_ARROW_TYPES = {
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "double precision": pa.float64(),
+    "boolean": pa.bool_(),
+    "date": pa.date32(),
+    "time without time zone": pa.time64("us"),
+    "timestamp without time zone": pa.timestamp("us"),
+    "text": pa.string(),
+    "character varying": pa.string(),
+    "character": pa.string(),
+}
+
+# scale used for unconstrained numeric columns fed by non-decimal data
+DEFAULT_NUMERIC_SCALE = 10
+
+
+def get_column_types(con, table_name):
+    """
+    Reads the column types of a table.
+
+    Parameters:
+    - con (pg.Connection): A warehouse connection.
+    - table_name (str): The table to describe.
+
+    Returns:
+    - dict: {column name: type as printed by format_type},
+    e.g. {"unit_price": "numeric(10,2)"}.
+    """
+    rows = con.run(
+        """
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = CAST(:table_name AS regclass)
+        AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum;
+        """,
+        table_name=table_name,
+    )
+    return {name: pg_type for name, pg_type in rows}
+
+
+def arrow_type_for(pg_type, current):
+    """
+    Chooses the arrow type a column is encoded as for a postgres type.
+
+    Parameters:
+    - pg_type (str): The column type from get_column_types.
+    - current (pa.DataType): The arrow type the column has now.
+
+    Returns:
+    - pa.DataType: The type to cast the column to.
+    """
+    base = re.sub(r"\(.*\)", "", pg_type).strip()
+    if base == "numeric":
+        modifiers = re.search(r"\((\d+),(\d+)\)", pg_type)
+        if modifiers:
+            return pa.decimal128(
+                int(modifiers.group(1)), int(modifiers.group(2))
+            )
+        if pa.types.is_decimal(current):
+            return current
+        return pa.decimal128(38, DEFAULT_NUMERIC_SCALE)
+    if base not in PG_ARROW_TYPES:
+        raise ValueError(f"no binary COPY encoding for {pg_type}")
+    return PG_ARROW_TYPES[base]
+
+
+def cast_column(column, target):
+    """
+    Casts one column, parsing "HH:MM:SS[.ffffff]" strings into
+    times which arrow cannot cast directly.
+    """
+    if pa.types.is_time(target) and pa.types.is_string(column.type):
+        column = pc.binary_join_element_wise("1970-01-01 ", column, "")
+        column = column.cast(pa.timestamp("us"))
+    return column.cast(target)
+
+
+def cast_to_column_types(table, column_types):
+    """
+    Casts the columns of an arrow table to the types matching
+    their postgres columns, binary COPY needs exact types.
+
+    Parameters:
+    - table (pa.Table): The batch to load.
+    - column_types (dict): The result of get_column_types.
+
+    Returns:
+    - pa.Table: The cast table.
+    """
+    return pa.table(
+        {
+            name: cast_column(
+                table.column(name),
+                arrow_type_for(column_types[name], table.column(name).type),
+            )
+            for name in table.column_names
+        }
+    )
+
+
+def big_endian(values, width):
+    """Returns the big-endian bytes of a numpy array, one row each."""
+    kind = "f" if values.dtype.kind == "f" else "i"
+    return values.astype(f">{kind}{width}").view(np.uint8).reshape(-1, width)
+
+
+def fixed_width_bytes(array):
+    """
+    Encodes the values of a fixed-width arrow array.
+
+    Parameters:
+    - array (pa.Array): A column cast by cast_to_column_types.
+
+    Returns:
+    - np.ndarray: (rows, width) uint8 array of encoded values,
+    null slots hold filler.
+    """
+    data_type = array.type
+    if pa.types.is_boolean(data_type):
+        values = pc.fill_null(array, False).to_numpy(zero_copy_only=False)
+        return values.astype(np.uint8).reshape(-1, 1)
+    if pa.types.is_date32(data_type):
+        days = pc.fill_null(array.cast(pa.int32()), 0).to_numpy()
+        return big_endian(days - PG_EPOCH_DAYS, 4)
+    if pa.types.is_time64(data_type):
+        return big_endian(
+            pc.fill_null(array.cast(pa.int64()), 0).to_numpy(), 8
+        )
+    if pa.types.is_timestamp(data_type):
+        micros = pc.fill_null(array.cast(pa.int64()), 0).to_numpy()
+        return big_endian(micros - PG_EPOCH_MICROS, 8)
+    values = pc.fill_null(array, 0).to_numpy()
+    return big_endian(values, values.dtype.itemsize)
+
+
+def decimal_bytes(array):
+    """
+    Encodes a decimal128 array in the postgres numeric wire format.
+
+    Parameters:
+    - array (pa.Array): A decimal128 column.
+
+    Returns:
+    - np.ndarray: (rows, width) uint8 array of encoded values.
+
+    Notes:
+    - Every value uses the same number of base 10000 digit groups,
+    postgres strips the leading and trailing zero groups on receive,
+    so the width is fixed and the encoding stays vectorised.
+    - Values must fit in 64 bits unscaled, which covers any
+    numeric(18, s) column.
+    """
+    scale = array.type.scale
+    if scale > 18:
+        raise ValueError("decimal scale too large for binary COPY")
+    words = np.frombuffer(array.buffers()[1], dtype="<i8")
+    words = words[2 * array.offset:2 * (array.offset + len(array))]
+    low = words[0::2]
+    high = words[1::2]
+    valid = array.is_valid().to_numpy(zero_copy_only=False)
+    if np.any((high != (low >> 63)) & valid):
+        raise ValueError("decimal value too large for binary COPY")
+
+    negative = (low < 0) & valid
+    magnitude = np.abs(low).astype(np.uint64)
+    fraction_groups = -(-scale // 4)
+    padding = fraction_groups * 4 - scale
+    integer, fraction = np.divmod(magnitude, np.uint64(10**scale))
+
+    groups = []
+    for power in range(NUMERIC_INT_GROUPS - 1, -1, -1):
+        groups.append(integer // np.uint64(10000**power) % np.uint64(10000))
+    # the fraction is right padded with zeros to whole groups, each
+    # group is cut from it unpadded as fraction * 10**padding would
+    # overflow 64 bits at scales 17 and 18
+    for power in range(fraction_groups - 1, -1, -1):
+        shift = 4 * power - padding
+        if shift >= 0:
+            group = fraction // np.uint64(10**shift) % np.uint64(10000)
+        else:
+            group = fraction % np.uint64(10 ** (4 + shift)) * np.uint64(
+                10**-shift
+            )
+        groups.append(group)
+    ndigits = len(groups)
+
+    rows = len(array)
+    header = np.empty((rows, 4), dtype=np.int64)
+    header[:, 0] = ndigits
+    header[:, 1] = NUMERIC_INT_GROUPS - 1
+    header[:, 2] = np.where(negative, NUMERIC_NEG, 0)
+    header[:, 3] = scale
+    digits = np.stack(groups, axis=1).astype(np.int64)
+    return big_endian(np.hstack([header, digits]).ravel(), 2).reshape(
+        rows, 2 * (4 + ndigits)
+    )
+
+
+def string_buffers(array):
+    """
+    Returns the offsets and utf-8 data of a string array
+    as numpy views over its arrow buffers.
+    """
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int32)
+    offsets = offsets[array.offset:array.offset + len(array) + 1]
+    data = array.buffers()[2]
+    data = (
+        np.frombuffer(data, dtype=np.uint8)
+        if data is not None
+        else np.empty(0, dtype=np.uint8)
+    )
+    return offsets, data
+
+
+def encode_batch(batch):
+    """
+    Encodes the rows of a record batch as binary COPY tuples.
+
+    Parameters:
+    - batch (pa.RecordBatch): Columns already cast with
+    cast_to_column_types.
+
+    Returns:
+    - bytes: The encoded tuples, without the file header or trailer.
+
+    Notes:
+    - Every field is written by scattering whole columns into one
+    output buffer, no per-value Python objects are created.
+    """
+    rows = batch.num_rows
+    columns = []
+    field_sizes = []
+    for array in batch.columns:
+        valid = array.is_valid().to_numpy(zero_copy_only=False)
+        if pa.types.is_string(array.type):
+            offsets, data = string_buffers(array)
+            lengths = np.diff(offsets).astype(np.int64)
+            payload = ("string", offsets, data)
+        else:
+            values = (
+                decimal_bytes(array)
+                if pa.types.is_decimal(array.type)
+                else fixed_width_bytes(array)
+            )
+            lengths = np.full(rows, values.shape[1], dtype=np.int64)
+            payload = ("fixed", values)
+        lengths[~valid] = -1
+        columns.append((valid, lengths, payload))
+        field_sizes.append(4 + np.maximum(lengths, 0))
+
+    row_sizes = 2 + np.sum(field_sizes, axis=0, dtype=np.int64)
+    row_starts = np.zeros(rows, dtype=np.int64)
+    np.cumsum(row_sizes[:-1], out=row_starts[1:])
+    out = np.empty(int(row_sizes.sum()), dtype=np.uint8)
+
+    field_count = big_endian(np.full(rows, len(columns)), 2)
+    out[row_starts[:, None] + np.arange(2)] = field_count
+
+    field_starts = row_starts + 2
+    for (valid, lengths, payload), size in zip(columns, field_sizes):
+        out[field_starts[:, None] + np.arange(4)] = big_endian(lengths, 4)
+        starts = field_starts[valid] + 4
+        if payload[0] == "fixed":
+            values = payload[1][valid]
+            out[starts[:, None] + np.arange(values.shape[1])] = values
+        else:
+            offsets, data = payload[1], payload[2]
+            value_lengths = lengths[valid]
+            total = int(value_lengths.sum())
+            within = np.arange(total) - np.repeat(
+                np.cumsum(value_lengths) - value_lengths, value_lengths
+            )
+            source = np.repeat(offsets[:-1][valid], value_lengths) + within
+            out[np.repeat(starts, value_lengths) + within] = data[source]
+        field_starts = field_starts + size
+    return out.tobytes()
+
+
+def iter_copy_chunks(table, rows_per_chunk=50_000):
+    """
+    Streams an arrow table as a binary COPY file.
+
+    Parameters:
+    - table (pa.Table): Columns already cast with cast_to_column_types.
+    - rows_per_chunk (int): Rows encoded per yielded chunk.
+
+    Returns:
+    - generator: bytes chunks, header first and trailer last, which
+    pg8000 sends as they are produced with `run(..., stream=...)`.
+    """
+    yield PGCOPY_HEADER
+    for batch in table.to_batches(max_chunksize=rows_per_chunk):
+        if batch.num_rows:
+            yield encode_batch(batch)
+    yield PGCOPY_TRAILER
+
+
+def encode_table(table):
+    """Encodes a whole arrow table as one binary COPY file."""
+    return b"".join(iter_copy_chunks(table))
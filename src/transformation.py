@@ -1,16 +1,44 @@
 import logging
 from urllib.request import urlopen
+import json
+from io import BytesIO
 from json import loads
 import os
-import boto3
-import pandas as pd
-import awswrangler as wr
 import botocore
-
-s3 = boto3.client("s3")
+from data_quality import profile_table, upload_profile
+from dim_date import dates_key, emit_dim_date, save_ranges
+from lineage import LINEAGE_ATTR, lineage_of, stamp, with_lineage
+from parquet_stream import to_frame
+from metrics import stage, table_of
+from clients import get_client
+from dimension_keys import (
+    DIMENSION_KEY_COLUMNS,
+    FACT_FOREIGN_KEYS,
+    FACT_KEY_COLUMNS,
+    check_fact_keys,
+    record_dimension_keys,
+)
+
+# the S3 client, created on first use (see s3_client)
+s3 = None
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
+# dim_transaction columns holding the id of only one kind of transaction
+ORDER_ID_COLUMNS = ["sales_order_id", "purchase_order_id"]
+
+# rows per Parquet row group, the loader streams files a group at a time
+ROW_GROUP_ROWS = 100_000
+
+
+def s3_client():
+    """
+    Returns the S3 client of the transformation, created on first
+    use (see clients.get_client). Tests patch s3 to substitute their
+    own.
+    """
+    return get_client("s3") if s3 is None else s3
+
 
 def lambda_handler(event, context):
     """
@@ -43,6 +71,20 @@ def lambda_handler(event, context):
     template, it reads the Parquet file,
       applies the transformation, and uploads the
       transformed file to another S3 bucket.
+    - Dimension ids are merged into the known key arrays and
+    fact rows with foreign keys not known yet are counted in the
+      profile and the "orphans" stage metrics, they are still
+      written out (see dimension_keys.check_fact_keys).
+    - Fact batches also emit the dim_date rows for any dates
+    in their range no fact table emitted before, as
+      "{timestamp}/date_{table}.pqt" (see dim_date.dates_key).
+    - A data-quality profile of every output file is written
+    next to it as "{key[:-4]}.profile.json", the key without
+      its ".pqt" (see data_quality.profile_key).
+    - The download, transform, serialize and upload stages emit
+    their metrics (see metrics.stage).
+    - Output files carry the lineage of their input, stamped with
+    the transformation time (see lineage).
     - It logs errors encountered during the process,
     including any ClientError exceptions
       from accessing S3, and raises other exceptions.
@@ -55,18 +97,79 @@ def lambda_handler(event, context):
         table_name = get_table_name(file_key)
 
         if table_name in list(tables_transformation_templates.keys()):
+            # pyarrow, as pandas, is left to the files transformed
+            import pyarrow as pa
+
+            client = s3_client()
             # read the file - return dataframe
-            df = get_df_from_parquet(file_key, bucket_name)
+            with stage("transformation", "download", table_name) as measured:
+                df = get_df_from_parquet(file_key, bucket_name)
+                measured["rows"] = len(df)
             # transform df due to template
-            new_df = tables_transformation_templates[table_name](df)
-            upload_parquet(
-                s3,
-                os.environ.get(
-                    "S3_TRANSFORMATION_BUCKET", "test_transform_bucket"
-                ),
-                file_key,
-                new_df,
+            with stage(
+                "transformation", "transform", table_name, rows=len(df)
+            ):
+                new_df = tables_transformation_templates[table_name](df)
+            # the lineage comes with the file read above
+            lineage = stamp(df.attrs.pop(LINEAGE_ATTR, None), "transformed_at")
+            # keep dimension keys current, count orphaned fact rows
+            control_bucket = os.environ.get(
+                "S3_CONTROL_BUCKET", "control_bucket"
+            )
+            if table_name in DIMENSION_KEY_COLUMNS:
+                record_dimension_keys(
+                    client,
+                    control_bucket,
+                    table_name,
+                    new_df[DIMENSION_KEY_COLUMNS[table_name]],
+                )
+            elif table_name in FACT_FOREIGN_KEYS:
+                with stage(
+                    "transformation", "orphans", table_name
+                ) as measured:
+                    orphans = check_fact_keys(
+                        client, control_bucket, file_key, table_name, new_df
+                    )
+                    measured["rows"] = orphans["rows"]
+            output_bucket = os.environ.get(
+                "S3_TRANSFORMATION_BUCKET", "test_transform_bucket"
             )
+            if table_name in FACT_FOREIGN_KEYS:
+                emitted = emit_dim_date(client, control_bucket, new_df)
+                if emitted is not None:
+                    dates, ranges = emitted
+                    upload_parquet(
+                        client,
+                        output_bucket,
+                        dates_key(file_key, table_name),
+                        dates,
+                        lineage,
+                    )
+                    save_ranges(client, control_bucket, ranges)
+            if os.environ.get("TRANSFORM_OUTPUT_LAYOUT", "flat") == "hive":
+                timestamp = file_key.split("/")[0]
+                outputs = [
+                    (partition_key(table_name, date, timestamp), part_df)
+                    for date, part_df in split_partitions(new_df)
+                ]
+            else:
+                outputs = [(file_key, new_df)]
+            for key, out_df in outputs:
+                # one conversion feeds both the profile and the upload
+                table = pa.Table.from_pandas(out_df, preserve_index=False)
+                upload_parquet(client, output_bucket, key, table, lineage)
+                profile = profile_table(table, tables_record_ids[table_name])
+                if table_name in FACT_FOREIGN_KEYS:
+                    # of the whole input file
+                    profile["orphans"] = orphans
+                upload_profile(client, output_bucket, key, profile)
+            if os.environ.get("TRANSFORM_OUTPUT_LAYOUT", "flat") == "hive":
+                upload_manifest(
+                    client,
+                    output_bucket,
+                    file_key,
+                    [key for key, _ in outputs],
+                )
 
     except botocore.exceptions.ClientError as e:
         logger.error(
@@ -101,18 +204,24 @@ def get_df_from_parquet(key, bucket_name):
 
     Notes:
     - This function reads a Parquet file located in the
-    specified S3 bucket.
-    - It uses the AWS Data Wrangler library (wr) to
-    read the Parquet file into a DataFrame.
+    specified S3 bucket, in one GET.
+    - Columns get the nullable dtypes awswrangler gives them
+    (see parquet_stream.to_frame).
+    - The lineage of the file is kept in df.attrs[LINEAGE_ATTR],
+    so it is not read from S3 a second time.
     - Ensure that appropriate permissions are set for accessing
     the S3 bucket.
     """
-    pqt_object = [f"s3://{bucket_name}/{key}"]
-    df = wr.s3.read_parquet(path=pqt_object)
+    import pyarrow.parquet as pq
+
+    body = s3_client().get_object(Bucket=bucket_name, Key=key)["Body"]
+    table = pq.read_table(BytesIO(body.read()))
+    df = to_frame(table)
+    df.attrs[LINEAGE_ATTR] = lineage_of(table.schema.metadata)
     return df
 
 
-def upload_parquet(client, bucket, key, data):
+def upload_parquet(client, bucket, key, data, lineage=None):
     """
     Uploads a Pandas DataFrame as a Parquet file
     to an S3 bucket.
@@ -124,15 +233,35 @@ def upload_parquet(client, bucket, key, data):
         to upload the Parquet file to.
         key (str): The key (object name) to use
         for the Parquet file within the S3 bucket.
-        data (pd.DataFrame): The Pandas DataFrame
-        to be uploaded as a Parquet file.
+        data (pd.DataFrame | pa.Table): The Pandas DataFrame
+        or Arrow table to be uploaded as a Parquet file.
+        lineage (dict): If given, stamped into the file's
+        key-value metadata (see lineage).
 
     Returns:
         None: The function does not return a specific value.
         It performs the upload operation directly.
     """
-    data.to_parquet(path="/tmp/output.parquet")
-    client.upload_file(Bucket=bucket, Key=key, Filename="/tmp/output.parquet")
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = table_of(key)
+    rows = data.num_rows if isinstance(data, pa.Table) else len(data)
+    with stage("transformation", "serialize", table, rows=rows) as measured:
+        if not isinstance(data, pa.Table):
+            data = pa.Table.from_pandas(data)
+        pq.write_table(
+            with_lineage(data, lineage),
+            "/tmp/output.parquet",
+            row_group_size=ROW_GROUP_ROWS,
+        )
+        measured["bytes"] = os.path.getsize("/tmp/output.parquet")
+    with stage(
+        "transformation", "upload", table, rows=rows, size=measured["bytes"]
+    ):
+        client.upload_file(
+            Bucket=bucket, Key=key, Filename="/tmp/output.parquet"
+        )
 
 
 def get_table_name(key):
@@ -162,6 +291,142 @@ def get_table_name(key):
     return key[:-4].split("/")[1]
 
 
+def partition_key(table, date, timestamp):
+    """
+    Builds the Hive-style key of a transformed partition file.
+
+    Parameters:
+    - table (str): The source table name.
+    - date (date | str): The last_updated_date of the partition.
+    - timestamp (str): The extraction timestamp from the input key.
+
+    Returns:
+    - str: A key like
+    "table=design/last_updated_date=2024-02-15/2024-02-15T19:01:53.pqt"
+    """
+    return f"table={table}/last_updated_date={date}/{timestamp}.pqt"
+
+
+def manifest_key(file_key):
+    """
+    Builds the key of the manifest listing the partition files
+    written for an input file.
+
+    Returns:
+    - str: A key like "2024-02-15T19:01:53/design.manifest.json".
+    """
+    return f"{file_key[:-4]}.manifest.json"
+
+
+def upload_manifest(client, bucket, file_key, keys):
+    """
+    Writes the keys of the partition files transformed from an
+    input file to its manifest (see manifest_key).
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - file_key (str): The key of the input file.
+    - keys (list): The partition file keys.
+
+    Returns:
+    - None
+
+    Notes:
+    - The manifest sits under the run's own prefix and is written
+    after the files it lists, the load coordinator finds a run's
+      partition files from it without listing every partition of
+      the table.
+    """
+    client.put_object(
+        Bucket=bucket,
+        Key=manifest_key(file_key),
+        Body=json.dumps(keys),
+        ContentType="application/json",
+    )
+
+
+def split_partitions(df):
+    """
+    Splits a transformed DataFrame by its last_updated_date.
+
+    Parameters:
+    - df (DataFrame): A transformed DataFrame with a
+    'last_updated_date' column.
+
+    Returns:
+    - list: (date, DataFrame) pairs, one per distinct date.
+    """
+    return [
+        (date, part_df.reset_index(drop=True))
+        for date, part_df in df.groupby("last_updated_date", sort=True)
+    ]
+
+
+def list_partitions(client, bucket, table, start=None, end=None):
+    """
+    Queries the partition index of a Hive-partitioned bucket
+    for the dates held for one table.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - table (str): The source table name.
+    - start (str | None): First date to include, "YYYY-MM-DD".
+    - end (str | None): Last date to include, "YYYY-MM-DD".
+
+    Returns:
+    - list: The partition dates as "YYYY-MM-DD" strings, in order.
+
+    Notes:
+    - The index is the key layout itself, partitions are read from
+    the common prefixes under "table={table}/" so no separate index
+    object has to be kept in step by concurrent invocations.
+    """
+    prefix = f"table={table}/last_updated_date="
+    dates = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=prefix, Delimiter="/"
+    ):
+        for common in page.get("CommonPrefixes", []):
+            date = common["Prefix"][len(prefix):].rstrip("/")
+            if start is not None and date < start:
+                continue
+            if end is not None and date > end:
+                continue
+            dates.append(date)
+    return sorted(dates)
+
+
+def list_partition_keys(client, bucket, table, start=None, end=None):
+    """
+    Lists the object keys in the partitions of a table between
+    two dates, so readers only fetch the partitions they need.
+
+    Parameters:
+    - client (boto3.client): An S3 client.
+    - bucket (str): The transformed bucket.
+    - table (str): The source table name.
+    - start (str | None): First date to include, "YYYY-MM-DD".
+    - end (str | None): Last date to include, "YYYY-MM-DD".
+
+    Returns:
+    - list: The object keys, ordered by date then extraction time.
+    """
+    keys = []
+    paginator = client.get_paginator("list_objects_v2")
+    for date in list_partitions(client, bucket, table, start, end):
+        prefix = f"table={table}/last_updated_date={date}/"
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys.extend(
+                item["Key"]
+                for item in page.get("Contents", [])
+                if item["Key"].endswith(".pqt")
+            )
+    return keys
+
+
 def split_time(df, col_name, new_date_col_name, new_time_col_name):
     """
     Splits a datetime column into separate date and
@@ -195,6 +460,8 @@ def split_time(df, col_name, new_date_col_name, new_time_col_name):
     components extracted from the original
       datetime column.
     """
+    import pandas as pd
+
     df[col_name] = pd.to_datetime(df[col_name])
 
     # split
@@ -462,6 +729,8 @@ def transform_currency(df):
     - It drops columns 'last_updated' and 'created_at'
     from the input DataFrame.
     """
+    import pandas as pd
+
     url = "https://raw.githubusercontent.com/umpirsky/currency-list/master/data/en_GB/currency.json"  # noqa
     response = urlopen(url)
     json_raw = response.read().decode("utf-8")
@@ -604,13 +873,17 @@ def transform_transaction_table(df):
     - It creates new columns, such as 'last_updated_date',
     'last_updated_time',
       and 'transaction_record_id'.
-    - It replaces NaN values with None.
+    - 'sales_order_id' and 'purchase_order_id' become nullable
+    Int64 columns, the id a transaction does not have is written
+      as a real null instead of NaN forcing the column to float.
     - It drops columns 'last_updated' and 'created_at'
     from the input DataFrame.
     """
     df["last_updated_date"] = df["last_updated"].dt.date
     df["last_updated_time"] = df["last_updated"].dt.time
     df["transaction_record_id"] = df["transaction_id"]
+    for col in ORDER_ID_COLUMNS:
+        df[col] = df[col].astype("Int64")
     df.drop(
         columns=[
             "last_updated",
@@ -633,3 +906,5 @@ tables_transformation_templates = {
     "staff": transform_staff_table,
     "transaction": transform_transaction_table,
 }
+
+tables_record_ids = {**DIMENSION_KEY_COLUMNS, **FACT_KEY_COLUMNS}
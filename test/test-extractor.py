@@ -1,5 +1,5 @@
 from datetime import datetime
-from unittest.mock import Mock, patch
+from unittest.mock import ANY, Mock, patch
 from configparser import ConfigParser
 from io import BytesIO
 import os
@@ -149,7 +149,9 @@ def test_extract(upload):
 
     extract(client, conn, "ingestion", table, time, time)
 
-    upload.assert_called_with(client, "ingestion", key, SAME_DF(df))
+    upload.assert_called_with(
+        client, "ingestion", key, SAME_DF(df), lineage=ANY
+    )
 
 
 @mock_aws
@@ -0,0 +1,206 @@
+import os
+from configparser import ConfigParser
+from datetime import date
+from decimal import Decimal
+from unittest.mock import patch
+import pandas as pd
+import pytest
+from t_utils import inhibit_CI
+from src.aggregates import (
+    AGGREGATES,
+    create_summary_query,
+    delta_query,
+    ensure_aggregates,
+    install_aggregate,
+    installed,
+    is_installed,
+)
+from src.loader import (
+    get_connection,
+    installed as loader_installed,
+    load_frame,
+    maintain_aggregates,
+)
+
+SALES_AGGREGATES = ["agg_daily_sales", "agg_daily_sales_by_counterparty"]
+
+
+@pytest.fixture(scope="function")
+def mockdb_creds():
+    """Mocked Database Credentials for local testing."""
+
+    config = ConfigParser()
+    config.read(".env.ini")
+    section = config["DEFAULT"]
+
+    os.environ["PGUSER2"] = section["PGUSER"]
+    os.environ["PGPASSWORD2"] = section["PGPASSWORD"]
+    os.environ["PGHOST2"] = "127.0.0.1"
+    os.environ["PGDATABASE2"] = "totesys_test_subset"
+
+
+@pytest.fixture(scope="function")
+def sales(mockdb_creds):
+    con = get_connection()
+    drop = f"DROP TABLE IF EXISTS fact_sales_order, {', '.join(AGGREGATES)};"
+    con.run(drop)
+    con.run(
+        """
+        CREATE TABLE fact_sales_order (
+            sales_record_id INT PRIMARY KEY,
+            created_date DATE,
+            currency_record_id INT,
+            design_record_id INT,
+            counterparty_record_id INT,
+            units_sold INT,
+            unit_price NUMERIC(10, 2)
+        );
+        """
+    )
+    con.run(
+        """
+        INSERT INTO fact_sales_order VALUES
+        (1, '2024-02-15', 1, 1, 1, 10, 2.50),
+        (2, '2024-02-15', 1, 1, 2, 5, 3.00),
+        (3, '2024-02-16', 2, 1, 1, 1, 1.00);
+        """
+    )
+    installed.clear()
+    loader_installed.clear()
+    yield con
+    installed.clear()
+    loader_installed.clear()
+    con.run(drop)
+    con.close()
+
+
+def summary_of(con, name):
+    return con.run(f"SELECT * FROM {name} ORDER BY 1, 2, 3")
+
+
+def recomputed(con, name):
+    con.run(create_summary_query(name).replace(name, "recomputed", 1))
+    rows = con.run("SELECT * FROM recomputed ORDER BY 1, 2, 3")
+    con.run("DROP TABLE recomputed")
+    return rows
+
+
+def test_delta_query_adds_differences_and_drops_empty_groups():
+    query = delta_query("agg_daily_payments", {"new_rows": 1, "old_rows": -1})
+
+    assert "1 * (payment_amount) AS payment_amount" in query
+    assert "-1 * (payment_amount) AS payment_amount" in query
+    assert (
+        "ON CONFLICT (created_date, currency_record_id, "
+        "counterparty_record_id) DO UPDATE SET "
+        "payment_amount = agg_daily_payments.payment_amount "
+        "+ EXCLUDED.payment_amount"
+    ) in query
+    assert "WHERE row_count = 0" in query
+
+
+@inhibit_CI
+def test_install_aggregate_summarises_existing_rows(sales):
+    install_aggregate(sales, "agg_daily_sales")
+
+    assert summary_of(sales, "agg_daily_sales") == [
+        [date(2024, 2, 15), 1, 1, 15, Decimal("40.00"), 2],
+        [date(2024, 2, 16), 2, 1, 1, Decimal("1.00"), 1],
+    ]
+    assert is_installed(sales, "agg_daily_sales")
+    assert not is_installed(sales, "agg_daily_payments")
+
+
+@inhibit_CI
+def test_triggers_keep_summaries_equal_to_a_rescan(sales):
+    for name in SALES_AGGREGATES:
+        install_aggregate(sales, name)
+
+    sales.run(
+        """
+        INSERT INTO fact_sales_order VALUES
+        (4, '2024-02-16', 2, 1, 1, 4, 1.00),
+        (5, '2024-02-17', 1, 2, 3, 7, 9.99),
+        (6, '2024-02-17', NULL, 2, 3, 7, 9.99)
+        ON CONFLICT (sales_record_id) DO UPDATE
+        SET units_sold = EXCLUDED.units_sold;
+        """
+    )
+    # one row moves to another design, one row changes in place
+    sales.run(
+        """
+        INSERT INTO fact_sales_order VALUES
+        (2, '2024-02-15', 1, 2, 2, 5, 3.00),
+        (1, '2024-02-15', 1, 1, 1, 20, 2.50)
+        ON CONFLICT (sales_record_id) DO UPDATE
+        SET design_record_id = EXCLUDED.design_record_id,
+        units_sold = EXCLUDED.units_sold;
+        """
+    )
+    sales.run("DELETE FROM fact_sales_order WHERE sales_record_id = 3")
+
+    for name in SALES_AGGREGATES:
+        assert summary_of(sales, name) == recomputed(sales, name)
+    # the group of row 3 was emptied by the delete
+    assert sales.run(
+        "SELECT row_count FROM agg_daily_sales "
+        "WHERE created_date = '2024-02-16'"
+    ) == [[1]]
+
+    sales.run("TRUNCATE fact_sales_order")
+
+    assert summary_of(sales, "agg_daily_sales") == []
+
+
+@inhibit_CI
+@pytest.mark.parametrize("load_mode", ["row", "copy"])
+def test_loads_maintain_summaries(sales, load_mode):
+    df = pd.DataFrame(
+        {
+            "sales_record_id": [3, 7],
+            "created_date": [date(2024, 2, 15), date(2024, 2, 18)],
+            "currency_record_id": [1, 1],
+            "design_record_id": [1, 1],
+            "counterparty_record_id": [1, 1],
+            "units_sold": [2, 3],
+            "unit_price": [Decimal("1.00"), Decimal("2.00")],
+        }
+    )
+    env = {"LOAD_MODE": load_mode, "LOAD_AGGREGATES": "true"}
+
+    with patch.dict(os.environ, env):
+        maintain_aggregates("fact_sales_order")
+        assert load_frame(df, "fact_sales_order", "sales_record_id", "k")
+
+    for name in SALES_AGGREGATES:
+        assert summary_of(sales, name) == recomputed(sales, name)
+    assert loader_installed == set(SALES_AGGREGATES)
+
+
+@inhibit_CI
+def test_ensure_aggregates_installs_once(sales):
+    assert ensure_aggregates(sales, "dim_design") == []
+    assert ensure_aggregates(sales, "fact_sales_order") == SALES_AGGREGATES
+    sales.run(
+        "INSERT INTO agg_daily_sales VALUES ('2000-01-01', 1, 1, 1, 1, 1)"
+    )
+
+    ensure_aggregates(sales, "fact_sales_order")
+    assert len(summary_of(sales, "agg_daily_sales")) == 3
+
+    # a summary whose triggers were dropped is rebuilt
+    installed.clear()
+    sales.run("DROP TRIGGER agg_daily_sales_update ON fact_sales_order")
+    ensure_aggregates(sales, "fact_sales_order")
+    assert len(summary_of(sales, "agg_daily_sales")) == 2
+    assert is_installed(sales, "agg_daily_sales")
+
+
+@patch("src.loader.warm_connection")
+def test_maintain_aggregates_off_by_default(mock_warm_connection):
+    with patch.dict(os.environ, {"LOAD_AGGREGATES": "false"}):
+        maintain_aggregates("fact_sales_order")
+    with patch.dict(os.environ, {"LOAD_AGGREGATES": "true"}):
+        maintain_aggregates("dim_design")
+
+    mock_warm_connection.assert_not_called()
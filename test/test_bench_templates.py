@@ -0,0 +1,55 @@
+from decimal import Decimal
+from scripts.bench_templates import (
+    benchmarks,
+    extracted_frame,
+    regressions,
+    source_frame,
+)
+from src.transformation import tables_transformation_templates
+
+
+def result(relative, peak_bytes):
+    return {"seconds": relative / 100, "relative": relative,
+            "peak_bytes": peak_bytes}
+
+
+def test_regressions_beyond_tolerance_only():
+    baseline = {
+        "a@1000": result(1.0, 1000),
+        "b@1000": result(1.0, 1000),
+        "c@1000": result(1.0, 1000),
+    }
+    results = {
+        "a@1000": result(1.5, 1200),
+        "b@1000": result(3.0, 1000),
+        "c@1000": result(0.5, 1300),
+        "new@1000": result(50.0, 10**9),
+    }
+
+    assert regressions(results, baseline, 0.5, 0.2) == [
+        "b@1000 took 3.00 references, baseline 1.00 (3.00x)",
+        "c@1000 allocated 1,300 bytes, baseline 1,000 (1.30x)",
+    ]
+
+
+def test_inputs_are_scaled_and_shaped_as_extracted():
+    assert len(source_frame("currency", 10)) == 10
+    assert source_frame("address", 250)["address_id"].is_unique
+
+    sales = extracted_frame("sales_order", 10)
+    staff = extracted_frame("staff", 10)
+    counterparty = extracted_frame("counterparty", 10)
+
+    assert isinstance(sales["unit_price"][0], Decimal)
+    assert staff["department_name"].notna().all()
+    assert counterparty["address_line_1"].notna().all()
+
+
+def test_every_template_is_benchmarked():
+    cases = benchmarks(10)
+
+    assert {
+        template.__name__
+        for template in tables_transformation_templates.values()
+    } < set(cases)
+    assert {"split_time", "create_query", "rows_to_dict"} < set(cases)
@@ -0,0 +1,273 @@
+import os
+from collections import Counter
+from configparser import ConfigParser
+from io import BytesIO
+from unittest.mock import patch
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+from t_utils import inhibit_CI
+from src.bulk_load import (
+    bulk_load_table,
+    copy_file,
+    get_foreign_key_constraints,
+    get_secondary_indexes,
+    lambda_handler,
+)
+from src.load_coordinator import LOADED, static_dependencies
+from src.loader import get_connection
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(
+            Bucket="processed",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield client
+
+
+@pytest.fixture(scope="function")
+def mockdb_creds():
+    """Mocked Database Credentials for local testing."""
+
+    config = ConfigParser()
+    config.read(".env.ini")
+    section = config["DEFAULT"]
+
+    os.environ["PGUSER2"] = section["PGUSER"]
+    os.environ["PGPASSWORD2"] = section["PGPASSWORD"]
+    os.environ["PGHOST2"] = "127.0.0.1"
+    os.environ["PGDATABASE2"] = "totesys_test_subset"
+
+
+@pytest.fixture(scope="function")
+def warehouse(mockdb_creds):
+    con = get_connection()
+    con.run("DROP TABLE IF EXISTS fact_sales_order, dim_design;")
+    con.run(
+        "CREATE TABLE dim_design "
+        "(design_record_id INT PRIMARY KEY, design_name VARCHAR);"
+    )
+    con.run("INSERT INTO dim_design VALUES (1, 'One'), (2, 'Two');")
+    con.run(
+        """
+        CREATE TABLE fact_sales_order (
+            sales_record_id INT PRIMARY KEY,
+            design_record_id INT
+                CONSTRAINT fact_design_fk REFERENCES dim_design,
+            units_sold INT
+        );
+        """
+    )
+    con.run(
+        "CREATE INDEX fact_design_idx "
+        "ON fact_sales_order (design_record_id);"
+    )
+    con.run(
+        "CREATE INDEX fact_units_idx ON fact_sales_order (units_sold) "
+        "WHERE units_sold > 0;"
+    )
+    con.run("INSERT INTO fact_sales_order VALUES (1, 1, 10);")
+    yield con
+    con.run("DROP TABLE IF EXISTS fact_sales_order, dim_design;")
+    con.close()
+
+
+def put_frame(client, key, df):
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False)
+    client.put_object(Bucket="processed", Key=key, Body=buffer.getvalue())
+
+
+def sales_frame(ids, designs, units):
+    return pd.DataFrame(
+        {
+            "sales_record_id": ids,
+            "design_record_id": designs,
+            "units_sold": units,
+        }
+    )
+
+
+def schema_of(con):
+    return (
+        get_secondary_indexes(con, "fact_sales_order"),
+        get_foreign_key_constraints(con, "fact_sales_order"),
+    )
+
+
+@inhibit_CI
+def test_secondary_indexes_leave_out_primary_key(warehouse):
+    indexes, foreign_keys = schema_of(warehouse)
+
+    assert [name for name, _ in indexes] == [
+        "fact_design_idx",
+        "fact_units_idx",
+    ]
+    assert "WHERE (units_sold > 0)" in indexes[1][1]
+    assert foreign_keys == [
+        (
+            "fact_design_fk",
+            "FOREIGN KEY (design_record_id) "
+            "REFERENCES dim_design(design_record_id)",
+        )
+    ]
+
+
+@inhibit_CI
+def test_bulk_load_table_restores_indexes_and_analyzes(warehouse, s3):
+    before = schema_of(warehouse)
+    put_frame(
+        s3, "a/sales_order.pqt", sales_frame([1, 2, 3], [1, 1, 2], [5, 6, 7])
+    )
+    put_frame(s3, "b/sales_order.pqt", sales_frame([2], [2], [60]))
+
+    counts = bulk_load_table(
+        s3,
+        "processed",
+        "fact_sales_order",
+        "sales_record_id",
+        ["a/sales_order.pqt", "b/sales_order.pqt"],
+        rows=2,
+    )
+
+    assert counts == Counter(inserted=2, updated=1, unchanged=0)
+    assert warehouse.run(
+        "SELECT * FROM fact_sales_order ORDER BY sales_record_id"
+    ) == [[1, 1, 5], [2, 2, 60], [3, 2, 7]]
+    assert schema_of(warehouse) == before
+    assert warehouse.run(
+        "SELECT reltuples FROM pg_class WHERE relname = 'fact_sales_order'"
+    ) == [[3.0]]
+    assert warehouse.run(
+        "SELECT count(*) FROM pg_class "
+        "WHERE relname = 'bulk_staging_fact_sales_order'"
+    ) == [[0]]
+
+
+@inhibit_CI
+def test_bulk_load_table_keeps_unique_indexes(warehouse, s3):
+    warehouse.run(
+        "CREATE UNIQUE INDEX fact_units_key ON fact_sales_order (units_sold);"
+    )
+    oid = "SELECT CAST(CAST('fact_units_key' AS regclass) AS oid)"
+    [[before]] = warehouse.run(oid)
+    put_frame(s3, "a/sales_order.pqt", sales_frame([2], [1], [11]))
+
+    assert "fact_units_key" not in dict(
+        get_secondary_indexes(warehouse, "fact_sales_order")
+    )
+    assert bulk_load_table(
+        s3,
+        "processed",
+        "fact_sales_order",
+        "sales_record_id",
+        ["a/sales_order.pqt"],
+    )
+    # never dropped and rebuilt
+    assert warehouse.run(oid) == [[before]]
+
+
+@inhibit_CI
+def test_bulk_load_table_copies_before_locking_target(warehouse, s3):
+    put_frame(s3, "a/sales_order.pqt", sales_frame([2], [1], [11]))
+    locks = []
+
+    def copy_and_check(*args):
+        locks.extend(
+            warehouse.run(
+                "SELECT mode FROM pg_locks "
+                "WHERE relation = CAST('fact_sales_order' AS regclass)"
+            )
+        )
+        return copy_file(*args)
+
+    with patch("src.bulk_load.copy_file", side_effect=copy_and_check):
+        assert bulk_load_table(
+            s3,
+            "processed",
+            "fact_sales_order",
+            "sales_record_id",
+            ["a/sales_order.pqt"],
+        )
+
+    assert ["AccessExclusiveLock"] not in locks
+
+
+@inhibit_CI
+def test_bulk_load_table_rolls_back_on_failure(warehouse, s3):
+    before = schema_of(warehouse)
+    # design 9 does not exist, re-adding the foreign key fails
+    put_frame(s3, "a/sales_order.pqt", sales_frame([1, 2], [1, 9], [50, 6]))
+
+    counts = bulk_load_table(
+        s3,
+        "processed",
+        "fact_sales_order",
+        "sales_record_id",
+        ["a/sales_order.pqt"],
+    )
+
+    assert counts is None
+    assert warehouse.run("SELECT * FROM fact_sales_order") == [[1, 1, 10]]
+    assert schema_of(warehouse) == before
+    assert warehouse.run(
+        "SELECT count(*) FROM pg_class "
+        "WHERE relname = 'bulk_staging_fact_sales_order'"
+    ) == [[0]]
+
+
+@patch("src.bulk_load.dependency_graph")
+@patch("src.bulk_load.bulk_load_table")
+def test_lambda_handler_loads_runs_in_order(
+    mock_bulk_load_table, mock_dependency_graph, s3
+):
+    for key in [
+        "2024-02-15T10:00:00/sales_order.pqt",
+        "2024-02-15T11:00:00/sales_order.pqt",
+        "2024-02-15T11:00:00/design.pqt",
+    ]:
+        s3.put_object(Bucket="processed", Key=key, Body=b"")
+    mock_dependency_graph.return_value = static_dependencies()
+    mock_bulk_load_table.return_value = Counter(inserted=1)
+
+    outcomes = lambda_handler(
+        {
+            "runs": ["2024-02-15T10:00:00", "2024-02-15T11:00:00"],
+            "bucket": "processed",
+        },
+        {},
+    )
+
+    assert outcomes == {"dim_design": LOADED, "fact_sales_order": LOADED}
+    calls = [call.args[2:] for call in mock_bulk_load_table.call_args_list]
+    assert calls == [
+        (
+            "dim_design",
+            "design_record_id",
+            ["2024-02-15T11:00:00/design.pqt"],
+        ),
+        (
+            "fact_sales_order",
+            "sales_record_id",
+            [
+                "2024-02-15T10:00:00/sales_order.pqt",
+                "2024-02-15T11:00:00/sales_order.pqt",
+            ],
+        ),
+    ]
@@ -0,0 +1,313 @@
+import json
+import os
+from datetime import date, time
+from io import BytesIO
+from unittest.mock import patch
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+from src.coalesce import (
+    advance_watermark,
+    coalesce_frames,
+    coalesced_key,
+    get_watermark,
+    lambda_handler,
+    late_horizon,
+    list_pending_files,
+    load_pending,
+    run_of,
+    save_watermark,
+)
+from src.load_coordinator import LOADED, static_dependencies
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        client = boto3.client("s3")
+        for bucket in ["processed", "control_bucket"]:
+            client.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration={
+                    "LocationConstraint": "eu-west-2"
+                },
+            )
+        yield client
+
+
+def put_frame(client, key, df):
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False)
+    client.put_object(Bucket="processed", Key=key, Body=buffer.getvalue())
+
+
+def design_frame(ids, names, day, seconds):
+    return pd.DataFrame(
+        {
+            "design_record_id": ids,
+            "design_name": names,
+            "last_updated_date": [day] * len(ids),
+            "last_updated_time": [time(0, 0, seconds)] * len(ids),
+        }
+    )
+
+
+def test_run_of_both_layouts():
+    assert run_of("2024-02-15T19:01:53/design.pqt") == "2024-02-15T19:01:53"
+    assert (
+        run_of(
+            "table=sales_order/last_updated_date=2024-02-15/"
+            "2024-02-15T19:01:53.pqt"
+        )
+        == "2024-02-15T19:01:53"
+    )
+    assert run_of("compacted/2024-02-15/design.pqt") is None
+    assert run_of("2024-02-15T19:01:53/design.profile.json") is None
+
+
+def test_watermark_round_trip(s3):
+    assert get_watermark(s3, "control_bucket", "design") == {
+        "run": "",
+        "loaded": [],
+    }
+    watermark = {
+        "run": "2024-02-15T19:01:53",
+        "loaded": ["2024-02-15T19:01:53/design.pqt"],
+    }
+
+    save_watermark(s3, "control_bucket", "design", watermark)
+
+    assert get_watermark(s3, "control_bucket", "design") == watermark
+
+
+def test_advance_watermark_forgets_keys_past_the_late_horizon():
+    watermark = {
+        "run": "2024-02-15T10:00:00",
+        "loaded": [
+            "2024-02-14T09:00:00/design.pqt",
+            "2024-02-15T10:00:00/design.pqt",
+        ],
+    }
+
+    assert late_horizon("2024-02-15T11:00:00") == "2024-02-14T11:00:00"
+    assert advance_watermark(
+        watermark,
+        ["2024-02-15T09:30:00/design.pqt", "2024-02-15T11:00:00/design.pqt"],
+    ) == {
+        "run": "2024-02-15T11:00:00",
+        "loaded": [
+            "2024-02-15T09:30:00/design.pqt",
+            "2024-02-15T10:00:00/design.pqt",
+            "2024-02-15T11:00:00/design.pqt",
+        ],
+    }
+
+
+def test_list_pending_files_only_after_watermark(s3):
+    keys = [
+        "2024-02-15T10:00:00/design.pqt",
+        "2024-02-15T11:00:00/design.pqt",
+        "2024-02-15T11:00:00/design.profile.json",
+        "2024-02-15T09:00:00/staff.pqt",
+        "compacted/2024-02-15/design.pqt",
+        "table=sales_order/last_updated_date=2024-02-15/"
+        "2024-02-15T11:00:00.pqt",
+        "table=sales_order/last_updated_date=2024-02-14/"
+        "2024-02-15T10:00:00.pqt",
+    ]
+    for key in keys:
+        s3.put_object(Bucket="processed", Key=key, Body=b"")
+    for key in keys[5:]:
+        s3.put_object(
+            Bucket="processed",
+            Key=f"{run_of(key)}/sales_order.manifest.json",
+            Body=json.dumps([key]),
+        )
+
+    pending = list_pending_files(
+        s3,
+        "processed",
+        {
+            "design": {
+                "run": "2024-02-15T10:00:00",
+                "loaded": ["2024-02-15T10:00:00/design.pqt"],
+            },
+            "sales_order": {"run": "", "loaded": []},
+        },
+    )
+
+    assert pending == {
+        "design": ["2024-02-15T11:00:00/design.pqt"],
+        "sales_order": [
+            "table=sales_order/last_updated_date=2024-02-14/"
+            "2024-02-15T10:00:00.pqt",
+            "table=sales_order/last_updated_date=2024-02-15/"
+            "2024-02-15T11:00:00.pqt",
+        ],
+    }
+
+
+def test_list_pending_files_picks_up_late_arrivals(s3):
+    keys = [
+        "2024-02-13T10:00:00/design.pqt",
+        "2024-02-15T10:00:00/design.pqt",
+        # transformed after the 11:00 run was loaded
+        "2024-02-15T10:30:00/design.pqt",
+        "2024-02-15T11:00:00/design.pqt",
+    ]
+    for key in keys:
+        s3.put_object(Bucket="processed", Key=key, Body=b"")
+    watermark = {"run": "2024-02-15T11:00:00", "loaded": [keys[1], keys[3]]}
+
+    pending = list_pending_files(s3, "processed", {"design": watermark})
+
+    assert pending == {"design": [keys[2]]}
+
+
+def test_coalesce_frames_keeps_latest_version():
+    day = date(2024, 2, 15)
+    frames = [
+        design_frame([1, 2, 3], ["a1", "b1", "c1"], day, 1),
+        # row 1 arrives again in a later file but with an older edit
+        design_frame([2, 1], ["b2", "a0"], day, 2)
+        .assign(last_updated_time=[time(0, 0, 2), time(0, 0, 0)]),
+        design_frame([2], ["b3"], day, 2),
+    ]
+
+    df = coalesce_frames(frames, "design_record_id")
+    df = df.sort_values("design_record_id")
+
+    assert df["design_record_id"].tolist() == [1, 2, 3]
+    # ties on last_updated go to the later file
+    assert df["design_name"].tolist() == ["a1", "b3", "c1"]
+    assert "_file_order" not in df.columns
+
+
+def test_coalesce_frames_without_last_updated_uses_file_order():
+    frames = [
+        pd.DataFrame({"date_id": [1, 2], "year": [2023, 2023]}),
+        pd.DataFrame({"date_id": [2], "year": [2024]}),
+    ]
+
+    df = coalesce_frames(frames, "date_id").sort_values("date_id")
+
+    assert df["year"].tolist() == [2023, 2024]
+
+
+@patch("src.coalesce.load_frame")
+def test_load_pending_loads_once_and_advances_watermark(
+    mock_load_frame, s3
+):
+    day = date(2024, 2, 15)
+    keys = [
+        "2024-02-15T10:00:00/design.pqt",
+        "2024-02-15T11:00:00/design.pqt",
+    ]
+    put_frame(s3, keys[0], design_frame([1, 2], ["a1", "b1"], day, 1))
+    put_frame(s3, keys[1], design_frame([1], ["a2"], day, 2))
+    mock_load_frame.return_value = "Loaded"
+
+    assert load_pending(s3, "processed", "control_bucket", "design", keys)
+
+    mock_load_frame.assert_called_once()
+    df, table_name, primary_key, file_key = mock_load_frame.call_args.args
+    assert (table_name, primary_key) == ("dim_design", "design_record_id")
+    assert file_key == coalesced_key("design", keys)
+    assert sorted(df["design_name"]) == ["a2", "b1"]
+    assert get_watermark(s3, "control_bucket", "design") == {
+        "run": "2024-02-15T11:00:00",
+        "loaded": keys,
+    }
+
+
+def test_coalesced_key_covers_the_whole_set():
+    keys = [
+        "2024-02-15T10:00:00/design.pqt",
+        "2024-02-15T11:00:00/design.pqt",
+    ]
+
+    assert coalesced_key("design", keys) == coalesced_key(
+        "design", keys[::-1]
+    )
+    assert coalesced_key("design", keys) != coalesced_key(
+        "design", keys[1:]
+    )
+    assert coalesced_key("design", keys) not in keys
+    assert coalesced_key("design", keys).endswith(".pqt")
+
+
+@patch("src.coalesce.load_frame")
+def test_load_pending_keeps_watermark_on_failure(mock_load_frame, s3):
+    key = "2024-02-15T10:00:00/design.pqt"
+    put_frame(s3, key, design_frame([1], ["a1"], date(2024, 2, 15), 1))
+    mock_load_frame.return_value = None
+
+    assert not load_pending(
+        s3, "processed", "control_bucket", "design", [key]
+    )
+    assert get_watermark(s3, "control_bucket", "design")["run"] == ""
+
+
+@patch("src.coalesce.dependency_graph")
+@patch("src.coalesce.load_pending")
+def test_lambda_handler_loads_pending_tables_in_order(
+    mock_load_pending, mock_dependency_graph, s3
+):
+    for key in [
+        "2024-02-15T10:00:00/sales_order.pqt",
+        "2024-02-15T10:00:00/design.pqt",
+        "2024-02-15T11:00:00/design.pqt",
+    ]:
+        s3.put_object(Bucket="processed", Key=key, Body=b"")
+    mock_dependency_graph.return_value = static_dependencies()
+    mock_load_pending.return_value = True
+
+    with patch.dict(os.environ, {"S3_CONTROL_BUCKET": "control_bucket"}):
+        outcomes = lambda_handler({"bucket": "processed"}, {})
+
+    assert outcomes == {"dim_design": LOADED, "fact_sales_order": LOADED}
+    calls = [call.args[3:] for call in mock_load_pending.call_args_list]
+    assert calls == [
+        (
+            "design",
+            [
+                "2024-02-15T10:00:00/design.pqt",
+                "2024-02-15T11:00:00/design.pqt",
+            ],
+        ),
+        ("sales_order", ["2024-02-15T10:00:00/sales_order.pqt"]),
+    ]
+
+
+@patch("src.coalesce.dependency_graph")
+@patch("src.coalesce.load_pending")
+def test_lambda_handler_loads_every_source_of_a_target(
+    mock_load_pending, mock_dependency_graph, s3
+):
+    for key in [
+        "2024-02-15T10:00:00/date_payment.pqt",
+        "2024-02-15T10:00:00/date_sales_order.pqt",
+        "2024-02-15T10:00:00/sales_order.pqt",
+    ]:
+        s3.put_object(Bucket="processed", Key=key, Body=b"")
+    mock_dependency_graph.return_value = static_dependencies()
+    mock_load_pending.return_value = True
+
+    with patch.dict(os.environ, {"S3_CONTROL_BUCKET": "control_bucket"}):
+        outcomes = lambda_handler({"bucket": "processed"}, {})
+
+    assert outcomes == {"dim_date": LOADED, "fact_sales_order": LOADED}
+    tables = [call.args[3] for call in mock_load_pending.call_args_list]
+    assert tables == ["date_payment", "date_sales_order", "sales_order"]
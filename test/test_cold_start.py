@@ -0,0 +1,65 @@
+import json
+import pytest
+from scripts.cold_start import (
+    BUDGET,
+    HANDLERS,
+    over_budget,
+    parse_importtime,
+    profile_import,
+    top_imports,
+)
+
+
+def test_parse_importtime_of_logs():
+    lines = [
+        "START RequestId: 1",
+        "import time: self [us] | cumulative | imported package",
+        "import time:       361 |     263404 |   pandas",
+        "\timport time:      1578 |     364918 | extractor",
+    ]
+
+    imports = parse_importtime(lines)
+
+    assert imports == [
+        ("pandas", 0.000361, 0.263404, 1),
+        ("extractor", 0.001578, 0.364918, 0),
+    ]
+    assert top_imports(imports, 1) == [imports[1]]
+    assert top_imports(imports, 5, depth=1) == [imports[0]]
+
+
+def test_over_budget():
+    budget = {"loader": {"import_relative": 0.2, "deferred": ["pyarrow"]}}
+    results = {
+        "loader": {
+            "seconds": 0.5,
+            "relative": 0.5,
+            "modules": {"pandas", "pyarrow"},
+            "clients": ["s3"],
+        },
+        "unbudgeted": {
+            "seconds": 9.0,
+            "relative": 9.0,
+            "modules": set(),
+            "clients": [],
+        },
+    }
+
+    assert over_budget(results, budget, 0.5) == [
+        "loader imported in 0.50 references, budget 0.20",
+        "loader imports pyarrow at load",
+        "loader creates its s3 client at load",
+    ]
+    assert over_budget(results, budget, 2.0) == over_budget(
+        results, budget, 0.5
+    )[1:]
+
+
+@pytest.mark.parametrize("handler", HANDLERS)
+def test_handlers_defer_what_their_budget_says(handler):
+    budget = json.loads(BUDGET.read_text())[handler]
+
+    result = profile_import(handler)
+
+    assert not result["modules"] & set(budget["deferred"])
+    assert result["clients"] == []
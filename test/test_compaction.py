@@ -0,0 +1,219 @@
+import json
+import os
+from datetime import datetime
+from io import BytesIO
+from unittest.mock import patch
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+from src.compaction import (
+    MANIFEST_KEY,
+    compact_bucket,
+    compact_window,
+    get_manifest,
+    group_keys,
+    lambda_handler,
+    parse_key,
+)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def bucket(s3):
+    name = "test-ingestion"
+    s3.create_bucket(
+        Bucket=name,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return name
+
+
+def put_run(s3, bucket, key, ids, updated):
+    df = pd.DataFrame(
+        {
+            "design_id": ids,
+            "design_name": [f"Design {i}" for i in ids],
+            "last_updated": pd.to_datetime(updated),
+        }
+    )
+    buffer = BytesIO()
+    df.to_parquet(buffer)
+    s3.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+
+def read_compacted(s3, bucket, key):
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    return pq.read_table(BytesIO(body)).to_pandas()
+
+
+def test_parse_key():
+    assert parse_key("2024-02-15T19:01:53/address.pqt") == (
+        datetime(2024, 2, 15, 19, 1, 53),
+        "address",
+    )
+    assert parse_key("compacted/2024-02-15/address.pqt") is None
+    assert parse_key("2024-02-15T19:01:53/address.profile.json") is None
+    assert parse_key("last_successful_extraction.txt") is None
+
+
+def test_group_keys_by_table_and_window():
+    keys = [
+        "2024-02-15T19:15:00/design.pqt",
+        "2024-02-15T19:00:00/design.pqt",
+        "2024-02-16T00:00:00/design.pqt",
+        "2024-02-15T19:00:00/staff.pqt",
+        "compacted/2024-02-14/design.pqt",
+    ]
+
+    groups = group_keys(keys, "day")
+
+    assert groups == {
+        ("design", "2024-02-15"): [
+            "2024-02-15T19:00:00/design.pqt",
+            "2024-02-15T19:15:00/design.pqt",
+        ],
+        ("design", "2024-02-16"): ["2024-02-16T00:00:00/design.pqt"],
+        ("staff", "2024-02-15"): ["2024-02-15T19:00:00/staff.pqt"],
+    }
+
+
+def test_group_keys_leaves_open_window_alone():
+    keys = [
+        "2024-02-15T19:00:00/design.pqt",
+        "2024-02-16T00:00:00/design.pqt",
+    ]
+
+    groups = group_keys(keys, "day", until="2024-02-16")
+
+    assert list(groups) == [("design", "2024-02-15")]
+
+
+def test_compact_bucket_merges_and_sorts(s3, bucket):
+    put_run(
+        s3, bucket, "2024-02-15T19:15:00/design.pqt",
+        [2, 1], ["2024-02-15 19:10", "2024-02-15 19:05"],
+    )
+    put_run(
+        s3, bucket, "2024-02-15T19:00:00/design.pqt",
+        [3], ["2024-02-15 18:55"],
+    )
+
+    manifests = compact_bucket(s3, bucket, "day")
+
+    assert len(manifests) == 1
+    assert manifests[0]["rows"] == 3
+    result = read_compacted(s3, bucket, "compacted/2024-02-15/design.pqt")
+    assert list(result["design_id"]) == [3, 1, 2]
+
+    body = s3.get_object(
+        Bucket=bucket, Key="compacted/2024-02-15/design.pqt"
+    )["Body"].read()
+    metadata = pq.read_metadata(BytesIO(body)).metadata
+    assert json.loads(metadata[MANIFEST_KEY])["source_keys"] == [
+        "2024-02-15T19:00:00/design.pqt",
+        "2024-02-15T19:15:00/design.pqt",
+    ]
+    assert get_manifest(s3, bucket, "design", "2024-02-15") == manifests[0]
+
+
+def test_compact_bucket_is_incremental(s3, bucket):
+    put_run(
+        s3, bucket, "2024-02-15T19:00:00/design.pqt",
+        [1], ["2024-02-15 18:55"],
+    )
+    compact_bucket(s3, bucket, "day")
+
+    assert compact_bucket(s3, bucket, "day") == []
+
+    put_run(
+        s3, bucket, "2024-02-15T20:00:00/design.pqt",
+        [2], ["2024-02-15 19:55"],
+    )
+    manifests = compact_bucket(s3, bucket, "day")
+
+    assert manifests[0]["rows"] == 2
+    assert len(manifests[0]["source_keys"]) == 2
+    result = read_compacted(s3, bucket, "compacted/2024-02-15/design.pqt")
+    assert list(result["design_id"]) == [1, 2]
+
+
+def test_compact_bucket_deletes_sources(s3, bucket):
+    key = "2024-02-15T19:00:00/design.pqt"
+    put_run(s3, bucket, key, [1], ["2024-02-15 18:55"])
+
+    compact_bucket(s3, bucket, "day", delete_sources=True)
+
+    keys = [
+        item["Key"]
+        for item in s3.list_objects_v2(Bucket=bucket)["Contents"]
+    ]
+    assert key not in keys
+    assert "compacted/2024-02-15/design.pqt" in keys
+
+
+def test_compact_window_retries_failed_deletes(s3, bucket):
+    key = "2024-02-15T19:00:00/design.pqt"
+    put_run(s3, bucket, key, [1], ["2024-02-15 18:55"])
+    with patch.object(s3, "delete_object", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            compact_window(s3, bucket, "design", "2024-02-15", [key], True)
+
+    # the rows are not compacted twice, the source goes this time
+    assert compact_window(
+        s3, bucket, "design", "2024-02-15", [key], True
+    ) is None
+    result = read_compacted(s3, bucket, "compacted/2024-02-15/design.pqt")
+    assert list(result["design_id"]) == [1]
+    assert "Contents" not in s3.list_objects_v2(Bucket=bucket, Prefix="2024")
+
+
+def test_compact_window_casts_to_the_newest_schema(s3, bucket):
+    keys = ["2024-02-15T19:00:00/transaction.pqt",
+            "2024-02-15T20:00:00/transaction.pqt"]
+    old = pd.DataFrame({"transaction_id": [1, 2],
+                        "sales_order_id": [5.0, None]})
+    new = pd.DataFrame({"transaction_id": [3],
+                        "sales_order_id": pd.array([None], "Int64")})
+    for key, df in zip(keys, [old, new]):
+        buffer = BytesIO()
+        df.to_parquet(buffer)
+        s3.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+
+    compact_window(s3, bucket, "transaction", "2024-02-15", keys)
+
+    body = s3.get_object(
+        Bucket=bucket, Key="compacted/2024-02-15/transaction.pqt"
+    )["Body"].read()
+    table = pq.read_table(BytesIO(body))
+    assert table.schema.field("sales_order_id").type == pa.int64()
+    assert table.column("sales_order_id").to_pylist() == [5, None, None]
+
+
+@patch("src.compaction.compact_bucket")
+def test_lambda_handler(mock_compact_bucket):
+    mock_compact_bucket.return_value = []
+
+    lambda_handler({"bucket": "processed", "window": "hour"}, {})
+
+    args = mock_compact_bucket.call_args[0]
+    assert args[1] == "processed"
+    assert args[2] == "hour"
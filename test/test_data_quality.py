@@ -0,0 +1,98 @@
+import json
+import os
+from datetime import date
+from decimal import Decimal
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pytest
+from moto import mock_aws
+from src.data_quality import profile_key, profile_table, upload_profile
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def batch():
+    df = pd.DataFrame(
+        {
+            "sales_record_id": [1, 2, 2, 3],
+            "units_sold": [10, None, 30, 40],
+            "unit_price": [
+                Decimal("1.50"),
+                Decimal("2.00"),
+                Decimal("0.75"),
+                None,
+            ],
+            "created_date": [
+                date(2024, 1, 2),
+                date(2024, 1, 1),
+                date(2024, 1, 3),
+                date(2024, 1, 2),
+            ],
+            "currency": ["GBP", "EUR", None, "USD"],
+            "paid": [True, False, True, None],
+        }
+    )
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def test_profile_table_counts(batch):
+    profile = profile_table(batch, "sales_record_id")
+
+    assert profile["rows"] == 4
+    assert profile["distinct_keys"] == 3
+    assert profile["duplicate_key_count"] == 1
+    assert profile["duplicate_keys"] == [2]
+
+
+def test_profile_table_columns(batch):
+    columns = profile_table(batch, "sales_record_id")["columns"]
+
+    assert columns["units_sold"]["null_count"] == 1
+    assert columns["units_sold"]["min"] == 10
+    assert columns["units_sold"]["max"] == 40
+    assert columns["unit_price"]["min"] == Decimal("0.75")
+    assert columns["created_date"]["max"] == date(2024, 1, 3)
+    assert columns["currency"]["min"] == "EUR"
+    assert columns["paid"] == {"type": "bool", "null_count": 1}
+
+
+def test_profile_table_all_null_column():
+    table = pa.table({"id": [1, 2], "empty": pa.array([None, None], "int64")})
+
+    columns = profile_table(table, "id")["columns"]
+
+    assert columns["empty"] == {"type": "int64", "null_count": 2}
+
+
+def test_upload_profile_writes_sidecar(s3, batch):
+    bucket = "test-transformed"
+    s3.create_bucket(
+        Bucket=bucket,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    key = "2024-02-15T19:01:53/sales_order.pqt"
+
+    upload_profile(s3, bucket, key, profile_table(batch, "sales_record_id"))
+
+    assert profile_key(key) == "2024-02-15T19:01:53/sales_order.profile.json"
+    body = s3.get_object(Bucket=bucket, Key=profile_key(key))["Body"].read()
+    profile = json.loads(body)
+    assert profile["columns"]["created_date"]["min"] == "2024-01-01"
+    assert profile["columns"]["unit_price"]["max"] == "2.00"
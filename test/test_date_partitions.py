@@ -0,0 +1,385 @@
+import os
+import threading
+from configparser import ConfigParser
+from datetime import date
+from unittest.mock import patch
+import pandas as pd
+import pyarrow as pa
+import pytest
+from t_utils import inhibit_CI
+# the loader shares the partition state of the module it imports
+from date_partitions import (
+    create_partition,
+    detach_partition,
+    ensure_partitions,
+    get_partitions,
+    known_partitions,
+    months_of,
+    next_month,
+    partition_columns,
+    partition_name,
+    partition_table,
+)
+from aggregates import ensure_aggregates, installed, is_installed
+from src.loader import (
+    arrow_copy_insertion,
+    conflict_clause,
+    get_connection,
+    load_frame,
+    prepare_partitions,
+)
+
+
+@pytest.fixture(scope="function")
+def mockdb_creds():
+    """Mocked Database Credentials for local testing."""
+
+    config = ConfigParser()
+    config.read(".env.ini")
+    section = config["DEFAULT"]
+
+    os.environ["PGUSER2"] = section["PGUSER"]
+    os.environ["PGPASSWORD2"] = section["PGPASSWORD"]
+    os.environ["PGHOST2"] = "127.0.0.1"
+    os.environ["PGDATABASE2"] = "totesys_test_subset"
+
+
+@pytest.fixture(scope="function")
+def payments(mockdb_creds):
+    con = get_connection()
+    drop = (
+        "DROP TABLE IF EXISTS payment_refund, fact_payment, "
+        "fact_payment_2024_01, agg_daily_payments, dim_currency;"
+    )
+    con.run(drop)
+    con.run(
+        """
+        CREATE TABLE fact_payment (
+            payment_record_id SERIAL PRIMARY KEY,
+            created_date DATE,
+            currency_record_id INT,
+            counterparty_record_id INT,
+            payment_amount NUMERIC(10, 2)
+        );
+        """
+    )
+    con.run(
+        """
+        INSERT INTO fact_payment VALUES
+        (1, '2024-01-15', 1, 1, 10.00),
+        (2, '2024-02-15', 1, 1, 20.00);
+        """
+    )
+    partition_columns.clear()
+    known_partitions.clear()
+    installed.clear()
+    yield con
+    partition_columns.clear()
+    known_partitions.clear()
+    installed.clear()
+    con.run(drop)
+    con.close()
+
+
+def payment_frame(ids, days, amounts):
+    return pd.DataFrame(
+        {
+            "payment_record_id": ids,
+            "created_date": days,
+            "currency_record_id": [1] * len(ids),
+            "counterparty_record_id": [1] * len(ids),
+            "payment_amount": amounts,
+        }
+    )
+
+
+def rows_by_partition(con):
+    return con.run(
+        "SELECT CAST(tableoid AS regclass), payment_record_id, "
+        "CAST(payment_amount AS TEXT) "
+        "FROM fact_payment ORDER BY payment_record_id"
+    )
+
+
+def test_partition_name_and_months():
+    assert partition_name("fact_payment", date(2024, 2, 1)) == (
+        "fact_payment_2024_02"
+    )
+    assert next_month(date(2023, 12, 1)) == date(2024, 1, 1)
+    days = [date(2024, 2, 29), None, date(2024, 2, 1), date(2023, 12, 31)]
+    months = {date(2024, 2, 1), date(2023, 12, 1)}
+    assert months_of(pd.Series(days, dtype=object)) == months
+    assert months_of(pd.Series(pd.to_datetime(days))) == months
+    assert months_of(pa.chunked_array([pa.array(days)])) == months
+
+
+@patch("src.loader.ensure_partitions")
+@patch("src.loader.partition_column")
+@patch("src.loader.warm_connection")
+def test_prepare_partitions_off_by_default(
+    mock_warm_connection, mock_partition_column, mock_ensure_partitions
+):
+    df = payment_frame([1], [date(2024, 1, 1)], [1.0])
+    mock_partition_column.side_effect = (
+        lambda con, table_name: partition_columns.setdefault(
+            table_name, "created_date"
+        )
+    )
+
+    with patch.dict(partition_columns, clear=True):
+        with patch.dict(os.environ, {"LOAD_DATE_PARTITIONS": "false"}):
+            prepare_partitions("fact_payment", df)
+            # looked up once, the upserts need it whatever the flag
+            assert partition_columns == {"fact_payment": "created_date"}
+            prepare_partitions("fact_payment", df)
+        with patch.dict(os.environ, {"LOAD_DATE_PARTITIONS": "true"}):
+            with patch.dict(partition_columns, {"dim_design": None}):
+                prepare_partitions("dim_design", df)
+
+    mock_warm_connection.assert_called_once()
+    mock_ensure_partitions.assert_not_called()
+
+
+def test_conflict_clause_includes_partition_column():
+    with patch.dict(partition_columns, {"fact_payment": "created_date"}):
+        clause = conflict_clause(
+            "fact_payment",
+            "payment_record_id",
+            ["payment_record_id", "created_date", "payment_amount"],
+        )
+
+    assert clause.startswith(
+        "ON CONFLICT (payment_record_id, created_date)\n"
+        "    DO UPDATE SET payment_amount = EXCLUDED.payment_amount\n"
+    )
+
+
+@inhibit_CI
+def test_partition_table_moves_rows_into_monthly_partitions(payments):
+    created = partition_table(payments, "fact_payment", "payment_record_id")
+
+    assert created == ["fact_payment_2024_01", "fact_payment_2024_02"]
+    assert rows_by_partition(payments) == [
+        ["fact_payment_2024_01", 1, "10.00"],
+        ["fact_payment_2024_02", 2, "20.00"],
+    ]
+    assert partition_columns == {"fact_payment": "created_date"}
+    # the serial default survived the old table
+    payments.run(
+        "INSERT INTO fact_payment (created_date) VALUES ('2024-01-01')"
+    )
+    assert payments.run("SELECT max(payment_record_id) FROM fact_payment")
+
+
+@inhibit_CI
+@pytest.mark.parametrize("load_mode", ["row", "copy", "binary"])
+def test_loads_create_partitions_and_upsert_within_them(
+    payments, load_mode, caplog
+):
+    partition_table(payments, "fact_payment", "payment_record_id")
+    # a new process, the partitioning is found in the catalog
+    partition_columns.clear()
+    known_partitions.clear()
+    df = payment_frame(
+        [2, 3, 4],
+        [date(2024, 2, 15), date(2024, 3, 1), date(2024, 5, 31)],
+        [25.5, 30.0, 40.0],
+    )
+
+    env = {"LOAD_MODE": load_mode, "LOAD_DATE_PARTITIONS": "true"}
+
+    with patch.dict(os.environ, env):
+        with caplog.at_level("INFO"):
+            assert load_frame(df, "fact_payment", "payment_record_id", "k")
+
+    if load_mode == "row":
+        assert "3 inserted or updated" in caplog.text
+    else:
+        assert "2 inserted, 1 updated, 0 unchanged" in caplog.text
+
+    assert rows_by_partition(payments) == [
+        ["fact_payment_2024_01", 1, "10.00"],
+        ["fact_payment_2024_02", 2, "25.50"],
+        ["fact_payment_2024_03", 3, "30.00"],
+        ["fact_payment_2024_05", 4, "40.00"],
+    ]
+    assert "fact_payment_2024_04" not in get_partitions(
+        payments, "fact_payment"
+    )
+
+
+@inhibit_CI
+@pytest.mark.parametrize("load_mode", ["row", "copy", "binary"])
+def test_loads_into_partitioned_table_with_flag_off(payments, load_mode):
+    partition_table(payments, "fact_payment", "payment_record_id")
+    # a new process, LOAD_DATE_PARTITIONS unset
+    partition_columns.clear()
+    known_partitions.clear()
+    df = payment_frame([1, 2], [date(2024, 1, 15), date(2024, 2, 15)],
+                       [11.0, 22.0])
+
+    with patch.dict(os.environ, {"LOAD_MODE": load_mode}):
+        os.environ.pop("LOAD_DATE_PARTITIONS", None)
+        assert load_frame(df, "fact_payment", "payment_record_id", "k")
+
+    assert rows_by_partition(payments) == [
+        ["fact_payment_2024_01", 1, "11.00"],
+        ["fact_payment_2024_02", 2, "22.00"],
+    ]
+
+
+@inhibit_CI
+def test_ensure_partitions_skips_known_months(payments):
+    partition_table(payments, "fact_payment", "payment_record_id")
+    values = pa.array([date(2024, 2, 3), date(2024, 4, 3)])
+
+    assert ensure_partitions(payments, "fact_payment", values) == [
+        "fact_payment_2024_04"
+    ]
+    with patch.object(payments, "run") as mock_run:
+        assert ensure_partitions(payments, "fact_payment", values) == []
+    mock_run.assert_not_called()
+
+
+@inhibit_CI
+def test_detached_partition_keeps_its_rows(payments):
+    partition_table(payments, "fact_payment", "payment_record_id")
+
+    detach_partition(payments, "fact_payment", date(2024, 1, 1))
+
+    assert payments.run("SELECT payment_record_id FROM fact_payment") == [
+        [2]
+    ]
+    assert payments.run(
+        "SELECT payment_record_id FROM fact_payment_2024_01"
+    ) == [[1]]
+
+
+@inhibit_CI
+def test_partitioning_keeps_summary_triggers(payments):
+    ensure_aggregates(payments, "fact_payment")
+
+    partition_table(payments, "fact_payment", "payment_record_id")
+
+    assert "agg_daily_payments" in installed
+    assert is_installed(payments, "agg_daily_payments")
+    payments.run(
+        "INSERT INTO fact_payment VALUES (3, '2024-01-15', 1, 1, 5.00)"
+    )
+    assert payments.run(
+        "SELECT CAST(payment_amount AS TEXT), row_count "
+        "FROM agg_daily_payments WHERE created_date = '2024-01-15'"
+    ) == [["15.00", 2]]
+
+
+@inhibit_CI
+def test_partitioning_recreates_indexes_and_foreign_keys(payments):
+    payments.run(
+        "CREATE TABLE dim_currency (currency_record_id INT PRIMARY KEY);"
+        "INSERT INTO dim_currency VALUES (1);"
+        "ALTER TABLE fact_payment ADD CONSTRAINT payment_currency_fk "
+        "FOREIGN KEY (currency_record_id) REFERENCES dim_currency;"
+        "ALTER TABLE fact_payment ADD CONSTRAINT payment_day_key "
+        "UNIQUE (payment_record_id, created_date);"
+        "CREATE INDEX payment_amount_idx ON fact_payment (payment_amount);"
+        "CREATE TABLE payment_refund (payment_record_id INT, "
+        "created_date DATE, CONSTRAINT refund_payment_fk "
+        "FOREIGN KEY (payment_record_id, created_date) "
+        "REFERENCES fact_payment (payment_record_id, created_date));"
+        "INSERT INTO payment_refund VALUES (1, '2024-01-15');"
+    )
+
+    partition_table(payments, "fact_payment", "payment_record_id")
+
+    assert payments.run(
+        "SELECT conname FROM pg_constraint WHERE contype = 'f' "
+        "AND 'fact_payment' IN (CAST(conrelid AS regclass)::TEXT, "
+        "CAST(confrelid AS regclass)::TEXT) ORDER BY conname"
+    ) == [["payment_currency_fk"], ["refund_payment_fk"]]
+    assert payments.run(
+        "SELECT indexname FROM pg_indexes "
+        "WHERE tablename = 'fact_payment' ORDER BY indexname"
+    ) == [
+        ["fact_payment_pkey"],
+        ["payment_amount_idx"],
+        ["payment_day_key"],
+    ]
+    with pytest.raises(Exception):
+        payments.run(
+            "INSERT INTO fact_payment VALUES (3, '2024-01-15', 9, 1, 1.00)"
+        )
+
+
+@inhibit_CI
+def test_failed_partitioning_rolls_back(payments):
+    # a unique index without the partition column can't be recreated
+    payments.run(
+        "CREATE UNIQUE INDEX payment_amount_key ON fact_payment "
+        "(payment_amount);"
+    )
+
+    with pytest.raises(Exception):
+        partition_table(payments, "fact_payment", "payment_record_id")
+
+    assert get_partitions(payments, "fact_payment") == set()
+    assert payments.run("SELECT count(*) FROM fact_payment") == [[2]]
+
+
+@inhibit_CI
+def test_create_partition_races_within_a_transaction(payments):
+    partition_table(payments, "fact_payment", "payment_record_id")
+    other = get_connection()
+    month = date(2024, 3, 1)
+    payments.run("START TRANSACTION")
+    create_partition(payments, "fact_payment", month)
+
+    errors = []
+
+    def create_meanwhile():
+        other.run("START TRANSACTION")
+        try:
+            # waits for the first creation, then finds it done
+            create_partition(other, "fact_payment", month)
+            other.run("SELECT 1")
+            other.run("COMMIT")
+        except Exception as e:
+            errors.append(e)
+            other.run("ROLLBACK")
+
+    thread = threading.Thread(target=create_meanwhile)
+    thread.start()
+    thread.join(0.5)
+    payments.run("COMMIT")
+    thread.join()
+    other.close()
+
+    assert errors == []
+    assert "fact_payment_2024_03" in get_partitions(payments, "fact_payment")
+
+
+@inhibit_CI
+def test_summaries_are_maintained_across_partitions(payments, caplog):
+    partition_table(payments, "fact_payment", "payment_record_id")
+    ensure_aggregates(payments, "fact_payment")
+    table = pa.Table.from_pandas(
+        payment_frame(
+            [1, 5], [date(2024, 1, 15), date(2024, 6, 1)], [15.0, 5.0]
+        ),
+        preserve_index=False,
+    )
+
+    with patch.dict(os.environ, {"LOAD_DATE_PARTITIONS": "true"}):
+        with caplog.at_level("INFO"):
+            assert arrow_copy_insertion(
+                table, "fact_payment", "payment_record_id"
+            )
+
+    assert "1 inserted, 1 updated, 0 unchanged" in caplog.text
+    assert payments.run(
+        "SELECT created_date, CAST(payment_amount AS TEXT), row_count "
+        "FROM agg_daily_payments ORDER BY created_date"
+    ) == [
+        [date(2024, 1, 15), "15.00", 1],
+        [date(2024, 2, 15), "20.00", 1],
+        [date(2024, 6, 1), "5.00", 1],
+    ]
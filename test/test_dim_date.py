@@ -0,0 +1,184 @@
+import os
+from datetime import date
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+from moto import mock_aws
+from src.dim_date import (
+    EMITTED_RANGES_PREFIX,
+    MAX_RANGE_PARTS,
+    batch_date_range,
+    dates_key,
+    emit_dim_date,
+    generate_dim_date,
+    load_ranges,
+    merge_ranges,
+    missing_ranges,
+    save_ranges,
+)
+from src.loader import get_table_name, table_relations
+
+
+def d(value):
+    return np.datetime64(value, "D")
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def bucket(s3):
+    name = "test-control"
+    s3.create_bucket(
+        Bucket=name,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return name
+
+
+def test_generate_dim_date():
+    table = generate_dim_date(d("2023-12-31"), d("2024-01-02")).to_pylist()
+
+    assert len(table) == 3
+    assert table[0] == {
+        "date_id": date(2023, 12, 31),
+        "year": 2023,
+        "month": 12,
+        "day": 31,
+        "day_of_week": 7,
+        "day_name": "Sunday",
+        "month_name": "December",
+        "quarter": 4,
+    }
+    assert table[2]["date_id"] == date(2024, 1, 2)
+    assert table[2]["day_name"] == "Tuesday"
+    assert table[2]["quarter"] == 1
+
+
+def test_generate_dim_date_matches_calendar():
+    rows = generate_dim_date(d("2024-01-01"), d("2024-12-31")).to_pylist()
+
+    for row in rows:
+        day = row["date_id"]
+        assert (row["year"], row["month"], row["day"]) == (
+            day.year, day.month, day.day,
+        )
+        assert row["day_of_week"] == day.isoweekday()
+        assert row["quarter"] == (day.month - 1) // 3 + 1
+
+
+def test_batch_date_range():
+    df = pd.DataFrame(
+        {
+            "created_date": [date(2024, 2, 3), date(2024, 2, 1)],
+            "agreed_delivery_date": ["2024-02-09", None],
+            "units_sold": [1, 2],
+        }
+    )
+
+    assert batch_date_range(df) == (d("2024-02-01"), d("2024-02-09"))
+    assert batch_date_range(df[["units_sold"]]) is None
+
+
+def test_merge_and_missing_ranges():
+    ranges = merge_ranges(
+        [
+            (d("2024-01-05"), d("2024-01-06")),
+            (d("2024-01-01"), d("2024-01-02")),
+            (d("2024-01-03"), d("2024-01-03")),
+        ]
+    )
+    assert ranges == [
+        (d("2024-01-01"), d("2024-01-03")),
+        (d("2024-01-05"), d("2024-01-06")),
+    ]
+
+    assert missing_ranges(d("2024-01-02"), d("2024-01-08"), ranges) == [
+        (d("2024-01-04"), d("2024-01-04")),
+        (d("2024-01-07"), d("2024-01-08")),
+    ]
+    assert missing_ranges(d("2024-01-01"), d("2024-01-02"), ranges) == []
+
+
+def test_emit_dim_date_emits_each_date_once(s3, bucket):
+    df = pd.DataFrame({"created_date": [date(2024, 2, 1), date(2024, 2, 3)]})
+
+    table, ranges = emit_dim_date(s3, bucket, df)
+    save_ranges(s3, bucket, ranges)
+
+    assert table.num_rows == 3
+    # the ranges are shared by every fact table
+    assert emit_dim_date(s3, bucket, df) is None
+
+    df = pd.DataFrame({"created_date": [date(2024, 2, 2), date(2024, 2, 5)]})
+    table, ranges = emit_dim_date(s3, bucket, df)
+    save_ranges(s3, bucket, ranges)
+
+    assert table.column("date_id").to_pylist() == [
+        date(2024, 2, 4),
+        date(2024, 2, 5),
+    ]
+    assert load_ranges(s3, bucket) == [(d("2024-02-01"), d("2024-02-05"))]
+
+
+def test_concurrent_emits_keep_each_others_ranges(s3, bucket):
+    first = pd.DataFrame({"created_date": [date(2024, 2, 1)]})
+    second = pd.DataFrame({"created_date": [date(2024, 3, 1)]})
+
+    # both read the ranges before either saved
+    emitted = [emit_dim_date(s3, bucket, df) for df in (first, second)]
+    for _, ranges in emitted:
+        save_ranges(s3, bucket, ranges)
+
+    assert load_ranges(s3, bucket) == [
+        (d("2024-02-01"), d("2024-02-01")),
+        (d("2024-03-01"), d("2024-03-01")),
+    ]
+
+
+def test_load_ranges_merges_parts(s3, bucket):
+    # the per-table ranges of earlier versions are read as parts
+    s3.put_object(
+        Bucket=bucket,
+        Key=f"{EMITTED_RANGES_PREFIX}/sales_order.json",
+        Body='[["2024-01-01", "2024-01-01"]]',
+    )
+    for day in range(2, MAX_RANGE_PARTS + 2):
+        first = d(f"2024-01-{day:02}")
+        save_ranges(s3, bucket, [(first, first)])
+
+    assert load_ranges(s3, bucket) == [
+        (d("2024-01-01"), d(f"2024-01-{MAX_RANGE_PARTS + 1:02}"))
+    ]
+
+    parts = s3.list_objects_v2(Bucket=bucket, Prefix=EMITTED_RANGES_PREFIX)
+    assert parts["KeyCount"] == 1
+    assert load_ranges(s3, bucket) == [
+        (d("2024-01-01"), d(f"2024-01-{MAX_RANGE_PARTS + 1:02}"))
+    ]
+
+
+def test_dates_key_per_fact_table():
+    key = "2024-02-15T19:01:53/sales_order.pqt"
+
+    assert dates_key(key, "sales_order") == (
+        "2024-02-15T19:01:53/date_sales_order.pqt"
+    )
+    assert get_table_name(dates_key(key, "payment")) == "date_payment"
+    assert table_relations["date_payment"] == ("dim_date", "date_id")
+    assert "date" not in table_relations
@@ -0,0 +1,133 @@
+import os
+from unittest.mock import patch
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+from moto import mock_aws
+from src.dimension_keys import (
+    MAX_KEY_PARTS,
+    check_fact_keys,
+    contains,
+    find_orphans,
+    load_keys,
+    record_dimension_keys,
+    save_keys,
+)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        yield boto3.client("s3")
+
+
+@pytest.fixture(scope="function")
+def bucket(s3):
+    name = "test-control"
+    s3.create_bucket(
+        Bucket=name,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    return name
+
+
+def test_contains():
+    keys = np.array([2, 4, 6])
+    values = np.array([1, 2, 5, 6, 7])
+
+    assert list(contains(keys, values)) == [False, True, False, True, False]
+    assert list(contains(np.array([], dtype="int64"), values)) == [False] * 5
+
+
+def test_record_dimension_keys_merges(s3, bucket):
+    assert load_keys(s3, bucket, "design") is None
+
+    record_dimension_keys(s3, bucket, "design", pd.Series([3, 1, 3]))
+    record_dimension_keys(s3, bucket, "design", pd.Series([2, None]))
+
+    assert list(load_keys(s3, bucket, "design")) == [1, 2, 3]
+
+
+def test_concurrent_records_keep_each_others_keys(s3, bucket):
+    record_dimension_keys(s3, bucket, "design", pd.Series([1]))
+    known = load_keys(s3, bucket, "design")
+    # both writers read the keys before either wrote
+    with patch("src.dimension_keys.load_keys", return_value=known):
+        record_dimension_keys(s3, bucket, "design", pd.Series([2]))
+        record_dimension_keys(s3, bucket, "design", pd.Series([3]))
+
+    assert list(load_keys(s3, bucket, "design")) == [1, 2, 3]
+
+
+def test_load_keys_merges_parts(s3, bucket):
+    for key in range(MAX_KEY_PARTS + 1):
+        save_keys(s3, bucket, "design", np.array([key]))
+
+    assert len(load_keys(s3, bucket, "design")) == MAX_KEY_PARTS + 1
+
+    parts = s3.list_objects_v2(Bucket=bucket, Prefix="dimension_keys/")
+    assert parts["KeyCount"] == 1
+    assert list(load_keys(s3, bucket, "design")) == list(
+        range(MAX_KEY_PARTS + 1)
+    )
+
+
+def test_find_orphans_ignores_null_keys():
+    df = pd.DataFrame(
+        {
+            "design_record_id": [1, 9, 2],
+            "currency_record_id": [1, None, 8],
+        }
+    )
+    key_sets = {
+        "design_record_id": np.array([1, 2]),
+        "currency_record_id": np.array([1]),
+    }
+
+    orphan, reasons = find_orphans(df, key_sets)
+
+    assert list(orphan) == [False, True, True]
+    assert reasons == ["", "design_record_id", "currency_record_id"]
+
+
+def test_check_fact_keys_reports_orphans(s3, bucket):
+    record_dimension_keys(s3, bucket, "design", pd.Series([1, 2]))
+    record_dimension_keys(s3, bucket, "currency", pd.Series([1]))
+    df = pd.DataFrame(
+        {
+            "sales_record_id": [10, 11, 12],
+            "design_record_id": [1, 2, 5],
+            "currency_record_id": [1, 1, 1],
+            "counterparty_record_id": [7, 8, 9],
+        }
+    )
+    file_key = "2024-02-15T19:01:53/sales_order.pqt"
+
+    orphans = check_fact_keys(s3, bucket, file_key, "sales_order", df)
+
+    assert orphans == {"rows": 1, "columns": {"design_record_id": 1}}
+    # the rows stay to be loaded
+    assert len(df) == 3
+
+
+def test_check_fact_keys_without_orphans(s3, bucket):
+    record_dimension_keys(s3, bucket, "design", pd.Series([1]))
+    df = pd.DataFrame({"design_record_id": [1, 1]})
+
+    orphans = check_fact_keys(
+        s3, bucket, "k/sales_order.pqt", "sales_order", df
+    )
+
+    assert orphans == {"rows": 0, "columns": {}}
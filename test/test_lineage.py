@@ -0,0 +1,249 @@
+import os
+from configparser import ConfigParser
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+import boto3
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+from t_utils import inhibit_CI
+from src.extractor import extract
+from src.lineage import (
+    LINEAGE_ATTR,
+    as_utc,
+    change_range,
+    ensure_audit_table,
+    freshness,
+    lineage_of,
+    record_load,
+    stage_latencies,
+    stamp,
+)
+from src.loader import audited_databases, get_connection, load_file
+from src.transformation import get_df_from_parquet, upload_parquet
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+@pytest.fixture(scope="function")
+def mockdb_creds():
+    """Mocked Database Credentials for local testing."""
+
+    config = ConfigParser()
+    config.read(".env.ini")
+    section = config["DEFAULT"]
+
+    os.environ["PGUSER2"] = section["PGUSER"]
+    os.environ["PGPASSWORD2"] = section["PGPASSWORD"]
+    os.environ["PGHOST2"] = "127.0.0.1"
+    os.environ["PGDATABASE2"] = "totesys_test_subset"
+
+
+@pytest.fixture(scope="function")
+def audit_con(mockdb_creds):
+    audited_databases.clear()
+    con = get_connection()
+    con.run("DROP TABLE IF EXISTS load_audit;")
+    yield con
+    con.run("DROP TABLE IF EXISTS load_audit;")
+    con.close()
+    audited_databases.clear()
+
+
+def test_stamps_are_utc_iso_strings():
+    naive = datetime(2024, 2, 13, 10, 45, 18)
+
+    assert as_utc(naive) == naive.replace(tzinfo=timezone.utc)
+    assert as_utc("2024-02-13T11:45:18+01:00") == as_utc(naive)
+
+    lineage = {"event_time": "x"}
+    stamped = stamp(lineage, "extracted_at", naive)
+    assert stamped == {
+        "event_time": "x",
+        "extracted_at": "2024-02-13T10:45:18+00:00",
+    }
+    # stamping copies
+    assert lineage == {"event_time": "x"}
+    assert stamp(None, "loaded_at").keys() == {"loaded_at"}
+
+
+def test_change_range_of_last_updated():
+    df = pd.DataFrame(
+        {
+            "last_updated": [
+                datetime(2024, 2, 13, 10, 0),
+                None,
+                datetime(2024, 2, 13, 9, 30),
+            ]
+        }
+    )
+
+    assert change_range(df) == {
+        "first_change": "2024-02-13T09:30:00+00:00",
+        "last_change": "2024-02-13T10:00:00+00:00",
+    }
+    assert change_range(pd.DataFrame({"a": [1]})) == {}
+
+
+def read_footer(client, key, path):
+    client.download_file("bucket", key, str(path))
+    return pq.read_metadata(path)
+
+
+def test_extracted_lineage_read_from_footer(s3, tmp_path):
+    conn = Mock()
+    conn.run.return_value = [
+        [1, datetime(2024, 2, 13, 10, 40)],
+        [2, datetime(2024, 2, 13, 10, 41)],
+    ]
+    conn.columns = [{"name": "design_id"}, {"name": "last_updated"}]
+    time = datetime(2024, 2, 13, 10, 45, 18)
+
+    extract(s3, conn, "bucket", "design", time, None)
+    footer = read_footer(
+        s3, "2024-02-13T10:45:18/design.pqt", tmp_path / "e.pqt"
+    )
+    lineage = lineage_of(footer.metadata)
+
+    assert footer.num_rows == 2
+    assert lineage["first_change"] == "2024-02-13T10:40:00+00:00"
+    assert lineage["last_change"] == "2024-02-13T10:41:00+00:00"
+    assert lineage["event_time"] == "2024-02-13T10:45:18+00:00"
+    assert as_utc(lineage["extracted_at"]) >= as_utc(time)
+
+
+def test_transformed_files_keep_lineage_and_pandas_metadata(s3, tmp_path):
+    df = pd.DataFrame({"design_record_id": [1, 2]}, index=[5, 6])
+    lineage = {"event_time": "2024-02-13T10:45:18+00:00"}
+
+    upload_parquet(s3, "bucket", "design.pqt", df, lineage=lineage)
+
+    footer = read_footer(s3, "design.pqt", tmp_path / "t.pqt")
+    assert lineage_of(footer.metadata) == lineage
+    assert pq.read_table(tmp_path / "t.pqt").to_pandas().index.tolist() == [
+        5, 6
+    ]
+
+
+def test_files_without_lineage(s3):
+    df = pd.DataFrame({"design_record_id": [1, 2]})
+    upload_parquet(s3, "bucket", "design.pqt", df)
+
+    with patch("src.transformation.s3", s3):
+        frame = get_df_from_parquet("design.pqt", "bucket")
+
+    assert frame.attrs[LINEAGE_ATTR] is None
+    assert lineage_of(None) is None
+
+
+def test_frames_carry_the_lineage_of_their_file(s3):
+    df = pd.DataFrame({"design_record_id": [1, 2]})
+    lineage = {"event_time": "2024-02-13T10:45:18+00:00"}
+    upload_parquet(s3, "bucket", "design.pqt", df, lineage=lineage)
+
+    with patch("src.transformation.s3", s3), patch.object(
+        s3, "get_object", wraps=s3.get_object
+    ) as gets:
+        frame = get_df_from_parquet("design.pqt", "bucket")
+
+    assert gets.call_count == 1
+    assert frame.attrs[LINEAGE_ATTR] == lineage
+    assert str(frame["design_record_id"].dtype) == "Int64"
+
+
+@inhibit_CI
+@pytest.mark.parametrize(
+    "env",
+    [
+        {"LOAD_MODE": "copy"},
+        {"LOAD_MODE": "binary"},
+        {"LOAD_MODE": "copy", "LOAD_STREAM_ROWS": "1"},
+    ],
+)
+def test_load_file_audits_lineage(s3, audit_con, env):
+    audit_con.run("DROP TABLE IF EXISTS dim_design;")
+    audit_con.run(
+        "CREATE TABLE dim_design "
+        "(design_record_id INT PRIMARY KEY, design_name VARCHAR);"
+    )
+    df = pd.DataFrame({"design_record_id": [1, 2], "design_name": ["a", "b"]})
+    lineage = {
+        "first_change": "2024-02-13T10:40:00+00:00",
+        "event_time": "2024-02-13T10:45:18+00:00",
+    }
+    upload_parquet(s3, "bucket", "2024-02-13T10:45:18/design.pqt", df,
+                   lineage=lineage)
+    env = dict(env, LOAD_AUDIT="true")
+
+    with patch("src.loader.s3", s3), patch.dict(os.environ, env):
+        with patch.object(s3, "head_object", wraps=s3.head_object) as heads:
+            with patch.object(s3, "get_object", wraps=s3.get_object) as gets:
+                assert load_file("2024-02-13T10:45:18/design.pqt", "bucket")
+
+    # the lineage comes from the one read of the file
+    if "LOAD_STREAM_ROWS" in env:
+        assert heads.call_count == 1
+    else:
+        assert gets.call_count == 1
+
+    [[table_name, rows, first_change, loaded_at]] = audit_con.run(
+        "SELECT table_name, rows, first_change, loaded_at FROM load_audit;"
+    )
+    assert (table_name, rows) == ("dim_design", 2)
+    assert first_change == as_utc(lineage["first_change"])
+    assert loaded_at > first_change
+    audit_con.run("DROP TABLE dim_design;")
+
+
+@inhibit_CI
+def test_freshness_and_stage_latencies(audit_con):
+    ensure_audit_table(audit_con)
+    start = datetime.now(timezone.utc) - timedelta(minutes=10)
+    for seconds in [10, 20, 30]:
+        lineage = {
+            name: (start + timedelta(seconds=offset * seconds)).isoformat()
+            for name, offset in [
+                ("first_change", 0),
+                ("event_time", 1),
+                ("extracted_at", 2),
+                ("transformed_at", 3),
+            ]
+        }
+        record_load(audit_con, "dim_design", f"{seconds}.pqt", 1, lineage)
+    record_load(audit_con, "dim_staff", "old.pqt", 1, None)
+
+    tables = freshness(audit_con)
+    latencies = stage_latencies(audit_con)
+
+    assert tables["dim_design"]["as_of"] == start + timedelta(seconds=30)
+    assert 600 - 30 < tables["dim_design"]["staleness"] < 600
+    assert tables["dim_staff"]["staleness"] is None
+    assert latencies["dim_design"]["extract"] == pytest.approx(
+        [20, 28, 29.8]
+    )
+    assert latencies["dim_design"]["end_to_end"][0] > 600 - 30
+    assert latencies["dim_staff"]["transform"] is None
+    assert stage_latencies(
+        audit_con, since=datetime.now(timezone.utc) + timedelta(hours=1)
+    ) == {}
@@ -0,0 +1,268 @@
+import json
+import os
+import threading
+import time
+from configparser import ConfigParser
+from unittest.mock import MagicMock, patch
+import boto3
+import pytest
+from moto import mock_aws
+from t_utils import inhibit_CI
+from src.load_coordinator import (
+    BLOCKED,
+    FAILED,
+    LOADED,
+    get_foreign_keys,
+    lambda_handler,
+    list_run_files,
+    load_table,
+    schedule,
+    static_dependencies,
+)
+from src.loader import get_connection
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(
+            Bucket="processed",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield client
+
+
+@pytest.fixture(scope="function")
+def mockdb_creds():
+    """Mocked Database Credentials for local testing."""
+
+    config = ConfigParser()
+    config.read(".env.ini")
+    section = config["DEFAULT"]
+
+    os.environ["PGUSER2"] = section["PGUSER"]
+    os.environ["PGPASSWORD2"] = section["PGPASSWORD"]
+    os.environ["PGHOST2"] = "127.0.0.1"
+    os.environ["PGDATABASE2"] = "totesys_test_subset"
+
+
+RUN = "2024-02-15T19:01:53"
+
+
+def test_static_dependencies_put_facts_after_their_dimensions():
+    dependencies = static_dependencies()
+
+    assert dependencies["fact_sales_order"] == {
+        "dim_design",
+        "dim_staff",
+        "dim_counterparty",
+        "dim_currency",
+        "dim_location",
+        "dim_date",
+    }
+    assert dependencies["fact_payment"] == {
+        "dim_transaction",
+        "dim_counterparty",
+        "dim_currency",
+        "dim_payment_type",
+        "dim_date",
+    }
+    assert "dim_design" not in dependencies
+
+
+def test_list_run_files_finds_both_layouts(s3):
+    keys = [
+        f"{RUN}/design.pqt",
+        f"{RUN}/design.profile.json",
+        f"{RUN}/date_payment.pqt",
+        f"{RUN}/date_sales_order.pqt",
+        f"{RUN}/unknown.pqt",
+        f"table=sales_order/last_updated_date=2024-02-14/{RUN}.pqt",
+        f"table=sales_order/last_updated_date=2024-02-15/{RUN}.pqt",
+        "table=sales_order/last_updated_date=2024-02-15/"
+        "2024-02-16T00:00:00.pqt",
+        "2024-02-16T00:00:00/design.pqt",
+    ]
+    for key in keys:
+        s3.put_object(Bucket="processed", Key=key, Body=b"")
+    s3.put_object(
+        Bucket="processed",
+        Key=f"{RUN}/sales_order.manifest.json",
+        Body=json.dumps(keys[5:7]),
+    )
+
+    files = list_run_files(s3, "processed", RUN)
+
+    assert files == {
+        "dim_design": [f"{RUN}/design.pqt"],
+        "dim_date": [
+            f"{RUN}/date_payment.pqt",
+            f"{RUN}/date_sales_order.pqt",
+        ],
+        "fact_sales_order": [
+            f"table=sales_order/last_updated_date=2024-02-14/{RUN}.pqt",
+            f"table=sales_order/last_updated_date=2024-02-15/{RUN}.pqt",
+        ],
+    }
+
+
+def test_list_run_files_lists_only_the_run_prefix():
+    client = MagicMock()
+    client.get_paginator.return_value.paginate.return_value = [
+        {"Contents": [{"Key": f"{RUN}/design.pqt"}]}
+    ]
+
+    assert list_run_files(client, "processed", RUN) == {
+        "dim_design": [f"{RUN}/design.pqt"]
+    }
+    client.get_paginator.return_value.paginate.assert_called_once_with(
+        Bucket="processed", Prefix=f"{RUN}/"
+    )
+
+
+def test_schedule_loads_dependencies_first():
+    finished = []
+
+    def load(table):
+        finished.append(table)
+        return True
+
+    outcomes = schedule(
+        ["fact", "dim_a", "dim_b"],
+        {"fact": {"dim_a", "dim_b"}},
+        load,
+    )
+
+    assert outcomes == {"fact": LOADED, "dim_a": LOADED, "dim_b": LOADED}
+    assert finished[-1] == "fact"
+
+
+def test_schedule_runs_independent_tables_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+
+    def load(table):
+        # only returns if the three dimensions run at the same time
+        barrier.wait()
+        return True
+
+    outcomes = schedule(["dim_a", "dim_b", "dim_c"], {}, load, workers=3)
+
+    assert set(outcomes.values()) == {LOADED}
+
+
+def test_schedule_starts_fact_once_its_own_dimensions_committed():
+    started = {}
+
+    def load(table):
+        started[table] = time.monotonic()
+        if table == "dim_slow":
+            time.sleep(0.3)
+        return True
+
+    schedule(
+        ["dim_fast", "dim_slow", "fact"],
+        {"fact": {"dim_fast"}},
+        load,
+        workers=3,
+    )
+
+    assert started["fact"] < started["dim_slow"] + 0.3
+
+
+def test_schedule_blocks_tables_depending_on_a_failure():
+    loaded = []
+
+    def load(table):
+        loaded.append(table)
+        return table != "dim_a"
+
+    outcomes = schedule(
+        ["fact", "dim_a", "dim_b", "aggregate"],
+        {"fact": {"dim_a", "dim_b"}, "aggregate": {"fact"}},
+        load,
+    )
+
+    assert outcomes == {
+        "dim_a": FAILED,
+        "dim_b": LOADED,
+        "fact": BLOCKED,
+        "aggregate": BLOCKED,
+    }
+    assert "fact" not in loaded
+
+
+def test_schedule_treats_exceptions_as_failures():
+    def load(table):
+        raise RuntimeError("boom")
+
+    assert schedule(["dim_a"], {}, load) == {"dim_a": FAILED}
+
+
+def test_schedule_ignores_dependencies_outside_the_run():
+    outcomes = schedule(["fact"], {"fact": {"dim_a"}}, lambda table: True)
+
+    assert outcomes == {"fact": LOADED}
+
+
+def test_schedule_rejects_cycles():
+    with pytest.raises(ValueError):
+        schedule(["a", "b"], {"a": {"b"}, "b": {"a"}}, lambda table: True)
+
+
+@patch("src.load_coordinator.load_file")
+def test_load_table_stops_at_first_failure(mock_load_file):
+    mock_load_file.side_effect = ["Loaded", None, "Loaded"]
+
+    assert not load_table("processed", ["a.pqt", "b.pqt", "c.pqt"])
+    assert mock_load_file.call_count == 2
+
+
+@patch("src.load_coordinator.dependency_graph")
+@patch("src.load_coordinator.load_file")
+def test_lambda_handler_loads_run_in_order(
+    mock_load_file, mock_dependency_graph, s3
+):
+    for key in [f"{RUN}/sales_order.pqt", f"{RUN}/design.pqt"]:
+        s3.put_object(Bucket="processed", Key=key, Body=b"")
+    mock_dependency_graph.return_value = static_dependencies()
+    mock_load_file.return_value = "Loaded"
+
+    outcomes = lambda_handler({"run": RUN, "bucket": "processed"}, {})
+
+    assert outcomes == {"dim_design": LOADED, "fact_sales_order": LOADED}
+    assert [call.args[0] for call in mock_load_file.call_args_list] == [
+        f"{RUN}/design.pqt",
+        f"{RUN}/sales_order.pqt",
+    ]
+
+
+@inhibit_CI
+def test_get_foreign_keys(mockdb_creds):
+    con = get_connection()
+    con.run("DROP TABLE IF EXISTS fact_payment, dim_payment_type;")
+    con.run(
+        "CREATE TABLE dim_payment_type "
+        "(payment_type_record_id INT PRIMARY KEY);"
+    )
+    con.run(
+        "CREATE TABLE fact_payment (payment_record_id INT PRIMARY KEY, "
+        "payment_type_record_id INT "
+        "REFERENCES dim_payment_type (payment_type_record_id));"
+    )
+
+    assert get_foreign_keys(con) == {"fact_payment": {"dim_payment_type"}}
+
+    con.run("DROP TABLE fact_payment, dim_payment_type;")
+    con.close()
@@ -4,21 +4,53 @@ from src.loader import (
     get_table_name,
     create_query,
     df_insertion,
+    create_merge_query,
+    df_copy_insertion,
+    get_connection,
+    arrow_copy_insertion,
+    deduplicate_keys,
+    get_batch_size,
+    batch_parameters,
+    conflict_clause,
+    upsert_counts,
+    upsert_batches,
+    partition_frame,
+    partitioned_insertion,
+    get_progress,
+    save_progress,
+    progress_key,
+    quarantine_rows,
+    quarantine_key,
+    warm_connection,
+    statement_cache,
+    prepared,
+    idle_connections,
+    nulls_as_none,
+    stream_file,
+    batch_key,
+    table_relations,
+    load_frame,
 )
 
 # from src.transformation import tables_transformation_templates
 import pg8000.native as pg
 from moto import mock_aws
+from botocore.exceptions import ClientError
 import pandas as pd
-from unittest.mock import patch  # , Mock
+import pyarrow as pa
+from unittest.mock import patch, MagicMock
+from collections import Counter
 import boto3
 from datetime import datetime
+from io import BytesIO
 from configparser import ConfigParser
 import pytest
 
 # from io import BytesIO
 import os
 from t_utils import inhibit_CI
+# the loader shares the partition state of the module it imports
+from date_partitions import partition_columns
 
 
 # from sample_datasets import sample_dataset
@@ -38,6 +70,14 @@ def aws_credentials():
     os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
 
 
+@pytest.fixture(scope="function", autouse=True)
+def unpartitioned_targets():
+    """The warehouse tables as looked up by prepare_partitions."""
+    targets = {table: None for table, _ in table_relations.values()}
+    with patch.dict(partition_columns, targets):
+        yield
+
+
 # @inhibit_CI
 @pytest.fixture(scope="function")
 def mockdb_creds():
@@ -89,6 +129,11 @@ def test_get_table_name():
     assert get_table_name(keys[1]) == "purchase_order"
 
 
+def test_get_table_name_hive_key():
+    key = "table=design/last_updated_date=2024-02-15/2024-02-15T19:01:53.pqt"
+    assert get_table_name(key) == "design"
+
+
 @patch("src.loader.df_insertion")
 @patch("src.loader.create_query")
 @patch("src.loader.get_df_from_parquet")
@@ -137,6 +182,47 @@ def test_lambda_handler(
     assert res == "Ok"
 
 
+@patch("src.loader.df_insertion")
+@patch("src.loader.get_df_from_parquet")
+def test_lambda_handler_skips_compacted_objects(
+    mock_get_df_from_parquet, mock_df_insertion
+):
+    for key in [
+        "compacted/2024-02-15/address.pqt",
+        "compacted/2024-02-15/address.manifest.json",
+    ]:
+        event = {
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": "processed"},
+                        "object": {"key": key},
+                    }
+                }
+            ],
+        }
+        assert lambda_handler(event, {}) == "Skipped"
+    assert not mock_get_df_from_parquet.called
+    assert not mock_df_insertion.called
+
+
+@patch("src.loader.load_file")
+def test_lambda_handler_defers_to_coalesced_load(mock_load_file):
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "processed"},
+                    "object": {"key": "2024-02-15T19:01:53/design.pqt"},
+                }
+            }
+        ],
+    }
+    with patch.dict(os.environ, {"LOAD_COALESCE": "true"}):
+        assert lambda_handler(event, {}) == "Deferred"
+    assert not mock_load_file.called
+
+
 def normalize_sql_query(query):
     return "\n".join(line.strip() for line in query.split("\n")).strip()
 
@@ -149,8 +235,10 @@ def test_create_query():
         INSERT INTO test_table (id, name, value)
         VALUES (:id, :name, :value)
         ON CONFLICT (id)
-        DO UPDATE SET name = EXCLUDED.name, value = EXCLUDED.value;
-        """
+        DO UPDATE SET name = EXCLUDED.name, value = EXCLUDED.value
+        WHERE (test_table.name, test_table.value) IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.value)
+        RETURNING (xmax = 0) AS inserted;
+        """  # noqa: E501
 
     # ACT
     query = normalize_sql_query(create_query("test_table", "id", df))
@@ -166,9 +254,11 @@ def test_create_query_dim_transaction():
     df = pd.DataFrame(data)
     expected_query = """
         INSERT INTO dim_transaction (id, sales_order_id, purchase_order_id)
-        VALUES (:id, nullif(:sales_order_id, -1), nullif(:purchase_order_id, -1))
+        VALUES (:id, :sales_order_id, :purchase_order_id)
         ON CONFLICT (id)
-        DO UPDATE SET sales_order_id = EXCLUDED.sales_order_id, purchase_order_id = EXCLUDED.purchase_order_id;
+        DO UPDATE SET sales_order_id = EXCLUDED.sales_order_id, purchase_order_id = EXCLUDED.purchase_order_id
+        WHERE (dim_transaction.sales_order_id, dim_transaction.purchase_order_id) IS DISTINCT FROM (EXCLUDED.sales_order_id, EXCLUDED.purchase_order_id)
+        RETURNING (xmax = 0) AS inserted;
         """  # noqa: E501
 
     # ACT
@@ -228,6 +318,100 @@ def delete_test_table(mockdb_creds):
     con.close()
 
 
+def test_create_query_multiple_rows():
+    df = pd.DataFrame({"id": [1, 2], "name": ["a", "b"]})
+    expected_query = """
+        INSERT INTO test_table (id, name)
+        VALUES (:id_0, :name_0), (:id_1, :name_1)
+        ON CONFLICT (id)
+        DO UPDATE SET name = EXCLUDED.name
+        WHERE (test_table.name) IS DISTINCT FROM (EXCLUDED.name)
+        RETURNING (xmax = 0) AS inserted;
+        """
+
+    query = normalize_sql_query(create_query("test_table", "id", df, 2))
+
+    assert query == normalize_sql_query(expected_query)
+
+
+def test_create_query_multiple_rows_dim_transaction():
+    df = pd.DataFrame({"id": [1], "sales_order_id": [None]})
+
+    query = create_query("dim_transaction", "id", df, 2)
+
+    assert "(:id_0, :sales_order_id_0)" in query
+    assert "(:id_1, :sales_order_id_1)" in query
+    assert "nullif" not in query
+
+
+def test_get_batch_size_stays_under_parameter_limit():
+    assert get_batch_size(7, "auto") == 71
+    assert get_batch_size(7, 250) == 250
+    assert get_batch_size(7, "0") == 1
+    assert get_batch_size(100, 1000) == 327
+    assert get_batch_size(10, 5000) == 3276
+    assert get_batch_size(50_000, "auto") == 1
+
+
+@patch.dict(os.environ, {"LOAD_BATCH_SIZE": "20"})
+def test_get_batch_size_reads_environment():
+    assert get_batch_size(7) == 20
+
+
+def test_batch_parameters_suffixes_row_numbers():
+    params = batch_parameters(["id", "name"], [(1, "a"), (2, None)])
+
+    assert params == {"id_0": 1, "name_0": "a", "id_1": 2, "name_1": None}
+    assert batch_parameters(["id"], [(1,)]) == {"id": 1}
+
+
+@patch.dict(os.environ, {"LOAD_BATCH_SIZE": "2"})
+@patch("src.loader.df_insertion")
+@patch("src.loader.get_df_from_parquet")
+def test_lambda_handler_batches_upserts(
+    mock_get_df_from_parquet, mock_df_insertion
+):
+    df = pd.DataFrame({"design_record_id": [1, 2, 3], "design_id": [1, 2, 3]})
+    mock_get_df_from_parquet.return_value = df
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "processed"},
+                    "object": {"key": "2024-02-15T19:01:53/design.pqt"},
+                }
+            }
+        ],
+    }
+
+    assert lambda_handler(event, {}) == "Ok"
+
+    query, _, table_name, primary_key, batch_size, file_key = (
+        mock_df_insertion.call_args.args
+    )
+    assert file_key == "2024-02-15T19:01:53/design.pqt"
+    assert table_name == "dim_design"
+    assert primary_key == "design_record_id"
+    assert batch_size == 2
+    assert ":design_record_id_1" in query
+
+
+def test_conflict_clause_without_other_columns_does_nothing():
+    assert conflict_clause("dim_date", "date_id", ["date_id"]) == (
+        "ON CONFLICT (date_id) DO NOTHING"
+    )
+
+
+def test_upsert_counts():
+    assert upsert_counts(5, [[True], [False], [True]]) == Counter(
+        inserted=2, updated=1, unchanged=2
+    )
+    assert upsert_counts(1, []) == Counter(
+        inserted=0, updated=0, unchanged=1
+    )
+    assert upsert_counts(1, None) == Counter()
+
+
 @inhibit_CI
 def test_df_insertion(mockdb_creds):
     setup_test_table(mockdb_creds)
@@ -308,3 +492,943 @@ def test_df_insertion(mockdb_creds):
     assert len(result) == 3
 
     delete_test_table(mockdb_creds)
+
+
+def test_create_merge_query():
+    query = create_merge_query(
+        "test_table", "id", ["id", "name", "value"], "staging_test_table"
+    )
+    expected_query = """
+        WITH upserted AS (
+        INSERT INTO test_table (id, name, value)
+        SELECT id, name, value FROM staging_test_table
+        ON CONFLICT (id)
+        DO UPDATE SET name = EXCLUDED.name, value = EXCLUDED.value
+        WHERE (test_table.name, test_table.value) IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.value)
+        RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted),
+        count(*) FILTER (WHERE NOT inserted),
+        (SELECT count(*) FROM staging_test_table) - count(*)
+        FROM upserted;
+        """  # noqa: E501
+
+    assert normalize_sql_query(query) == normalize_sql_query(expected_query)
+
+
+def test_create_merge_query_dim_transaction():
+    query = create_merge_query(
+        "dim_transaction",
+        "id",
+        ["id", "sales_order_id", "purchase_order_id"],
+        "staging_dim_transaction",
+    )
+
+    assert (
+        "SELECT id, sales_order_id, purchase_order_id FROM "
+        "staging_dim_transaction" in query
+    )
+
+
+@patch.dict(os.environ, {"LOAD_MODE": "copy"})
+@patch("src.loader.df_copy_insertion")
+@patch("src.loader.df_insertion")
+@patch("src.loader.get_df_from_parquet")
+def test_lambda_handler_copy_mode(
+    mock_get_df_from_parquet, mock_df_insertion, mock_df_copy_insertion
+):
+    df = pd.DataFrame({"design_record_id": [1]})
+    mock_get_df_from_parquet.return_value = df
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "processed"},
+                    "object": {"key": "2024-02-15T19:01:53/design.pqt"},
+                }
+            }
+        ],
+    }
+
+    assert lambda_handler(event, {}) == "Ok"
+
+    assert not mock_df_insertion.called
+    mock_df_copy_insertion.assert_called_once_with(
+        df,
+        "dim_design",
+        "design_record_id",
+        "2024-02-15T19:01:53/design.pqt",
+    )
+
+
+@inhibit_CI
+def test_df_copy_insertion(mockdb_creds):
+    setup_test_table(mockdb_creds)
+    tdf = pd.DataFrame(
+        {
+            "design_record_id": [1, 2],
+            "design_id": [1, 2],
+            "design_name": ["Design One", None],
+            "file_location": ["/path/to/design1", "/path, with comma"],
+            "file_name": ["design1.png", ""],
+            "last_updated_date": ["2021-01-01", "2021-01-02"],
+            "last_updated_time": ["12:00:00", "13:00:00"],
+        }
+    )
+
+    df_copy_insertion(tdf, "dim_design", "design_record_id")
+
+    con = get_connection()
+    result = con.run(
+        "SELECT design_record_id, design_name, file_location, file_name "
+        "FROM dim_design ORDER BY design_record_id"
+    )
+    assert result == [
+        [1, "Design One", "/path/to/design1", "design1.png"],
+        [2, None, "/path, with comma", ""],
+    ]
+
+    tdf = pd.DataFrame(
+        {
+            "design_record_id": [1, 3, 1],
+            "design_id": [1, 3, 1],
+            "design_name": ["Design 99", "Design 3", "Design 100"],
+            "file_location": ["/a", "/b", "/c"],
+            "file_name": ["a.png", "b.png", "c.png"],
+            "last_updated_date": ["2021-11-11", "2021-03-03", "2021-11-12"],
+            "last_updated_time": ["11:11:11", "13:03:03", "11:11:12"],
+        }
+    )
+    df_copy_insertion(tdf, "dim_design", "design_record_id")
+
+    result = con.run(
+        "SELECT design_record_id, design_name "
+        "FROM dim_design ORDER BY design_record_id"
+    )
+    assert result == [[1, "Design 100"], [2, None], [3, "Design 3"]]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+def test_nulls_as_none_converts_nullable_columns_only():
+    df = pd.DataFrame(
+        {
+            "id": [1, 2],
+            "sales_order_id": pd.array([5, None], dtype="Int64"),
+            "purchase_order_id": pd.array([6, 7], dtype="Int64"),
+        }
+    )
+
+    rows = list(nulls_as_none(df).itertuples(index=False, name=None))
+
+    assert rows == [(1, 5, 6), (2, None, 7)]
+    assert nulls_as_none(df)["purchase_order_id"].dtype == "Int64"
+
+
+@inhibit_CI
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_df_insertion_dim_transaction_sends_nulls(mockdb_creds, batch_size):
+    con = get_connection()
+    con.run("DROP TABLE IF EXISTS dim_transaction;")
+    con.run(
+        """
+        CREATE TABLE dim_transaction (
+            transaction_record_id INT PRIMARY KEY,
+            sales_order_id INT,
+            purchase_order_id INT
+        );
+        """
+    )
+    df = pd.DataFrame(
+        {
+            "transaction_record_id": [1, 2, 3],
+            "sales_order_id": pd.array([5, None, 6], dtype="Int64"),
+            "purchase_order_id": pd.array([None, 7, None], dtype="Int64"),
+        }
+    )
+    query = create_query(
+        "dim_transaction", "transaction_record_id", df, batch_size
+    )
+
+    status = df_insertion(
+        query, df, "dim_transaction", "transaction_record_id", batch_size
+    )
+
+    assert status is not None
+    result = con.run(
+        "SELECT sales_order_id, purchase_order_id FROM dim_transaction "
+        "ORDER BY transaction_record_id"
+    )
+    assert result == [[5, None], [None, 7], [6, None]]
+    con.run("DROP TABLE dim_transaction;")
+    con.close()
+
+
+@inhibit_CI
+def test_df_copy_insertion_dim_transaction(mockdb_creds):
+    con = get_connection()
+    con.run("DROP TABLE IF EXISTS dim_transaction;")
+    con.run(
+        """
+        CREATE TABLE dim_transaction (
+            transaction_record_id INT PRIMARY KEY,
+            transaction_id INT,
+            transaction_type VARCHAR(10),
+            sales_order_id INT,
+            purchase_order_id INT
+        );
+        """
+    )
+    tdf = pd.DataFrame(
+        {
+            "transaction_record_id": [1, 2],
+            "transaction_id": [1, 2],
+            "transaction_type": ["SALE", "PURCHASE"],
+            "sales_order_id": pd.array([5, None], dtype="Int64"),
+            "purchase_order_id": pd.array([None, 7], dtype="Int64"),
+        }
+    )
+
+    df_copy_insertion(tdf, "dim_transaction", "transaction_record_id")
+
+    result = con.run(
+        "SELECT sales_order_id, purchase_order_id FROM dim_transaction "
+        "ORDER BY transaction_record_id"
+    )
+    assert result == [[5, None], [None, 7]]
+    con.run("DROP TABLE dim_transaction;")
+    con.close()
+
+
+def test_deduplicate_keys_keeps_last_row_of_each_key():
+    table = pa.table({"id": [1, 2, 1, 3, 2], "value": list("abcde")})
+
+    result = deduplicate_keys(table, "id")
+
+    assert result.to_pydict() == {"id": [1, 3, 2], "value": ["c", "d", "e"]}
+
+
+def test_deduplicate_keys_returns_unique_table_unchanged():
+    table = pa.table({"id": [3, 1, 2]})
+
+    assert deduplicate_keys(table, "id") is table
+
+
+@patch.dict(os.environ, {"LOAD_MODE": "binary"})
+@patch("src.loader.arrow_copy_insertion")
+@patch("src.loader.get_df_from_parquet")
+@patch("src.loader.get_table_from_parquet")
+def test_lambda_handler_binary_mode(
+    mock_get_table_from_parquet,
+    mock_get_df_from_parquet,
+    mock_arrow_copy_insertion,
+):
+    table = pa.table({"design_record_id": [1]})
+    mock_get_table_from_parquet.return_value = table
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "processed"},
+                    "object": {"key": "2024-02-15T19:01:53/design.pqt"},
+                }
+            }
+        ],
+    }
+
+    assert lambda_handler(event, {}) == "Ok"
+
+    assert not mock_get_df_from_parquet.called
+    mock_get_table_from_parquet.assert_called_once_with(
+        "2024-02-15T19:01:53/design.pqt", "processed"
+    )
+    mock_arrow_copy_insertion.assert_called_once_with(
+        table, "dim_design", "design_record_id"
+    )
+
+
+@inhibit_CI
+def test_arrow_copy_insertion(mockdb_creds):
+    setup_test_table(mockdb_creds)
+    table = pa.table(
+        {
+            "design_record_id": [1, 2, 1],
+            "design_id": [1, 2, 1],
+            "design_name": ["Design One", None, "Design 100"],
+            "file_location": ["/a", "/path, with comma", "/c"],
+            "file_name": ["a.png", "", "c.png"],
+            "last_updated_date": ["2021-01-01", "2021-01-02", "2021-11-12"],
+            "last_updated_time": ["12:00:00", "13:00:00", "11:11:12"],
+        }
+    )
+
+    arrow_copy_insertion(table, "dim_design", "design_record_id")
+
+    con = get_connection()
+    result = con.run(
+        "SELECT design_record_id, design_name, file_location, file_name, "
+        "CAST(last_updated_date AS TEXT), CAST(last_updated_time AS TEXT) "
+        "FROM dim_design ORDER BY design_record_id"
+    )
+    assert result == [
+        [1, "Design 100", "/c", "c.png", "2021-11-12", "11:11:12"],
+        [2, None, "/path, with comma", "", "2021-01-02", "13:00:00"],
+    ]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+@inhibit_CI
+def test_arrow_copy_insertion_dim_transaction_keeps_nulls(mockdb_creds):
+    con = get_connection()
+    con.run("DROP TABLE IF EXISTS dim_transaction;")
+    con.run(
+        """
+        CREATE TABLE dim_transaction (
+            transaction_record_id INT PRIMARY KEY,
+            transaction_id INT,
+            transaction_type VARCHAR(10),
+            sales_order_id INT,
+            purchase_order_id INT
+        );
+        """
+    )
+    table = pa.table(
+        {
+            "transaction_record_id": [1, 2],
+            "transaction_id": [1, 2],
+            "transaction_type": ["SALE", "PURCHASE"],
+            "sales_order_id": [5.0, None],
+            "purchase_order_id": [None, 7.0],
+        }
+    )
+
+    arrow_copy_insertion(table, "dim_transaction", "transaction_record_id")
+
+    result = con.run(
+        "SELECT sales_order_id, purchase_order_id FROM dim_transaction "
+        "ORDER BY transaction_record_id"
+    )
+    assert result == [[5, None], [None, 7]]
+    con.run("DROP TABLE dim_transaction;")
+    con.close()
+
+
+@inhibit_CI
+def test_df_insertion_batched(mockdb_creds):
+    setup_test_table(mockdb_creds)
+    tdf = pd.DataFrame(
+        {
+            "design_record_id": [1, 2, 3, 1, 4],
+            "design_id": [1, 2, 3, 1, 4],
+            "design_name": ["One", None, "Three", "One again", "Four"],
+            "file_location": ["/a", "/b", "/c", "/d", "/e"],
+            "file_name": ["a.png", "b.png", "c.png", "d.png", "e.png"],
+            "last_updated_date": ["2021-01-01"] * 5,
+            "last_updated_time": ["12:00:00"] * 5,
+        }
+    )
+    query = create_query("dim_design", "design_record_id", tdf, 3)
+
+    df_insertion(query, tdf, "dim_design", "design_record_id", 3)
+
+    con = get_connection()
+    result = con.run(
+        "SELECT design_record_id, design_name "
+        "FROM dim_design ORDER BY design_record_id"
+    )
+    assert result == [[1, "One again"], [2, None], [3, "Three"], [4, "Four"]]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+@inhibit_CI
+def test_df_insertion_batched_rolls_back_on_error(mockdb_creds):
+    setup_test_table(mockdb_creds)
+    tdf = pd.DataFrame(
+        {
+            "design_record_id": [1, 2, 3],
+            "design_id": [1, 2, 3],
+            "design_name": ["One", "Two", "x" * 60],
+            "file_location": ["/a", "/b", "/c"],
+            "file_name": ["a.png", "b.png", "c.png"],
+            "last_updated_date": ["2021-01-01"] * 3,
+            "last_updated_time": ["12:00:00"] * 3,
+        }
+    )
+    query = create_query("dim_design", "design_record_id", tdf, 2)
+
+    df_insertion(query, tdf, "dim_design", "design_record_id", 2)
+
+    con = get_connection()
+    assert con.run("SELECT count(*) FROM dim_design") == [[0]]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+def design_frame(names):
+    return pd.DataFrame(
+        {
+            "design_record_id": list(range(1, len(names) + 1)),
+            "design_id": list(range(1, len(names) + 1)),
+            "design_name": names,
+            "file_location": ["/a"] * len(names),
+            "file_name": ["a.png"] * len(names),
+            "last_updated_date": ["2021-01-01"] * len(names),
+            "last_updated_time": ["12:00:00"] * len(names),
+        }
+    )
+
+
+@inhibit_CI
+def test_upsert_batches_skips_unchanged_rows(mockdb_creds):
+    setup_test_table(mockdb_creds)
+    con = get_connection()
+    df = design_frame(["One", "Two", "Three"])
+    query = create_query("dim_design", "design_record_id", df, 2)
+
+    counts = upsert_batches(
+        con, query, df, "dim_design", "design_record_id", 2
+    )
+    assert counts == Counter(inserted=3, updated=0, unchanged=0)
+    versions = con.run(
+        "SELECT CAST(xmin AS TEXT) FROM dim_design ORDER BY design_record_id"
+    )
+
+    df = design_frame(["One", "Two", "Changed"])
+    counts = upsert_batches(
+        con, query, df, "dim_design", "design_record_id", 2
+    )
+    assert counts == Counter(inserted=0, updated=1, unchanged=2)
+    reloaded = con.run(
+        "SELECT CAST(xmin AS TEXT) FROM dim_design ORDER BY design_record_id"
+    )
+    assert reloaded[:2] == versions[:2]
+    assert reloaded[2] != versions[2]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+@inhibit_CI
+def test_df_insertion_logs_counts(mockdb_creds, caplog):
+    setup_test_table(mockdb_creds)
+    df = design_frame(["One", "Two"])
+    query = create_query("dim_design", "design_record_id", df)
+    df_insertion(query, df, "dim_design")
+
+    df = design_frame(["One", "Changed", "Three"])
+    df_insertion(query, df, "dim_design")
+
+    assert "dim_design: 1 inserted, 1 updated, 1 unchanged" in caplog.text
+    delete_test_table(mockdb_creds)
+
+
+@patch("src.loader.get_connection")
+def test_warm_connection_reuses_idle_connection(mock_get_connection):
+    idle_connections.clear()
+    mock_get_connection.side_effect = [MagicMock(), MagicMock()]
+
+    with warm_connection() as first:
+        pass
+    with warm_connection() as second:
+        pass
+
+    assert second is first
+    assert mock_get_connection.call_count == 1
+    idle_connections.clear()
+
+
+@patch("src.loader.get_connection")
+def test_warm_connection_discards_failed_and_dead_connections(
+    mock_get_connection,
+):
+    idle_connections.clear()
+    first, second, third = MagicMock(), MagicMock(), MagicMock()
+    mock_get_connection.side_effect = [first, second, third]
+
+    with pytest.raises(ValueError):
+        with warm_connection():
+            raise ValueError("load failed")
+    first.close.assert_called_once()
+
+    with warm_connection() as con:
+        assert con is second
+    second.run.side_effect = OSError("connection reset")
+    with warm_connection() as con:
+        assert con is third
+    second.close.assert_called_once()
+    idle_connections.clear()
+
+
+@inhibit_CI
+def test_statement_cache_survives_loads_until_schema_changes(mockdb_creds):
+    setup_test_table(mockdb_creds)
+    df = design_frame(["One", "Two", "Three"])
+    query = create_query("dim_design", "design_record_id", df, 2)
+    df_insertion(query, df, "dim_design", "design_record_id", 2)
+
+    with warm_connection() as con:
+        cache = statement_cache(con, "dim_design")
+        first = prepared(con, cache, df.columns, query)
+        assert prepared(con, cache, df.columns, query) is first
+    df_insertion(query, df, "dim_design", "design_record_id", 2)
+    with warm_connection() as con:
+        cache = statement_cache(con, "dim_design")
+        assert prepared(con, cache, df.columns, query) is first
+
+        con.run("ALTER TABLE dim_design ALTER COLUMN design_id TYPE BIGINT")
+        cache = statement_cache(con, "dim_design")
+        assert prepared(con, cache, df.columns, query) is not first
+
+    df = design_frame(["One", "Two", "Changed"])
+    status = df_insertion(query, df, "dim_design", "design_record_id", 2)
+    assert status is not None
+    con = get_connection()
+    assert con.run(
+        "SELECT design_name FROM dim_design WHERE design_record_id = 3"
+    ) == [["Changed"]]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+@inhibit_CI
+def test_df_copy_insertion_logs_counts(mockdb_creds, caplog):
+    setup_test_table(mockdb_creds)
+    df_copy_insertion(
+        design_frame(["One", "Two"]), "dim_design", "design_record_id"
+    )
+
+    df_copy_insertion(
+        design_frame(["One", "Changed", "Three"]),
+        "dim_design",
+        "design_record_id",
+    )
+
+    assert "dim_design: 2 inserted, 0 updated, 0 unchanged" in caplog.text
+    assert "dim_design: 1 inserted, 1 updated, 1 unchanged" in caplog.text
+    delete_test_table(mockdb_creds)
+
+
+def test_partition_frame_splits_keys_into_disjoint_partitions():
+    df = pd.DataFrame({"id": range(1000), "value": range(1000)})
+
+    parts = partition_frame(df, "id", 4)
+
+    assert len(parts) == 4
+    assert sorted(pd.concat(parts)["id"]) == list(range(1000))
+    assert all(len(part) > 150 for part in parts)
+    again = partition_frame(df.iloc[::-1], "id", 4)
+    assert [set(p["id"]) for p in parts] == [set(p["id"]) for p in again]
+
+
+@pytest.fixture(scope="function")
+def control_bucket(s3):
+    s3.create_bucket(
+        Bucket="control_bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    with patch("src.loader.s3", s3):
+        yield s3
+
+
+def fact_frame(rows):
+    return pd.DataFrame({"sales_record_id": range(rows), "units": range(rows)})
+
+
+@patch("src.loader.load_partition")
+def test_partitioned_insertion_retries_failed_partitions(
+    mock_load_partition, control_bucket
+):
+    calls = []
+
+    def load(df, table_name, primary_key, load_mode, key):
+        calls.append(set(df["sales_record_id"]))
+        if len(calls) == 1:
+            raise RuntimeError("deadlock detected")
+        return Counter(inserted=len(df), updated=0, unchanged=0)
+
+    mock_load_partition.side_effect = load
+
+    status = partitioned_insertion(
+        fact_frame(100),
+        "fact_sales_order",
+        "sales_record_id",
+        "run/sales_order.pqt",
+        partitions=4,
+        workers=1,
+        retries=1,
+    )
+
+    assert status is not None
+    assert len(calls) == 5
+    assert calls[-1] == calls[0]
+    assert get_progress(
+        control_bucket, "control_bucket", "run/sales_order.pqt", 4
+    ) == set()
+
+
+@patch("src.loader.load_partition")
+def test_partitioned_insertion_records_progress_for_retry(
+    mock_load_partition, control_bucket
+):
+    parts = partition_frame(fact_frame(100), "sales_record_id", 4)
+    broken = set(parts[2]["sales_record_id"])
+
+    def load(df, table_name, primary_key, load_mode, key):
+        if set(df["sales_record_id"]) == broken:
+            raise RuntimeError("connection reset")
+        return Counter(inserted=len(df), updated=0, unchanged=0)
+
+    mock_load_partition.side_effect = load
+
+    status = partitioned_insertion(
+        fact_frame(100),
+        "fact_sales_order",
+        "sales_record_id",
+        "run/sales_order.pqt",
+        partitions=4,
+        retries=0,
+    )
+
+    assert status is None
+    assert get_progress(
+        control_bucket, "control_bucket", "run/sales_order.pqt", 4
+    ) == {0, 1, 3}
+
+    mock_load_partition.reset_mock(side_effect=True)
+    mock_load_partition.return_value = Counter(inserted=1)
+    status = partitioned_insertion(
+        fact_frame(100),
+        "fact_sales_order",
+        "sales_record_id",
+        "run/sales_order.pqt",
+        partitions=4,
+    )
+
+    assert status is not None
+    mock_load_partition.assert_called_once()
+    retried = mock_load_partition.call_args.args[0]
+    assert set(retried["sales_record_id"]) == broken
+
+
+@patch("src.loader.load_partition")
+def test_partitioned_insertion_never_deletes(
+    mock_load_partition, control_bucket
+):
+    mock_load_partition.return_value = Counter(inserted=25)
+    denied = ClientError(
+        {"Error": {"Code": "AccessDenied", "Message": "Access Denied"}},
+        "DeleteObject",
+    )
+
+    with patch.object(control_bucket, "delete_object", side_effect=denied):
+        status = partitioned_insertion(
+            fact_frame(100),
+            "fact_sales_order",
+            "sales_record_id",
+            "run/sales_order.pqt",
+            partitions=4,
+        )
+
+    assert status is not None
+    assert get_progress(
+        control_bucket, "control_bucket", "run/sales_order.pqt", 4
+    ) == set()
+
+
+def test_get_progress_ignores_a_different_split(control_bucket):
+    save_progress(control_bucket, "control_bucket", "run/a.pqt", 8, {1, 2})
+
+    assert get_progress(control_bucket, "control_bucket", "run/a.pqt", 4) == (
+        set()
+    )
+    assert progress_key("run/a.pqt") == "load_progress/run/a.pqt.json"
+
+
+@patch.dict(os.environ, {"LOAD_PARTITION_ROWS": "3"})
+@patch("src.loader.partitioned_insertion")
+@patch("src.loader.df_insertion")
+@patch("src.loader.get_df_from_parquet")
+def test_lambda_handler_partitions_large_files(
+    mock_get_df_from_parquet, mock_df_insertion, mock_partitioned_insertion
+):
+    df = pd.DataFrame({"sales_record_id": [1, 2, 3]})
+    mock_get_df_from_parquet.return_value = df
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "processed"},
+                    "object": {"key": "2024-02-15T19:01:53/sales_order.pqt"},
+                }
+            }
+        ],
+    }
+
+    assert lambda_handler(event, {}) == "Ok"
+
+    assert not mock_df_insertion.called
+    mock_partitioned_insertion.assert_called_once_with(
+        df,
+        "fact_sales_order",
+        "sales_record_id",
+        "2024-02-15T19:01:53/sales_order.pqt",
+    )
+
+
+@inhibit_CI
+@pytest.mark.parametrize("load_mode", ["row", "copy"])
+def test_partitioned_insertion(mockdb_creds, control_bucket, load_mode):
+    setup_test_table(mockdb_creds)
+    names = [f"Design {i}" for i in range(50)]
+    df = design_frame(names)
+    df = pd.concat([df, df.tail(1).assign(design_name="Latest")])
+
+    with patch.dict(os.environ, {"LOAD_MODE": load_mode}):
+        status = partitioned_insertion(
+            df, "dim_design", "design_record_id", "run/design.pqt", 4, 2
+        )
+
+    assert status is not None
+    con = get_connection()
+    result = con.run(
+        "SELECT design_record_id, design_name "
+        "FROM dim_design ORDER BY design_record_id"
+    )
+    assert len(result) == 50
+    assert result[-1] == [50, "Latest"]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+def read_quarantine(client, key):
+    body = client.get_object(Bucket="control_bucket", Key=quarantine_key(key))
+    return pd.read_parquet(BytesIO(body["Body"].read()))
+
+
+def test_quarantine_rows_writes_rows_with_their_error(control_bucket):
+    rejected = [((1, "a"), "value too long"), ((3, "c"), "bad date")]
+
+    quarantine_rows("run/design.pqt", ["id", "name"], rejected)
+
+    bad = read_quarantine(control_bucket, "run/design.pqt")
+    assert bad.to_dict("list") == {
+        "id": [1, 3],
+        "name": ["a", "c"],
+        "load_error": ["value too long", "bad date"],
+    }
+    assert quarantine_key("run/design.pqt") == "quarantine/load/run/design.pqt"
+
+
+def with_bad_rows(df, positions):
+    df = df.copy()
+    df.loc[positions, "design_name"] = "x" * 60
+    return df
+
+
+@inhibit_CI
+def test_df_insertion_quarantines_rejected_rows(
+    mockdb_creds, control_bucket, caplog
+):
+    setup_test_table(mockdb_creds)
+    df = with_bad_rows(design_frame([f"Design {i}" for i in range(7)]), [4])
+    query = create_query("dim_design", "design_record_id", df, 3)
+
+    status = df_insertion(
+        query, df, "dim_design", "design_record_id", 3, "run/design.pqt"
+    )
+
+    assert status is not None
+    con = get_connection()
+    loaded = con.run("SELECT design_record_id FROM dim_design ORDER BY 1")
+    assert loaded == [[1], [2], [3], [4], [6], [7]]
+    con.close()
+    bad = read_quarantine(control_bucket, "run/design.pqt")
+    assert list(bad["design_record_id"]) == [5]
+    assert "too long" in bad["load_error"][0]
+    assert "6 inserted, 0 updated, 0 unchanged, 1 rejected" in caplog.text
+    delete_test_table(mockdb_creds)
+
+
+@inhibit_CI
+def test_one_row_file_quarantines_its_rejected_row(
+    mockdb_creds, control_bucket
+):
+    setup_test_table(mockdb_creds)
+    df = with_bad_rows(design_frame(["Design 0"]), [0])
+
+    with patch.dict(os.environ, {"LOAD_MODE": "row"}):
+        status = load_frame(df, "dim_design", "design_record_id", "r/d.pqt")
+
+    assert status is not None
+    con = get_connection()
+    assert con.run("SELECT count(*) FROM dim_design") == [[0]]
+    con.close()
+    bad = read_quarantine(control_bucket, "r/d.pqt")
+    assert list(bad["design_record_id"]) == [1]
+    delete_test_table(mockdb_creds)
+
+
+@inhibit_CI
+def test_df_copy_insertion_falls_back_to_isolating_bad_rows(
+    mockdb_creds, control_bucket
+):
+    setup_test_table(mockdb_creds)
+    df = with_bad_rows(design_frame([f"D {i}" for i in range(20)]), [0, 13])
+
+    status = df_copy_insertion(
+        df, "dim_design", "design_record_id", "run/design.pqt"
+    )
+
+    assert status is not None
+    con = get_connection()
+    assert con.run("SELECT count(*) FROM dim_design") == [[18]]
+    con.close()
+    bad = read_quarantine(control_bucket, "run/design.pqt")
+    assert sorted(bad["design_record_id"]) == [1, 14]
+    delete_test_table(mockdb_creds)
+
+
+@inhibit_CI
+def test_partitioned_insertion_quarantines_per_partition(
+    mockdb_creds, control_bucket
+):
+    setup_test_table(mockdb_creds)
+    df = with_bad_rows(design_frame([f"D {i}" for i in range(40)]), [7])
+
+    status = partitioned_insertion(
+        df, "dim_design", "design_record_id", "run/design.pqt", 4, 2
+    )
+
+    assert status is not None
+    number = [
+        n
+        for n, part in enumerate(partition_frame(df, "design_record_id", 4))
+        if 8 in set(part["design_record_id"])
+    ][0]
+    bad = read_quarantine(control_bucket, f"run/design-{number}.pqt")
+    assert list(bad["design_record_id"]) == [8]
+    con = get_connection()
+    assert con.run("SELECT count(*) FROM dim_design") == [[39]]
+    con.close()
+    delete_test_table(mockdb_creds)
+
+
+def put_design_file(client, key, rows):
+    client.create_bucket(
+        Bucket="processed",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    buffer = BytesIO()
+    design_frame([f"Design {i}" for i in range(rows)]).to_parquet(
+        buffer, index=False, row_group_size=2
+    )
+    client.put_object(Bucket="processed", Key=key, Body=buffer.getvalue())
+
+
+def test_batch_key_keeps_file_key_for_first_batch():
+    assert batch_key("run/design.pqt", 0) == "run/design.pqt"
+    assert batch_key("run/design.pqt", 2) == "run/design-batch-2.pqt"
+
+
+@patch("src.loader.load_frame")
+def test_stream_file_loads_batches_in_order(mock_load_frame, control_bucket):
+    put_design_file(control_bucket, "run/design.pqt", 5)
+    mock_load_frame.return_value = "Loaded"
+
+    status = stream_file(
+        "run/design.pqt", "processed", "dim_design", "design_record_id", 2
+    )
+
+    assert status == "Loaded"
+    calls = mock_load_frame.call_args_list
+    assert [len(call.args[0]) for call in calls] == [2, 2, 1]
+    assert [call.args[3] for call in calls] == [
+        "run/design.pqt",
+        "run/design-batch-1.pqt",
+        "run/design-batch-2.pqt",
+    ]
+    assert calls[2].args[0]["design_name"].tolist() == ["Design 4"]
+    assert calls[0].args[0]["design_record_id"].dtype == "Int64"
+
+
+@patch("src.loader.load_frame")
+def test_stream_file_stops_at_first_failed_batch(
+    mock_load_frame, control_bucket
+):
+    put_design_file(control_bucket, "run/design.pqt", 5)
+    mock_load_frame.side_effect = ["Loaded", None, "Loaded"]
+
+    status = stream_file(
+        "run/design.pqt", "processed", "dim_design", "design_record_id", 2
+    )
+
+    assert status is None
+    assert mock_load_frame.call_count == 2
+
+
+@patch.dict(os.environ, {"LOAD_MODE": "binary"})
+@patch("src.loader.arrow_copy_insertion")
+def test_stream_file_binary_mode_copies_each_batch(
+    mock_arrow_copy_insertion, control_bucket
+):
+    put_design_file(control_bucket, "run/design.pqt", 5)
+    mock_arrow_copy_insertion.return_value = "Loaded"
+
+    stream_file(
+        "run/design.pqt", "processed", "dim_design", "design_record_id", 2
+    )
+
+    calls = mock_arrow_copy_insertion.call_args_list
+    assert [call.args[0].num_rows for call in calls] == [2, 2, 1]
+
+
+@patch.dict(os.environ, {"LOAD_STREAM_ROWS": "2"})
+@patch("src.loader.get_df_from_parquet")
+@patch("src.loader.open_parquet")
+@patch("src.loader.stream_file")
+def test_lambda_handler_streams_with_load_stream_rows(
+    mock_stream_file, mock_open_parquet, mock_get_df_from_parquet
+):
+    mock_stream_file.return_value = "Loaded"
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "processed"},
+                    "object": {"key": "2024-02-15T19:01:53/design.pqt"},
+                }
+            }
+        ],
+    }
+
+    assert lambda_handler(event, {}) == "Ok"
+    mock_stream_file.assert_called_once_with(
+        "2024-02-15T19:01:53/design.pqt",
+        "processed",
+        "dim_design",
+        "design_record_id",
+        2,
+        mock_open_parquet.return_value,
+    )
+    assert not mock_get_df_from_parquet.called
+
+
+@inhibit_CI
+def test_stream_file_loads_into_warehouse(mockdb_creds, control_bucket):
+    setup_test_table(mockdb_creds)
+    put_design_file(control_bucket, "run/design.pqt", 5)
+
+    status = stream_file(
+        "run/design.pqt", "processed", "dim_design", "design_record_id", 2
+    )
+
+    assert status is not None
+    con = get_connection()
+    result = con.run(
+        "SELECT design_record_id, design_name FROM dim_design "
+        "ORDER BY design_record_id"
+    )
+    assert result == [[i + 1, f"Design {i}"] for i in range(5)]
+    con.close()
+    delete_test_table(mockdb_creds)
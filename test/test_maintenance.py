@@ -0,0 +1,139 @@
+import os
+from collections import Counter
+from configparser import ConfigParser
+from unittest.mock import MagicMock, patch
+import pandas as pd
+import pytest
+from t_utils import inhibit_CI
+# the loader shares the change counts of the module it imports
+from maintenance import (
+    changed_rows,
+    forget_changes,
+    maintain,
+    maintenance_threshold,
+    needs_check,
+    record_changes,
+    table_rows,
+    vacuumed_tables,
+)
+from src.loader import get_connection, load_frame, maintain_table
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clear_changes():
+    changed_rows.clear()
+    table_rows.clear()
+    yield
+    changed_rows.clear()
+    table_rows.clear()
+
+
+@pytest.fixture(scope="function")
+def mockdb_creds():
+    """Mocked Database Credentials for local testing."""
+
+    config = ConfigParser()
+    config.read(".env.ini")
+    section = config["DEFAULT"]
+
+    os.environ["PGUSER2"] = section["PGUSER"]
+    os.environ["PGPASSWORD2"] = section["PGPASSWORD"]
+    os.environ["PGHOST2"] = "127.0.0.1"
+    os.environ["PGDATABASE2"] = "totesys_test_subset"
+
+
+def mock_connection(rows):
+    con = MagicMock()
+    con.run.side_effect = lambda query, **params: (
+        [[rows]] if "reltuples" in query else None
+    )
+    return con
+
+
+def test_record_changes_counts_written_rows():
+    record_changes("dim_design", Counter(inserted=2, updated=3, unchanged=9))
+    record_changes("dim_design", Counter(written=4, rejected=1))
+    record_changes("dim_staff", Counter(unchanged=5))
+
+    assert changed_rows == {"dim_design": 9}
+
+    forget_changes("dim_design")
+    assert changed_rows == {}
+
+
+def test_maintenance_threshold_from_environment():
+    assert maintenance_threshold(50_000) == 6000
+    env = {"LOAD_MAINTENANCE_ROWS": "0", "LOAD_MAINTENANCE_FRACTION": "0.5"}
+    with patch.dict(os.environ, env):
+        assert maintenance_threshold(50_000) == 25_000
+    with patch.dict(os.environ, {"LOAD_VACUUM_TABLES": " a, b ,"}):
+        assert vacuumed_tables() == {"a", "b"}
+
+
+def test_needs_check_without_round_trip_below_threshold(caplog):
+    assert not needs_check("dim_design")
+    record_changes("dim_design", Counter(inserted=10))
+    # size not known yet
+    assert needs_check("dim_design")
+
+    table_rows["dim_design"] = 100
+    with caplog.at_level("INFO"):
+        assert not needs_check("dim_design")
+    assert "maintenance deferred until 1010" in caplog.text
+
+    record_changes("dim_design", Counter(updated=1000))
+    assert needs_check("dim_design")
+
+
+@pytest.mark.parametrize(
+    "vacuum, statement",
+    [("", "ANALYZE"), ("dim_staff,dim_design", "VACUUM (ANALYZE)")],
+)
+def test_maintain_runs_statement_once_threshold_reached(vacuum, statement):
+    con = mock_connection(20_000)
+    record_changes("dim_design", Counter(inserted=2999))
+
+    with patch.dict(os.environ, {"LOAD_VACUUM_TABLES": vacuum}):
+        assert maintain(con, "dim_design") is None
+        record_changes("dim_design", Counter(updated=1))
+        assert maintain(con, "dim_design") == statement
+
+    con.run.assert_any_call(f"{statement} dim_design")
+    assert changed_rows["dim_design"] == 0
+    assert table_rows == {"dim_design": 20_000}
+
+
+@patch("src.loader.warm_connection")
+def test_maintain_table_failure_is_logged(mock_warm_connection, caplog):
+    con = mock_warm_connection.return_value.__enter__.return_value
+    con.run.side_effect = Exception("lock timeout")
+    record_changes("dim_design", Counter(inserted=1))
+
+    maintain_table("dim_design")
+
+    assert "Maintenance of dim_design failed: lock timeout" in caplog.text
+
+
+@inhibit_CI
+def test_loads_analyze_changed_tables(mockdb_creds):
+    con = get_connection()
+    con.run("DROP TABLE IF EXISTS dim_design;")
+    con.run(
+        "CREATE TABLE dim_design "
+        "(design_record_id INT PRIMARY KEY, design_name VARCHAR);"
+    )
+    df = pd.DataFrame(
+        {"design_record_id": range(50), "design_name": ["a"] * 50}
+    )
+    env = {"LOAD_MODE": "copy", "LOAD_MAINTENANCE_ROWS": "10"}
+
+    with patch.dict(os.environ, env):
+        assert load_frame(df, "dim_design", "design_record_id", "k")
+        maintain_table("dim_design")
+
+    assert con.run(
+        "SELECT reltuples FROM pg_class WHERE relname = 'dim_design'"
+    ) == [[50.0]]
+    assert changed_rows["dim_design"] == 0
+    con.run("DROP TABLE dim_design;")
+    con.close()
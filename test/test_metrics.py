@@ -0,0 +1,156 @@
+import json
+import os
+from datetime import datetime
+from unittest.mock import Mock, patch
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pytest
+from moto import mock_aws
+# the lambdas emit through the module they import
+from metrics import captured_metrics, emf_document, stage, table_of
+from src.extractor import extract
+from src.loader import load_file
+from src.transformation import upload_parquet
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+def metric_names(document):
+    [directive] = document["_aws"]["CloudWatchMetrics"]
+    return [metric["Name"] for metric in directive["Metrics"]]
+
+
+def test_emf_document_declares_its_metrics():
+    with patch.dict(os.environ, {"METRICS_NAMESPACE": "Test"}):
+        document = emf_document(
+            "loader", "insert", "dim_design", 0.5, rows=100, size=2048
+        )
+
+    [directive] = document["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == "Test"
+    assert directive["Dimensions"] == [["Service", "Stage", "Table"]]
+    assert metric_names(document) == [
+        "Duration", "Errors", "Rows", "RowsPerSecond", "Bytes"
+    ]
+    assert document["Service"] == "loader"
+    assert document["Table"] == "dim_design"
+    assert document["Duration"] == 500.0
+    assert document["RowsPerSecond"] == 200.0
+    assert document["Bytes"] == 2048
+    assert metric_names(emf_document("a", "b", "c", 1.0)) == [
+        "Duration", "Errors"
+    ]
+
+
+def test_stage_prints_one_json_line(capsys):
+    with stage("extractor", "query", "design") as measured:
+        measured["rows"] = 3
+
+    [line] = capsys.readouterr().out.splitlines()
+    document = json.loads(line)
+    assert document["Stage"] == "query"
+    assert document["Rows"] == 3
+    assert document["Errors"] == 0
+
+
+def test_stage_failures_count_as_errors():
+    with captured_metrics() as documents:
+        with pytest.raises(ValueError):
+            with stage("loader", "download", "dim_staff", rows=5):
+                raise ValueError("bad file")
+        with stage("loader", "insert", "dim_staff", rows=5) as measured:
+            measured["failed"] = True
+        with patch.dict(os.environ, {"METRICS_ENABLED": "false"}):
+            with stage("loader", "insert", "dim_staff"):
+                pass
+
+    assert [document["Errors"] for document in documents] == [1, 1]
+    assert "RowsPerSecond" not in documents[0]
+
+
+@pytest.mark.parametrize(
+    "key, table",
+    [
+        ("2024-02-15T19:01:53/design.pqt", "design"),
+        ("table=staff/last_updated_date=2024-02-15/2024.pqt", "staff"),
+        ("sales_order.pqt", "sales_order"),
+    ],
+)
+def test_table_of(key, table):
+    assert table_of(key) == table
+
+
+def test_extract_emits_every_stage(s3):
+    conn = Mock()
+    conn.run.return_value = [[1, "AAA"], [2, "BBB"]]
+    conn.columns = [{"name": "a"}, {"name": "b"}]
+    time = datetime(2024, 2, 13, 10, 45, 18)
+
+    with captured_metrics() as documents:
+        extract(s3, conn, "bucket", "design", time, None)
+
+    assert [document["Stage"] for document in documents] == [
+        "query", "build_frame", "serialize", "upload"
+    ]
+    assert {document["Table"] for document in documents} == {"design"}
+    assert [document["Rows"] for document in documents] == [2, 2, 2, 2]
+    size = s3.head_object(
+        Bucket="bucket", Key="2024-02-13T10:45:18/design.pqt"
+    )["ContentLength"]
+    assert documents[2]["Bytes"] == documents[3]["Bytes"] == size
+
+
+def test_transformation_upload_emits_table_of_hive_keys(s3):
+    table = pa.table({"staff_record_id": [1, 2, 3]})
+
+    with captured_metrics() as documents:
+        upload_parquet(
+            s3, "bucket", "table=staff/last_updated_date=x/t.pqt", table
+        )
+
+    assert [(d["Stage"], d["Table"], d["Rows"]) for d in documents] == [
+        ("serialize", "staff", 3),
+        ("upload", "staff", 3),
+    ]
+
+
+@patch("src.loader.maintain_table")
+@patch("src.loader.load_frame")
+@patch("src.loader.get_df_from_parquet")
+def test_load_file_emits_download_and_insert(
+    mock_get_df, mock_load_frame, mock_maintain_table
+):
+    mock_get_df.return_value = pd.DataFrame({"design_record_id": [1, 2]})
+    mock_load_frame.return_value = None
+
+    with patch.dict(os.environ, {"LOAD_MODE": "row"}):
+        with captured_metrics() as documents:
+            load_file("2024-02-15T19:01:53/design.pqt", "bucket")
+
+    assert [
+        (d["Stage"], d["Table"], d["Rows"], d["Errors"]) for d in documents
+    ] == [
+        ("download", "dim_design", 2, 0),
+        ("insert", "dim_design", 2, 1),
+    ]
@@ -0,0 +1,121 @@
+import io
+import os
+import threading
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+from src.parquet_stream import (
+    S3RangeReader,
+    iter_batches,
+    prefetch,
+    to_frame,
+)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(
+            Bucket="processed",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield client
+
+
+def put_table(client, key, table, row_group_size):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, row_group_size=row_group_size)
+    client.put_object(Bucket="processed", Key=key, Body=buffer.getvalue())
+
+
+def test_s3_range_reader_reads_and_seeks(s3):
+    s3.put_object(Bucket="processed", Key="blob", Body=b"0123456789")
+    reader = S3RangeReader(s3, "processed", "blob")
+
+    assert reader.read(4) == b"0123"
+    reader.seek(-3, io.SEEK_END)
+    assert reader.read() == b"789"
+    reader.seek(2)
+    assert reader.read(3) == b"234"
+    assert reader.tell() == 5
+    reader.seek(20)
+    assert reader.read(4) == b""
+
+
+def test_iter_batches_streams_row_groups_in_order(s3):
+    table = pa.table({"id": range(10), "name": [f"n{i}" for i in range(10)]})
+    put_table(s3, "run/design.pqt", table, row_group_size=4)
+
+    batches = list(iter_batches(s3, "processed", "run/design.pqt", 3))
+
+    assert [batch.num_rows for batch in batches] == [3, 3, 3, 1]
+    assert pa.Table.from_batches(batches).equals(table)
+
+
+def test_to_frame_uses_nullable_dtypes():
+    batch = pa.RecordBatch.from_pydict(
+        {
+            "id": pa.array([1, None], pa.int64()),
+            "name": pa.array(["a", None]),
+            "price": pa.array([1.5, None]),
+        }
+    )
+
+    df = to_frame(batch)
+
+    assert df["id"].dtype == "Int64"
+    assert df["name"].dtype == pd.StringDtype()
+    assert df["price"].dtype == "float64"
+    assert df["id"].isna().tolist() == [False, True]
+
+
+def test_prefetch_produces_next_item_while_current_is_used():
+    produced = []
+    ready = threading.Event()
+
+    def items():
+        for number in range(3):
+            produced.append(number)
+            if number == 1:
+                ready.set()
+            yield number
+
+    consumed = []
+    for item in prefetch(items()):
+        if item == 0:
+            # item 1 is produced without being asked for
+            assert ready.wait(timeout=5)
+        consumed.append(item)
+
+    assert consumed == [0, 1, 2]
+    assert produced == [0, 1, 2]
+
+
+def test_prefetch_stops_when_consumer_stops():
+    produced = []
+
+    def items():
+        for number in range(100):
+            produced.append(number)
+            yield number
+
+    for item in prefetch(items()):
+        if item == 1:
+            break
+
+    assert len(produced) <= 3
@@ -0,0 +1,188 @@
+from datetime import date, datetime, time
+from decimal import Decimal
+import struct
+import pyarrow as pa
+import pytest
+from src.pg_binary_copy import (
+    PGCOPY_HEADER,
+    PGCOPY_TRAILER,
+    arrow_type_for,
+    cast_to_column_types,
+    encode_batch,
+    encode_table,
+    iter_copy_chunks,
+)
+
+
+def tuples(table):
+    """Encodes a one column table and returns its field bytes per row."""
+    data = encode_table(table)[len(PGCOPY_HEADER):-len(PGCOPY_TRAILER)]
+    fields = []
+    while data:
+        assert struct.unpack(">h", data[:2])[0] == 1
+        length = struct.unpack(">i", data[2:6])[0]
+        if length == -1:
+            fields.append(None)
+            data = data[6:]
+        else:
+            fields.append(data[6:6 + length])
+            data = data[6 + length:]
+    return fields
+
+
+def test_encode_table_wraps_tuples_in_header_and_trailer():
+    data = encode_table(pa.table({"id": pa.array([], pa.int32())}))
+
+    assert data == b"PGCOPY\n\xff\r\n\x00" + bytes(8) + b"\xff\xff"
+
+
+def test_encodes_integers_big_endian():
+    table = pa.table({"id": pa.array([1, -2], pa.int32())})
+
+    assert tuples(table) == [b"\x00\x00\x00\x01", b"\xff\xff\xff\xfe"]
+
+
+def test_encodes_nulls_as_minus_one_length():
+    table = pa.table({"id": pa.array([None, 3], pa.int64())})
+
+    assert tuples(table) == [None, struct.pack(">q", 3)]
+
+
+def test_encodes_strings_as_utf8():
+    table = pa.table({"name": ["abc", "", None, "né"]})
+
+    assert tuples(table) == [b"abc", b"", None, "né".encode()]
+
+
+def test_encodes_sliced_strings():
+    table = pa.table({"name": ["abc", "de", "f"]}).slice(1)
+
+    assert tuples(table) == [b"de", b"f"]
+
+
+def test_encodes_dates_from_postgres_epoch():
+    table = pa.table({"day": [date(2000, 1, 1), date(1999, 12, 31)]})
+
+    assert tuples(table) == [struct.pack(">i", 0), struct.pack(">i", -1)]
+
+
+def test_encodes_times_and_timestamps_as_microseconds():
+    table = pa.table(
+        {
+            "at": pa.array([time(0, 0, 1)], pa.time64("us")),
+        }
+    )
+    stamps = pa.table(
+        {
+            "at": pa.array(
+                [datetime(2000, 1, 1, 0, 0, 0, 5)], pa.timestamp("us")
+            )
+        }
+    )
+
+    assert tuples(table) == [struct.pack(">q", 1_000_000)]
+    assert tuples(stamps) == [struct.pack(">q", 5)]
+
+
+def test_encodes_booleans_and_floats():
+    flags = pa.table({"flag": [True, False]})
+    floats = pa.table({"value": pa.array([1.5], pa.float64())})
+
+    assert tuples(flags) == [b"\x01", b"\x00"]
+    assert tuples(floats) == [struct.pack(">d", 1.5)]
+
+
+def test_encodes_numeric_in_base_10000_groups():
+    table = pa.table(
+        {"price": pa.array([Decimal("-12345.67"), None], pa.decimal128(10, 2))}
+    )
+
+    header = struct.pack(">hhhh", 6, 4, 0x4000, 2)
+    digits = struct.pack(">hhhhhh", 0, 0, 0, 1, 2345, 6700)
+    assert tuples(table) == [header + digits, None]
+
+
+def numeric_value(field):
+    """Decodes a postgres binary numeric field."""
+    ndigits, weight, sign, scale = struct.unpack(">hhhh", field[:8])
+    digits = struct.unpack(f">{ndigits}h", field[8:])
+    value = sum(
+        Decimal(digit) * Decimal(10000) ** (weight - i)
+        for i, digit in enumerate(digits)
+    )
+    value = -value if sign == 0x4000 else value
+    return value.quantize(Decimal(1).scaleb(-scale))
+
+
+@pytest.mark.parametrize(
+    "values, scale",
+    [
+        (["92.23372036854775807", "-0.00000000000000001", "1.5"], 17),
+        (["9.223372036854775807", "-0.000000000000000001", "0"], 18),
+        (["-12345.67", "0.01"], 2),
+    ],
+)
+def test_numeric_round_trips_at_every_scale(values, scale):
+    values = [Decimal(value) for value in values]
+    table = pa.table({"price": pa.array(values, pa.decimal128(38, scale))})
+
+    assert [numeric_value(field) for field in tuples(table)] == values
+
+
+def test_numeric_rejects_values_over_64_bits():
+    table = pa.table(
+        {"price": pa.array([Decimal(10**20)], pa.decimal128(38, 0))}
+    )
+
+    with pytest.raises(ValueError):
+        encode_batch(table.to_batches()[0])
+
+
+def test_arrow_type_for_reads_numeric_modifiers():
+    assert arrow_type_for("numeric(10,2)", pa.float64()) == pa.decimal128(
+        10, 2
+    )
+    assert arrow_type_for("character varying(50)", pa.string()) == (
+        pa.string()
+    )
+    with pytest.raises(ValueError):
+        arrow_type_for("jsonb", pa.string())
+
+
+def test_cast_to_column_types_casts_every_column():
+    table = pa.table({"id": [1], "amount": [2.5], "day": ["2024-01-02"]})
+
+    result = cast_to_column_types(
+        table, {"id": "integer", "amount": "numeric(10,2)", "day": "date"}
+    )
+
+    assert result.schema == pa.schema(
+        [
+            ("id", pa.int32()),
+            ("amount", pa.decimal128(10, 2)),
+            ("day", pa.date32()),
+        ]
+    )
+
+
+def test_cast_to_column_types_parses_time_strings():
+    table = pa.table({"at": ["12:00:01", None, "13:30:00.25"]})
+
+    result = cast_to_column_types(table, {"at": "time without time zone"})
+
+    assert result.column("at").to_pylist() == [
+        time(12, 0, 1),
+        None,
+        time(13, 30, 0, 250000),
+    ]
+
+
+def test_iter_copy_chunks_splits_rows_into_chunks():
+    table = pa.table({"id": pa.array(range(5), pa.int16())})
+
+    chunks = list(iter_copy_chunks(table, rows_per_chunk=2))
+
+    assert chunks[0] == PGCOPY_HEADER
+    assert chunks[-1] == PGCOPY_TRAILER
+    assert len(chunks) == 5
+    assert b"".join(chunks) == encode_table(table)
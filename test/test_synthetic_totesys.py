@@ -0,0 +1,81 @@
+from unittest.mock import patch
+import pandas as pd
+import pytest
+from scripts.synthetic_totesys import (
+    SOURCE_COLUMNS,
+    TABLES,
+    generate,
+    generate_block,
+    table_sizes,
+)
+from src.transformation import (
+    transform_counterparty_table,
+    sales_order_transformation,
+    transform_transaction_table,
+)
+
+
+@pytest.fixture(scope="module")
+def totesys():
+    return generate(2000, seed=3)
+
+
+def test_tables_have_their_sizes_and_source_columns(totesys):
+    assert set(totesys) == set(TABLES)
+    for table, df in totesys.items():
+        assert len(df) == table_sizes(2000)[table]
+        assert list(df.columns) == SOURCE_COLUMNS[table]
+        assert df[f"{table}_id"].is_unique
+        assert (df["last_updated"] >= df["created_at"]).all()
+
+
+def test_same_seed_same_rows_and_blocks_hold_their_ids(totesys):
+    pd.testing.assert_frame_equal(generate(2000, seed=3)["payment"],
+                                  totesys["payment"])
+    assert not generate(2000, seed=4)["payment"].equals(totesys["payment"])
+    with patch("scripts.synthetic_totesys.BLOCK_ROWS", 1000):
+        second = generate_block("sales_order", 2000, 1, seed=3)
+    # a block can be generated on its own, e.g. by a parallel writer
+    assert second["sales_order_id"].tolist() == list(range(1001, 2001))
+
+
+@pytest.mark.parametrize(
+    "table, column, parent",
+    [
+        ("sales_order", "design_id", "design"),
+        ("sales_order", "staff_id", "staff"),
+        ("sales_order", "agreed_delivery_location_id", "address"),
+        ("purchase_order", "counterparty_id", "counterparty"),
+        ("counterparty", "legal_address_id", "address"),
+        ("staff", "department_id", "department"),
+        ("payment", "transaction_id", "transaction"),
+        ("payment", "currency_id", "currency"),
+        ("payment", "payment_type_id", "payment_type"),
+        ("transaction", "sales_order_id", "sales_order"),
+        ("transaction", "purchase_order_id", "purchase_order"),
+    ],
+)
+def test_foreign_keys_exist(totesys, table, column, parent):
+    keys = totesys[table][column].dropna()
+    assert keys.isin(totesys[parent][f"{parent}_id"]).all()
+
+
+def test_every_transaction_has_one_order(totesys):
+    transactions = totesys["transaction"]
+    assert (
+        transactions["sales_order_id"].isna()
+        != transactions["purchase_order_id"].isna()
+    ).all()
+    assert transactions["sales_order_id"].nunique() == 2000
+
+
+def test_templates_accept_generated_tables(totesys):
+    counterparty = totesys["counterparty"].merge(
+        totesys["address"].drop(columns=["created_at", "last_updated"]),
+        left_on="legal_address_id",
+        right_on="address_id",
+    )
+
+    assert len(transform_counterparty_table(counterparty)) == 5
+    assert len(sales_order_transformation(totesys["sales_order"])) == 2000
+    assert len(transform_transaction_table(totesys["transaction"])) == 3000
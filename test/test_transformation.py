@@ -3,6 +3,12 @@ from src.transformation import (
     upload_parquet,
     get_df_from_parquet,
     get_table_name,
+    partition_key,
+    split_partitions,
+    list_partitions,
+    list_partition_keys,
+    tables_record_ids,
+    tables_transformation_templates,
 )
 
 # from src.transformation import tables_transformation_templates
@@ -96,9 +102,16 @@ def test_get_table_name():
     assert get_table_name(keys[1]) == "purchase_order"
 
 
+@patch("src.transformation.upload_profile")
+@patch("src.transformation.record_dimension_keys")
 @patch("src.transformation.upload_parquet")
 @patch("src.transformation.get_df_from_parquet")
-def test_lambda_handler(mock_get_df_from_parquet, mock_upload_parquet):
+def test_lambda_handler(
+    mock_get_df_from_parquet,
+    mock_upload_parquet,
+    mock_record_keys,
+    mock_upload_profile,
+):
     data = {
         "address_id": [1, 2, 3],
         "address_line_1": [
@@ -141,6 +154,7 @@ def test_lambda_handler(mock_get_df_from_parquet, mock_upload_parquet):
         )
     )
     mock_upload_parquet.assert_called_once()
+    assert mock_record_keys.call_args[0][2] == "address"
 
 
 @mock_aws
@@ -197,3 +211,206 @@ def test_general_exception_error():
 
     with pytest.raises(Exception):
         lambda_handler(event, context)
+
+
+def test_partition_key():
+    key = partition_key("design", "2024-02-15", "2024-02-15T19:01:53")
+    assert key == (
+        "table=design/last_updated_date=2024-02-15/2024-02-15T19:01:53.pqt"
+    )
+
+
+def test_split_partitions():
+    df = pd.DataFrame(
+        {
+            "design_record_id": [1, 2, 3],
+            "last_updated_date": [
+                datetime(2024, 2, 16).date(),
+                datetime(2024, 2, 15).date(),
+                datetime(2024, 2, 16).date(),
+            ],
+        }
+    )
+
+    parts = split_partitions(df)
+
+    assert [str(date) for date, _ in parts] == ["2024-02-15", "2024-02-16"]
+    assert list(parts[1][1]["design_record_id"]) == [1, 3]
+
+
+@patch.dict(os.environ, {"TRANSFORM_OUTPUT_LAYOUT": "hive"})
+@patch("src.transformation.upload_manifest")
+@patch("src.transformation.upload_profile")
+@patch("src.transformation.record_dimension_keys")
+@patch("src.transformation.upload_parquet")
+@patch("src.transformation.get_df_from_parquet")
+def test_lambda_handler_hive_layout(
+    mock_get_df_from_parquet,
+    mock_upload_parquet,
+    mock_record_keys,
+    mock_upload_profile,
+    mock_upload_manifest,
+):
+    mock_get_df_from_parquet.return_value = pd.DataFrame(
+        {
+            "design_id": [1, 2],
+            "design_name": ["a", "b"],
+            "file_location": ["/a", "/b"],
+            "file_name": ["a.json", "b.json"],
+            "created_at": [datetime(2024, 2, 14), datetime(2024, 2, 14)],
+            "last_updated": [datetime(2024, 2, 14), datetime(2024, 2, 15)],
+        }
+    )
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "extraction"},
+                    "object": {"key": "2024-02-15T19:01:53/design.pqt"},
+                }
+            }
+        ],
+    }
+
+    lambda_handler(event, {})
+
+    keys = [call.args[2] for call in mock_upload_parquet.call_args_list]
+    assert keys == [
+        "table=design/last_updated_date=2024-02-14/2024-02-15T19:01:53.pqt",
+        "table=design/last_updated_date=2024-02-15/2024-02-15T19:01:53.pqt",
+    ]
+    assert mock_upload_manifest.call_args.args[2:] == (
+        "2024-02-15T19:01:53/design.pqt",
+        keys,
+    )
+
+
+def test_list_partitions(s3):
+    bucket = "test-transformed"
+    s3.create_bucket(
+        Bucket=bucket,
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    keys = [
+        partition_key("design", "2024-02-14", "2024-02-15T19:00:00"),
+        partition_key("design", "2024-02-15", "2024-02-15T19:00:00"),
+        partition_key("design", "2024-02-15", "2024-02-15T19:15:00"),
+        partition_key("design", "2024-02-16", "2024-02-16T09:00:00"),
+        partition_key("staff", "2024-02-15", "2024-02-15T19:00:00"),
+    ]
+    for key in keys:
+        s3.put_object(Bucket=bucket, Key=key, Body=b"")
+
+    assert list_partitions(s3, bucket, "design") == [
+        "2024-02-14",
+        "2024-02-15",
+        "2024-02-16",
+    ]
+    assert list_partitions(s3, bucket, "design", start="2024-02-15") == [
+        "2024-02-15",
+        "2024-02-16",
+    ]
+    assert list_partition_keys(
+        s3, bucket, "design", "2024-02-15", "2024-02-15"
+    ) == keys[1:3]
+
+
+@patch("src.transformation.emit_dim_date", return_value=None)
+@patch("src.transformation.upload_profile")
+@patch("src.transformation.check_fact_keys")
+@patch("src.transformation.upload_parquet")
+@patch("src.transformation.get_df_from_parquet")
+def test_lambda_handler_checks_fact_keys(
+    mock_get_df_from_parquet,
+    mock_upload_parquet,
+    mock_check_fact_keys,
+    mock_upload_profile,
+    mock_emit_dim_date,
+):
+    mock_get_df_from_parquet.return_value = pd.DataFrame(
+        {
+            "sales_order_id": [1],
+            "created_at": [datetime(2024, 2, 14)],
+            "last_updated": [datetime(2024, 2, 14)],
+            "design_id": [1],
+            "staff_id": [1],
+            "counterparty_id": [1],
+            "currency_id": [1],
+        }
+    )
+    orphans = {"rows": 1, "columns": {"design_record_id": 1}}
+    mock_check_fact_keys.return_value = orphans
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "extraction"},
+                    "object": {"key": "2024-02-15T19:01:53/sales_order.pqt"},
+                }
+            }
+        ],
+    }
+
+    lambda_handler(event, {})
+
+    assert mock_check_fact_keys.call_args[0][3] == "sales_order"
+    # orphans are reported, not removed
+    uploaded = mock_upload_parquet.call_args[0][3]
+    assert uploaded.num_rows == 1
+    profile = mock_upload_profile.call_args[0][3]
+    assert profile["primary_key"] == "sales_record_id"
+    assert profile["rows"] == 1
+    assert profile["orphans"] == orphans
+
+
+@patch("src.transformation.save_ranges")
+@patch("src.transformation.emit_dim_date")
+@patch("src.transformation.upload_profile")
+@patch("src.transformation.check_fact_keys")
+@patch("src.transformation.upload_parquet")
+@patch("src.transformation.get_df_from_parquet")
+def test_lambda_handler_emits_dim_date(
+    mock_get_df_from_parquet,
+    mock_upload_parquet,
+    mock_check_fact_keys,
+    mock_upload_profile,
+    mock_emit_dim_date,
+    mock_save_ranges,
+):
+    mock_check_fact_keys.return_value = {"rows": 0, "columns": {}}
+    mock_emit_dim_date.return_value = ("dates", ["ranges"])
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "extraction"},
+                    "object": {"key": "2024-02-15T19:01:53/sales_order.pqt"},
+                }
+            }
+        ],
+    }
+    mock_get_df_from_parquet.return_value = pd.DataFrame(
+        {
+            "sales_order_id": [1],
+            "created_at": [datetime(2024, 2, 14)],
+            "last_updated": [datetime(2024, 2, 14)],
+        }
+    )
+
+    lambda_handler(event, {})
+
+    first_upload = mock_upload_parquet.call_args_list[0][0]
+    assert first_upload[2:4] == (
+        "2024-02-15T19:01:53/date_sales_order.pqt",
+        "dates",
+    )
+    assert "transformed_at" in first_upload[4]
+    assert mock_save_ranges.call_args[0][2:] == (["ranges"],)
+
+
+def test_every_table_has_its_record_id():
+    from src.loader import table_relations
+
+    assert tables_record_ids.keys() == tables_transformation_templates.keys()
+    for table, record_id in tables_record_ids.items():
+        assert table_relations[table][1] == record_id
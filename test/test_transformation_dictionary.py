@@ -559,5 +559,8 @@ def test_transform_transaction_table():
     expected_df = expected_df.astype(
         {col: "int32" for col in expected_df.select_dtypes("int64").columns}
     )
+    expected_df = expected_df.astype(
+        {"sales_order_id": "Int64", "purchase_order_id": "Int64"}
+    )
 
     assert transformed_df.equals(expected_df)